@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+# Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
+# See LICENSE in the project root for license information.
+
+# -*- coding:utf-8 -*-
+
+'''
+Throughput of read-mostly API endpoints with and without the response cache.
+
+Runs GET /v0/plans/{id} and GET /v0/applications in process against a fake
+database that sleeps `LATENCY` ms per query to stand in for MySQL round trips.
+Each endpoint is measured uncached, cached, and cached with clients
+revalidating through If-None-Match.
+
+usage: python benchmarks/bench_response_cache.py [REQUESTS] [LATENCY]
+'''
+
+import sys
+import time
+import falcon
+import falcon.testing
+from mock import patch, MagicMock
+
+from iris_api import api
+from iris_api.metrics import stats
+
+
+plan = {
+    'id': 1, 'name': 'bench-plan', 'threshold_window': 900, 'threshold_count': 10, 'aggregation_window': 300,
+    'aggregation_reset': 300, 'description': 'x' * 200, 'created': 0, 'creator': 'demo', 'tracking_type': None,
+    'tracking_key': None, 'tracking_template': None, 'active': 1,
+}
+steps = [{'step': step, 'role': 'user', 'target': 'demo', 'priority': 'high', 'wait': 600, 'repeat': 1,
+          'template': 'bench-template'} for step in xrange(1, 4) for _ in xrange(3)]
+applications = [{'id': i, 'name': 'app-%d' % i, 'context_template': 'x' * 500, 'sample_context': '{}',
+                 'summary_template': 'x' * 200} for i in xrange(20)]
+variables = [{'name': 'var-%d' % i, 'required': i % 2} for i in xrange(5)]
+
+
+def fake_cursor(latency):
+    cursor = MagicMock()
+    state = {}
+
+    def execute(query, *args):
+        time.sleep(latency)
+        if query.startswith(api.single_plan_query):
+            state['rows'] = [dict(plan)]
+        elif query == api.single_plan_query_steps:
+            state['rows'] = [dict(step) for step in steps]
+        elif query == api.get_applications_query:
+            state['rows'] = [dict(app) for app in applications]
+        else:
+            state['rows'] = [dict(var) for var in variables]
+
+    cursor.execute.side_effect = execute
+    cursor.fetchall.side_effect = lambda: state['rows']
+    cursor.__iter__.side_effect = lambda: iter(state['rows'])
+    return cursor
+
+
+def bench(client, name, path, count, cached, revalidate):
+    api.response_cache.max_size = 1000 if cached else 0
+    api.response_cache.invalidate('plan')
+    api.response_cache.invalidate('application')
+    headers = {}
+    if revalidate:
+        headers['If-None-Match'] = client.simulate_get(path=path).headers['etag']
+    start = time.time()
+    for _ in xrange(count):
+        result = client.simulate_get(path=path, headers=headers)
+        assert result.status in (falcon.HTTP_200, falcon.HTTP_304)
+    elapsed = time.time() - start
+    mode = 'revalidate' if revalidate else 'cached' if cached else 'uncached'
+    print '%-18s %-10s %10.0f req/s %8d B' % (name, mode, count / elapsed, len(result.content))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    latency = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.0005
+    stats.update(api.default_api_metrics)
+
+    app = falcon.API()
+    app.add_route('/v0/plans/{plan_id}', api.Plan())
+    app.add_route('/v0/applications', api.Applications())
+    client = falcon.testing.TestClient(app)
+
+    with patch('iris_api.api.db') as db:
+        db.engine.raw_connection.return_value.cursor.side_effect = lambda *args: fake_cursor(latency)
+        for name, path in (('plan', '/v0/plans/1'), ('applications', '/v0/applications')):
+            bench(client, name, path, count / 10, False, False)
+            bench(client, name, path, count, True, False)
+            bench(client, name, path, count, True, True)
+
+
+if __name__ == '__main__':
+    main()
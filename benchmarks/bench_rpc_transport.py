@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+# Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
+# See LICENSE in the project root for license information.
+
+# -*- coding:utf-8 -*-
+
+'''
+Throughput of the sender RPC transport over localhost sockets.
+
+Compares the framed transport (iris_api.utils.MsgpackFramedSocket) against
+the previous transport, which read with recv(1024) into a fresh msgpack
+Unpacker per message. Each case echoes messages of a given body size over a
+single persistent connection.
+
+usage: python benchmarks/bench_rpc_transport.py [MESSAGES]
+'''
+
+from gevent import socket
+from gevent.server import StreamServer
+import msgpack
+import sys
+import time
+
+from iris_api.utils import MsgpackFramedSocket
+
+
+def legacy_recv(sock, unpacker):
+    while True:
+        try:
+            return unpacker.next()
+        except StopIteration:
+            pass
+        buf = sock.recv(1024)
+        if not buf:
+            return None
+        unpacker.feed(buf)
+
+
+def legacy_handler(sock, address):
+    unpacker = msgpack.Unpacker()
+    while True:
+        msg = legacy_recv(sock, unpacker)
+        if msg is None:
+            break
+        sock.sendall(msgpack.packb(msg))
+    sock.close()
+
+
+def framed_handler(sock, address):
+    connection = MsgpackFramedSocket(sock)
+    while True:
+        msg = connection.recv()
+        if msg is None:
+            break
+        connection.send(msg)
+    connection.close()
+
+
+def run_legacy(address, message, count):
+    sock = socket.create_connection(address)
+    unpacker = msgpack.Unpacker()
+    payload = msgpack.packb(message)
+    for _ in xrange(count):
+        sock.sendall(payload)
+        legacy_recv(sock, unpacker)
+    sock.close()
+
+
+def run_framed(address, message, count):
+    connection = MsgpackFramedSocket(socket.create_connection(address))
+    payload = msgpack.packb(message)
+    for _ in xrange(count):
+        connection.send_packed(payload)
+        connection.recv()
+    connection.close()
+
+
+def bench(name, handler, client, message, count):
+    server = StreamServer(('127.0.0.1', 0), handler)
+    server.start()
+    start = time.time()
+    client(('127.0.0.1', server.server_port), message, count)
+    elapsed = time.time() - start
+    server.stop()
+    size = len(msgpack.packb(message))
+    print '%-8s %8d B %10.0f msg/s %10.2f MB/s' % (
+        name, size, count / elapsed, 2 * size * count / elapsed / 1024 / 1024)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    for body_size in (100, 4096, 65536, 1024 * 1024):
+        message = {'endpoint': 'v0/slave_send',
+                   'data': {'message_id': 1234, 'subject': 'subject', 'body': 'x' * body_size,
+                            'aggregated_ids': range(50)}}
+        n = max(count * 1024 / max(body_size, 1024), 20)
+        bench('legacy', legacy_handler, run_legacy, message, n)
+        bench('framed', framed_handler, run_framed, message, n)
+
+
+if __name__ == '__main__':
+    main()
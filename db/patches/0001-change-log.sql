@@ -0,0 +1,10 @@
+-- Versioned log of template and plan activation changes, polled by the
+-- sender to refresh only what changed.
+CREATE TABLE IF NOT EXISTS `change_log` (
+  `id` bigint(20) NOT NULL AUTO_INCREMENT,
+  `type` varchar(32) NOT NULL,
+  `name` varchar(255) NOT NULL,
+  `created` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id`),
+  KEY `ix_change_log_created` (`created`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
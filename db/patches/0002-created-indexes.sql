@@ -0,0 +1,20 @@
+-- (created, id) indexes backing ordered and keyset paginated listing of
+-- messages and incidents. MySQL has no ADD INDEX IF NOT EXISTS, so each is
+-- only added when missing.
+SET @sql = (SELECT IF(COUNT(*) = 0,
+                      'ALTER TABLE `message` ADD KEY `ix_message_created` (`created`, `id`)',
+                      'DO 0')
+            FROM `information_schema`.`statistics`
+            WHERE `table_schema` = DATABASE() AND `table_name` = 'message' AND `index_name` = 'ix_message_created');
+PREPARE stmt FROM @sql;
+EXECUTE stmt;
+DEALLOCATE PREPARE stmt;
+
+SET @sql = (SELECT IF(COUNT(*) = 0,
+                      'ALTER TABLE `incident` ADD KEY `ix_incident_created` (`created`, `id`)',
+                      'DO 0')
+            FROM `information_schema`.`statistics`
+            WHERE `table_schema` = DATABASE() AND `table_name` = 'incident' AND `index_name` = 'ix_incident_created');
+PREPARE stmt FROM @sql;
+EXECUTE stmt;
+DEALLOCATE PREPARE stmt;
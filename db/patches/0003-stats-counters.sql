@@ -0,0 +1,15 @@
+-- Counters behind /v0/stats, maintained by the master sender so the endpoint
+-- doesn't have to scan message and incident.
+CREATE TABLE IF NOT EXISTS `stats_counter` (
+  `name` varchar(64) NOT NULL,
+  `value` bigint(20) NOT NULL DEFAULT '0',
+  `watermark` bigint(20) NOT NULL DEFAULT '0',
+  PRIMARY KEY (`name`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+
+CREATE TABLE IF NOT EXISTS `stats_daily_counter` (
+  `day` date NOT NULL,
+  `name` varchar(64) NOT NULL,
+  `value` bigint(20) NOT NULL DEFAULT '0',
+  PRIMARY KEY (`day`, `name`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
@@ -0,0 +1,11 @@
+-- Flags set alongside mode and target changes in message_changelog, read by
+-- message listings instead of a subquery per row. Populate existing messages
+-- with `iris_ctl message backfill-change-flags`.
+SET @sql = (SELECT IF(COUNT(*) = 0,
+                      'ALTER TABLE `message` ADD COLUMN `mode_changed` tinyint(1) NOT NULL DEFAULT \'0\' AFTER `plan_notification_id`, ADD COLUMN `target_changed` tinyint(1) NOT NULL DEFAULT \'0\' AFTER `mode_changed`',
+                      'DO 0')
+            FROM `information_schema`.`columns`
+            WHERE `table_schema` = DATABASE() AND `table_name` = 'message' AND `column_name` = 'mode_changed');
+PREPARE stmt FROM @sql;
+EXECUTE stmt;
+DEALLOCATE PREPARE stmt;
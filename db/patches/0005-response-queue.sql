@@ -0,0 +1,15 @@
+-- Webhook responses queued by the API when response_queue is enabled,
+-- deduplicated on a hash of the provider's message id.
+CREATE TABLE IF NOT EXISTS `response_queue` (
+  `id` bigint(20) NOT NULL AUTO_INCREMENT,
+  `idempotency_key` char(40) NOT NULL,
+  `kind` varchar(32) NOT NULL,
+  `body` mediumtext NOT NULL,
+  `created` datetime NOT NULL,
+  `claimed` datetime DEFAULT NULL,
+  `attempts` int(11) NOT NULL DEFAULT '0',
+  `processed` datetime DEFAULT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `ux_response_queue_idempotency_key` (`idempotency_key`),
+  KEY `ix_response_queue_processed` (`processed`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
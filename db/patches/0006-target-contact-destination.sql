@@ -0,0 +1,10 @@
+-- Index for looking up the target behind a response's source address when
+-- it isn't in the API's contact cache.
+SET @sql = (SELECT IF(COUNT(*) = 0,
+                      'ALTER TABLE `target_contact` ADD KEY `ix_target_contact_destination` (`destination`, `mode_id`)',
+                      'DO 0')
+            FROM `information_schema`.`statistics`
+            WHERE `table_schema` = DATABASE() AND `table_name` = 'target_contact' AND `index_name` = 'ix_target_contact_destination');
+PREPARE stmt FROM @sql;
+EXECUTE stmt;
+DEALLOCATE PREPARE stmt;
@@ -0,0 +1,10 @@
+-- When a queued response's row was inserted into `response`, so a retry of
+-- the same queued response doesn't record it twice.
+SET @sql = (SELECT IF(COUNT(*) = 0,
+                      'ALTER TABLE `response_queue` ADD COLUMN `responded` datetime DEFAULT NULL AFTER `attempts`',
+                      'DO 0')
+            FROM `information_schema`.`columns`
+            WHERE `table_schema` = DATABASE() AND `table_name` = 'response_queue' AND `column_name` = 'responded');
+PREPARE stmt FROM @sql;
+EXECUTE stmt;
+DEALLOCATE PREPARE stmt;
@@ -38,6 +38,23 @@ CREATE TABLE `application` (
 ) ENGINE=InnoDB DEFAULT CHARSET=latin1;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
+--
+-- Table structure for table `change_log`
+--
+
+DROP TABLE IF EXISTS `change_log`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `change_log` (
+  `id` bigint(20) NOT NULL AUTO_INCREMENT,
+  `type` varchar(32) NOT NULL,
+  `name` varchar(255) NOT NULL,
+  `created` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id`),
+  KEY `ix_change_log_created` (`created`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
 --
 -- Table structure for table `incident`
 --
@@ -58,6 +75,7 @@ CREATE TABLE `incident` (
   PRIMARY KEY (`id`),
   KEY `ix_incident_plan_id` (`plan_id`),
   KEY `ix_incident_updated` (`updated`),
+  KEY `ix_incident_created` (`created`, `id`),
   KEY `ix_incident_owner_id` (`owner_id`),
   KEY `ix_incident_active` (`active`),
   KEY `ix_incident_application_id` (`application_id`),
@@ -89,10 +107,13 @@ CREATE TABLE `message` (
   `body` text,
   `incident_id` bigint(20) DEFAULT NULL,
   `plan_notification_id` bigint(20) DEFAULT NULL,
+  `mode_changed` tinyint(1) NOT NULL DEFAULT '0',
+  `target_changed` tinyint(1) NOT NULL DEFAULT '0',
   `active` tinyint(1) NOT NULL DEFAULT '1',
   `template_id` int(11) DEFAULT NULL,
   PRIMARY KEY (`id`),
   KEY `plan_id` (`plan_id`),
+  KEY `ix_message_created` (`created`, `id`),
   KEY `ix_message_sent` (`sent`),
   KEY `ix_message_incident_id` (`incident_id`),
   KEY `ix_message_plan_notification_id` (`plan_notification_id`),
@@ -259,6 +280,59 @@ CREATE TABLE `response` (
 ) ENGINE=InnoDB DEFAULT CHARSET=latin1;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
+--
+-- Table structure for table `response_queue`
+--
+
+DROP TABLE IF EXISTS `response_queue`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `response_queue` (
+  `id` bigint(20) NOT NULL AUTO_INCREMENT,
+  `idempotency_key` char(40) NOT NULL,
+  `kind` varchar(32) NOT NULL,
+  `body` mediumtext NOT NULL,
+  `created` datetime NOT NULL,
+  `claimed` datetime DEFAULT NULL,
+  `attempts` int(11) NOT NULL DEFAULT '0',
+  `responded` datetime DEFAULT NULL,
+  `processed` datetime DEFAULT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `ux_response_queue_idempotency_key` (`idempotency_key`),
+  KEY `ix_response_queue_processed` (`processed`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Table structure for table `stats_counter`
+--
+
+DROP TABLE IF EXISTS `stats_counter`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `stats_counter` (
+  `name` varchar(64) NOT NULL,
+  `value` bigint(20) NOT NULL DEFAULT '0',
+  `watermark` bigint(20) NOT NULL DEFAULT '0',
+  PRIMARY KEY (`name`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Table structure for table `stats_daily_counter`
+--
+
+DROP TABLE IF EXISTS `stats_daily_counter`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `stats_daily_counter` (
+  `day` date NOT NULL,
+  `name` varchar(64) NOT NULL,
+  `value` bigint(20) NOT NULL DEFAULT '0',
+  PRIMARY KEY (`day`, `name`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
 --
 -- Table structure for table `target`
 --
@@ -315,6 +389,7 @@ CREATE TABLE `target_contact` (
   `destination` varchar(255) NOT NULL,
   PRIMARY KEY (`target_id`,`mode_id`),
   KEY `ix_target_contact_mode_id` (`mode_id`),
+  KEY `ix_target_contact_destination` (`destination`, `mode_id`),
   CONSTRAINT `target_contact_ibfk_1` FOREIGN KEY (`target_id`) REFERENCES `target` (`id`) ON DELETE CASCADE ON UPDATE CASCADE,
   CONSTRAINT `target_contact_ibfk_2` FOREIGN KEY (`mode_id`) REFERENCES `mode` (`id`)
 ) ENGINE=InnoDB DEFAULT CHARSET=latin1;
@@ -55,7 +55,7 @@ def initialize_mysql_schema(config):
 
     load_sqldump(config, os.path.join(dbpath, 'schema_0.sql'))
 
-    for f in glob(os.path.join(dbpath, 'patches', '*.sql')):
+    for f in sorted(glob(os.path.join(dbpath, 'patches', '*.sql'))):
         load_sqldump(config, f)
 
     load_sqldump(config, os.path.join(dbpath, 'dummy_data.sql'))
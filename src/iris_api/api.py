@@ -3,8 +3,10 @@
 
 from __future__ import absolute_import
 
-from gevent import socket
-import msgpack
+from gevent import socket, spawn
+from gevent.pool import Pool
+from collections import OrderedDict
+import functools
 import time
 import hmac
 import hashlib
@@ -16,7 +18,8 @@ import jinja2
 from jinja2.sandbox import SandboxedEnvironment
 from urlparse import parse_qs
 import ujson
-from falcon import HTTP_200, HTTP_201, HTTP_204, HTTPBadRequest, HTTPNotFound, HTTPUnauthorized, HTTPForbidden, API
+from falcon import (HTTP_200, HTTP_201, HTTP_204, HTTP_304, HTTPError, HTTPBadRequest, HTTPNotFound,
+                    HTTPUnauthorized, HTTPForbidden, HTTPServiceUnavailable, API)
 from sqlalchemy.exc import IntegrityError
 from importlib import import_module
 import yaml
@@ -26,7 +29,10 @@ from streql import equals
 from . import db
 from . import utils
 from . import cache
-from iris_api.sender import auditlog
+from . import counters
+from .metrics import stats, init as init_metrics, emit_metrics
+from .change_log import ChangeLog, record_change
+from iris_api.sender.pool import init_sender_pool, default_pool_metrics
 
 
 from .constants import (
@@ -66,8 +72,8 @@ message_columns = {
     'priority': '`priority`.`name` as `priority`',
     'target': '`target`.`name` as `target`',
     'body': '`message`.`body` as `body`',
-    'mode_changed': 'exists(SELECT 1 FROM `message_changelog` WHERE `message_id` = `message`.`id` AND `change_type` = %(mode_change)s) as mode_changed',
-    'target_changed': 'exists(SELECT 1 FROM `message_changelog` WHERE `message_id` = `message`.`id` AND `change_type` = %(target_change)s) as target_changed'
+    'mode_changed': '`message`.`mode_changed` as `mode_changed`',
+    'target_changed': '`message`.`target_changed` as `target_changed`',
 }
 
 message_filters = {
@@ -185,8 +191,8 @@ single_incident_query_steps = '''SELECT `message`.`id` as `id`,
     UNIX_TIMESTAMP(`message`.`created`) as `created`,
     UNIX_TIMESTAMP(`message`.`sent`) as `sent`,
     `plan_notification`.`step` as `step`,
-    exists(SELECT 1 FROM `message_changelog` WHERE `message_id` = `message`.`id` AND `change_type` = %s) as mode_changed,
-    exists(SELECT 1 FROM `message_changelog` WHERE `message_id` = `message`.`id` AND `change_type` = %s) as target_changed
+    `message`.`mode_changed` as `mode_changed`,
+    `message`.`target_changed` as `target_changed`
 FROM `message`
 JOIN `priority` ON `message`.`priority_id` = `priority`.`id`
 JOIN `mode` ON `message`.`mode_id` = `mode`.`id`
@@ -425,6 +431,9 @@ get_applications_query = '''SELECT
 FROM `application`
 WHERE `auth_only` is False'''
 
+application_fields = ('name', 'context_template', 'sample_context', 'summary_template',
+                      'variables', 'required_variables')
+
 get_vars_query = 'SELECT `name`, `required` FROM `template_variable` WHERE `application_id` = %s ORDER BY `required` DESC, `name` ASC'
 
 get_allowed_roles_query = '''SELECT `target_role`.`id`
@@ -435,6 +444,17 @@ get_allowed_roles_query = '''SELECT `target_role`.`id`
 
 uuid4hex = re.compile('[0-9a-f]{32}\Z', re.I)
 
+default_api_metrics = {
+    'response_cache_hit_cnt': 0, 'response_cache_miss_cnt': 0, 'response_cache_not_modified_cnt': 0,
+    'response_cache_eviction_cnt': 0, 'response_cache_size': 0, 'query_cache_hit_cnt': 0, 'query_cache_miss_cnt': 0,
+    'response_batch_insert_cnt': 0, 'response_batch_insert_time': 0, 'batch_claim_incidents': 0,
+    'batch_claim_time': 0, 'response_queue_enqueue_cnt': 0, 'response_queue_duplicate_cnt': 0,
+    'response_queue_process_cnt': 0, 'response_queue_invalid_cnt': 0, 'response_queue_fail_cnt': 0,
+    'response_queue_sweep_cnt': 0, 'response_queue_process_time': 0, 'response_queue_dead_cnt': 0,
+    'contact_cache_hit_cnt': 0, 'contact_cache_miss_cnt': 0,
+}
+default_api_metrics.update(default_pool_metrics)
+
 
 def load_config_file(config_path):
     with open(config_path) as h:
@@ -457,6 +477,139 @@ def stream_incidents_with_context(cursor):
         yield row
 
 
+stream_chunk_size = 500
+
+
+class RowStream(object):
+    '''
+    JSON list of the rows of an executed unbuffered cursor, serialized
+    `stream_chunk_size` rows at a time. The first chunk is read up front so a
+    failing query still fails the request before a 200 is committed. The
+    connection is closed once the rows are consumed, when the WSGI server
+    closes the response, or when the stream is dropped without being read.
+    '''
+    def __init__(self, connection, cursor, row_filter=None):
+        self.connection = connection
+        self.cursor = cursor
+        self.row_filter = row_filter
+        try:
+            self.first_rows = cursor.fetchmany(stream_chunk_size)
+        except Exception:
+            self.close()
+            raise
+
+    def __iter__(self):
+        try:
+            yield '['
+            separator = ''
+            rows = self.first_rows
+            while rows:
+                if self.row_filter:
+                    rows = list(self.row_filter(rows))
+                yield separator + ujson.dumps(rows)[1:-1]
+                separator = ','
+                rows = self.cursor.fetchmany(stream_chunk_size)
+            yield ']'
+        except Exception:
+            # The 200 is already sent; raising aborts the response instead of
+            # ending it as if the truncated list were complete
+            logger.exception('Failed streaming rows')
+            raise
+        finally:
+            self.close()
+
+    def close(self):
+        if self.connection is None:
+            return
+        connection, self.connection = self.connection, None
+        try:
+            self.cursor.close()
+        finally:
+            connection.close()
+
+    __del__ = close
+
+
+def without_fields(rows, fields):
+    for row in rows:
+        for field in fields:
+            del row[field]
+        yield row
+
+
+def page_after(table):
+    '''
+    Filter for the rows of `table` following a page cursor in descending
+    (created, id) order, which the (created, id) index serves as a range scan
+    however deep the page is. Bind it to the values from parse_page_cursor.
+    '''
+    return ('(`{0}`.`created` < FROM_UNIXTIME(%s) OR '
+            '(`{0}`.`created` = FROM_UNIXTIME(%s) AND `{0}`.`id` < %s))').format(table)
+
+
+def parse_page_cursor(page_cursor):
+    try:
+        created, row_id = (int(value) for value in ujson.loads(base64.urlsafe_b64decode(str(page_cursor))))
+    except (TypeError, ValueError):
+        raise HTTPBadRequest('Invalid cursor', 'cursor must be a value from a previous X-Next-Cursor header')
+    return [created, created, row_id]
+
+
+def page_limit(limit):
+    '''
+    Row limit for a page of a cursor paginated listing. Pages can't be larger
+    than `stream_chunk_size` rows, so they are buffered and can carry an
+    X-Next-Cursor header, which a streamed response would already have sent
+    before its last row is known. Larger limits are rejected rather than
+    silently cut short; leave out the limit to stream every row.
+    '''
+    if limit is not None and limit > stream_chunk_size:
+        raise HTTPBadRequest('Invalid limit', 'limit must be at most %d, page with X-Next-Cursor for more rows'
+                             % stream_chunk_size)
+    return limit
+
+
+def next_page_cursor(row):
+    return base64.urlsafe_b64encode(ujson.dumps([row['created'], row['id']]))
+
+
+def respond_with_rows(resp, connection, query, args=None, limit=None, row_filter=None, page_fields=None):
+    '''
+    Respond with the rows of `query` as a JSON list. Unless the limit fits in
+    one chunk, rows are read through an unbuffered cursor and serialized
+    `stream_chunk_size` at a time into resp.stream, so worker memory doesn't
+    grow with the size of the result.
+
+    When `page_fields` is given, buffered pages that hit the limit get an
+    X-Next-Cursor header (see page_limit) to continue from, and the listed fields, which were
+    only selected to build it, are dropped from the rows.
+    '''
+    if page_fields:
+        row_filter = (lambda rows, row_filter=row_filter: without_fields(
+            row_filter(rows) if row_filter else rows, page_fields))
+    if limit is not None and limit <= stream_chunk_size:
+        cursor = connection.cursor(db.dict_cursor)
+        try:
+            cursor.execute(query, args)
+            rows = cursor.fetchall()
+        finally:
+            cursor.close()
+            connection.close()
+        resp.status = HTTP_200
+        if page_fields is not None and limit and len(rows) == limit:
+            resp.set_header('X-Next-Cursor', next_page_cursor(rows[-1]))
+        resp.body = ujson.dumps(list(row_filter(rows)) if row_filter else rows)
+    else:
+        try:
+            cursor = connection.cursor(db.ss_dict_cursor)
+            cursor.execute(query, args)
+        except Exception:
+            connection.close()
+            raise
+        resp.stream = RowStream(connection, cursor, row_filter)
+        resp.status = HTTP_200
+
+
 def get_app_from_msg_id(session, msg_id):
     sql = '''SELECT `application`.`name` FROM `message`
              JOIN `application` on `application`.`id` = `message`.`application_id`
@@ -494,26 +647,214 @@ def is_valid_tracking_settings(t, k, tpl):
     return True, None
 
 
-def gen_where_filter_clause(connection, filters, filter_types, kwargs):
-    where = []
-    for key, values in kwargs.iteritems():
+def parse_filters(filter_types, kwargs):
+    '''
+    Split query string filters into the shape of their WHERE clause, a tuple
+    of (column, operator) pairs, and the list of values to bind to it.
+    '''
+    shape = []
+    values = []
+    for key, vals in sorted(kwargs.iteritems()):
         col, _, op = key.partition('__')
         col_type = filter_types.get(col, str)
         # Format strings because Falcon splits on ',' but not on '%2C'
         # TODO: Get rid of this by setting request options on Falcon 1.1
-        if isinstance(values, basestring):
-            values = values.split(',')
-        for val in values:
-            if op == 'in':
-                if len(values) == 1:
-                    op = 'eq'
-                    val = col_type(values[0])
-                else:
-                    val = tuple([col_type(v) for v in values])
+        if isinstance(vals, basestring):
+            vals = vals.split(',')
+        if op == 'in':
+            if len(vals) == 1:
+                shape.append((col, 'eq'))
+                values.append(col_type(vals[0]))
             else:
-                val = col_type(val)
-            where.append(operators[op] % (filters[col], connection.escape(val)))
-    return where
+                # a tuple is bound as a parenthesized list, so any number of
+                # values shares one placeholder
+                shape.append((col, 'in'))
+                values.append(tuple(col_type(v) for v in vals))
+        else:
+            for val in vals:
+                shape.append((col, op))
+                values.append(col_type(val))
+    return tuple(shape), values
+
+
+def gen_where_filter_clause(filters, shape):
+    return [operators[op] % (filters[col], '%s') for col, op in shape]
+
+
+query_cache = {}
+query_cache_max_size = 1000
+
+
+def cached_query(key, build_query):
+    '''
+    Memoize the SQL built by `build_query` under `key`, which has to cover
+    everything the SQL text depends on. Filter values are always bound as
+    parameters, so requests of the same shape share one SQL string.
+    '''
+    query = query_cache.get(key)
+    if query is None:
+        stats['query_cache_miss_cnt'] += 1
+        if len(query_cache) >= query_cache_max_size:
+            query_cache.clear()
+        query = query_cache[key] = build_query()
+    else:
+        stats['query_cache_hit_cnt'] += 1
+    return query
+
+
+class MetricsMiddleware(object):
+    '''
+    API workers don't run a background loop, so the request path starts a
+    flush once every `interval` seconds. It runs in its own greenlet, so the
+    request doesn't wait on the metrics backend.
+    '''
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.last_emit = time.time()
+
+    def process_response(self, req, resp, resource):
+        now = time.time()
+        if now - self.last_emit >= self.interval:
+            self.last_emit = now
+            spawn(emit_metrics)
+
+
+class ChangeLogMiddleware(object):
+    '''
+    Applies changes published to the change log by other processes, polling
+    from the request path at most once every `interval` seconds.
+    '''
+
+    def __init__(self, change_log, interval):
+        self.change_log = change_log
+        self.interval = interval
+        self.last_poll = time.time()
+
+    def process_request(self, req, resp):
+        now = time.time()
+        if now - self.last_poll >= self.interval:
+            self.last_poll = now
+            self.change_log.dispatch()
+
+
+class ResponseCache(object):
+    '''
+    Bounded LRU of serialized GET responses keyed by URI.
+
+    Each entry depends on a set of change log types and is dropped when any of
+    them changes, either locally through invalidate() or from other workers
+    through the change log. Entries also expire after `ttl` seconds, for
+    writes that don't go through the change log. Cached responses carry a
+    strong ETag of their body, so clients revalidating with If-None-Match get
+    a 304.
+    '''
+
+    def __init__(self, max_size=1000, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.keys_by_type = {}
+        # bumped on every invalidation, so a response rendered while its data
+        # changed underneath it is not cached
+        self.generations = {}
+
+    def subscribe(self, change_log, change_types):
+        for change_type in change_types:
+            invalidate = functools.partial(self.invalidate, change_type)
+            change_log.subscribe(change_type, lambda names, invalidate=invalidate: invalidate(), invalidate)
+
+    def invalidate(self, change_type):
+        self.generations[change_type] = self.generations.get(change_type, 0) + 1
+        for key in self.keys_by_type.pop(change_type, ()):
+            self.data.pop(key, None)
+        stats['response_cache_size'] = len(self.data)
+
+    def get(self, key):
+        entry = self.data.pop(key, None)
+        if entry is None:
+            return None
+        if entry[2] < time.time():
+            stats['response_cache_size'] = len(self.data)
+            return None
+        self.data[key] = entry
+        return entry
+
+    def set(self, key, change_types, etag, body):
+        self.data.pop(key, None)
+        self.data[key] = (etag, body, time.time() + self.ttl)
+        for change_type in change_types:
+            self.keys_by_type.setdefault(change_type, set()).add(key)
+        while len(self.data) > self.max_size:
+            self.data.popitem(last=False)
+            stats['response_cache_eviction_cnt'] += 1
+        stats['response_cache_size'] = len(self.data)
+
+    def respond(self, change_types, req, resp, responder):
+        key = req.relative_uri
+        entry = self.get(key)
+        if entry is None:
+            stats['response_cache_miss_cnt'] += 1
+            generations = [self.generations.get(change_type, 0) for change_type in change_types]
+            responder()
+            if resp.status != HTTP_200 or resp.body is None:
+                return
+            etag = '"%s"' % hashlib.sha1(resp.body).hexdigest()
+            if generations == [self.generations.get(change_type, 0) for change_type in change_types]:
+                self.set(key, change_types, etag, resp.body)
+        else:
+            stats['response_cache_hit_cnt'] += 1
+            etag, resp.body, _ = entry
+            resp.status = HTTP_200
+        resp.etag = etag
+        if etag_matches(req.get_header('If-None-Match'), etag):
+            stats['response_cache_not_modified_cnt'] += 1
+            resp.status = HTTP_304
+            resp.body = None
+
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    # If-None-Match uses weak comparison, so W/ prefixes are ignored
+    candidates = (tag.strip() for tag in if_none_match.split(','))
+    return etag in (tag[2:] if tag.startswith('W/') else tag for tag in candidates)
+
+
+response_cache = ResponseCache()
+cached_change_types = set()
+
+
+def refresh_plan_coverage(**kwargs):
+    '''
+    Refresh this worker's plan coverage index after a committed plan or
+    template write. Failures are only logged, so a write that succeeded isn't
+    answered with a 500; the change log poll refreshes the index again.
+    '''
+    try:
+        cache.cache_plan_coverage(**kwargs)
+    except Exception:
+        logger.exception('Failed refreshing plan coverage for %s', kwargs)
+
+
+def cached_response(*change_types):
+    '''
+    Serve a GET responder from response_cache, dropping the cached response
+    whenever one of `change_types` changes. These responders read from the
+    primary, since they are rerun right after the change that invalidated
+    them.
+    '''
+    cached_change_types.update(change_types)
+
+    def decorator(responder):
+        @functools.wraps(responder)
+        def wrapper(self, req, resp, *args, **kwargs):
+            response_cache.respond(change_types, req, resp,
+                                   lambda: responder(self, req, resp, *args, **kwargs))
+        return wrapper
+    return decorator
 
 
 class HeaderMiddleware(object):
@@ -593,6 +934,7 @@ class AuthMiddleware(object):
 class Plan(object):
     allow_read_only = True
 
+    @cached_response('plan')
     def on_get(self, req, resp, plan_id):
         if plan_id.isdigit():
             where = 'WHERE `plan`.`id` = %s'
@@ -647,8 +989,13 @@ class Plan(object):
                                 {'plan_id': plan_id})
             else:
                 session.execute('DELETE FROM `plan_active` WHERE `plan_id`=:plan_id', {'plan_id': plan_id})
+            plan_name = session.execute('SELECT `name` FROM `plan` WHERE `id` = :plan_id',
+                                        {'plan_id': plan_id}).scalar()
+            if plan_name:
+                record_change(session, 'plan', plan_name)
             session.commit()
             session.close()
+            response_cache.invalidate('plan')
             resp.status = HTTP_200
             resp.body = ujson.dumps(active)
         except HTTPBadRequest:
@@ -657,6 +1004,8 @@ class Plan(object):
             session.close()
             logger.exception('ERROR')
             raise
+        if plan_name:
+            refresh_plan_coverage(plan_names=[plan_name])
 
 
 class Plans(object):
@@ -704,34 +1053,30 @@ class Plans(object):
         if fields is None:
             fields = plan_columns
 
-        query = plan_query % ', '.join(plan_columns[f] for f in fields)
-
-        where = []
         active = req.get_param_as_bool('active')
         req.params.pop('active', None)
-        if active is not None:
-            if active:
-                where.append('`plan_active`.`plan_id` IS NOT NULL')
-            else:
-                where.append('`plan_active`.`plan_id` IS NULL')
-
-        connection = db.engine.raw_connection()
-        where += gen_where_filter_clause(
-            connection, plan_filters, plan_filter_types, req.params)
-
-        if where:
-            query = query + ' WHERE ' + ' AND '.join(where)
-
+        shape, values = parse_filters(plan_filter_types, req.params)
+
+        def build_query():
+            query = plan_query % ', '.join(plan_columns[f] for f in fields)
+            where = []
+            if active is not None:
+                if active:
+                    where.append('`plan_active`.`plan_id` IS NOT NULL')
+                else:
+                    where.append('`plan_active`.`plan_id` IS NULL')
+            where += gen_where_filter_clause(plan_filters, shape)
+            if where:
+                query = query + ' WHERE ' + ' AND '.join(where)
+            if query_limit is not None:
+                query += ' ORDER BY `plan`.`created` DESC LIMIT %s'
+            return query
+
+        query = cached_query(('plans', tuple(fields), active, shape, query_limit is not None), build_query)
         if query_limit is not None:
-            query += ' ORDER BY `plan`.`created` DESC LIMIT %s' % query_limit
-
-        cursor = connection.cursor(db.dict_cursor)
-        cursor.execute(query)
-
-        payload = ujson.dumps(cursor)
-        connection.close()
-        resp.status = HTTP_200
-        resp.body = payload
+            values.append(query_limit)
+        connection = db.read_engine().raw_connection()
+        respond_with_rows(resp, connection, query, values, query_limit)
 
     def on_post(self, req, resp):
         plan_params = ujson.loads(req.context['body'])
@@ -803,9 +1148,11 @@ class Plans(object):
             session.execute('INSERT INTO `plan_active` (`name`, `plan_id`) '
                             'VALUES (:name, :plan_id) ON DUPLICATE KEY UPDATE `plan_id`=:plan_id',
                             {'name': plan_name, 'plan_id': plan_id})
+            record_change(session, 'plan', plan_name)
 
             session.commit()
             session.close()
+            response_cache.invalidate('plan')
             resp.status = HTTP_201
             resp.body = ujson.dumps(plan_id)
             resp.set_header('Location', '/plans/%s' % plan_id)
@@ -818,9 +1165,62 @@ class Plans(object):
             session.close()
             logger.exception('ERROR')
             raise
+        refresh_plan_coverage(plan_names=[plan_name])
 
 
-class Incidents(object):
+class IncidentCreateMixin(object):
+    def validate_incident(self, incident_params, app, reloaded_plans):
+        '''
+        Check an incident against its plan and application, returning the row
+        to insert. Plans are checked against cache.plan_coverage. Plans
+        missing from it, or lacking templates for the application, are read
+        from the database once per request, since another worker may have
+        just created them. `reloaded_plans` tracks those plans.
+        '''
+        if not isinstance(incident_params, dict) or 'plan' not in incident_params:
+            raise HTTPBadRequest('missing plan name attribute', '')
+
+        if 'application' in incident_params:
+            if not app['allow_other_app_incidents']:
+                raise HTTPForbidden('This application does not allow creating incidents as other applications', '')
+
+            app = cache.applications.get(incident_params['application'])
+
+            if not app:
+                raise HTTPBadRequest('Invalid application', '')
+
+        context = incident_params.get('context')
+        if not isinstance(context, dict):
+            raise HTTPBadRequest('missing context attribute', '')
+        context_json_str = ujson.dumps({variable: context.get(variable)
+                                       for variable in app['variables']})
+        if len(context_json_str) > 65535:
+            raise HTTPBadRequest('Context too long', '')
+
+        plan = incident_params['plan']
+        coverage = cache.plan_coverage.get(plan)
+        if (coverage is None or app['id'] not in coverage[1]) and plan not in reloaded_plans:
+            reloaded_plans.add(plan)
+            coverage = cache.cache_plan_coverage(plan_names=[plan]).get(plan)
+        if coverage is None:
+            logger.warn('Plan "%s" not found.', plan)
+            raise HTTPNotFound(title='Plan not found', description=plan)
+
+        plan_id, app_ids = coverage
+        if app['id'] not in app_ids:
+            raise HTTPBadRequest('No plan template actions exist for this app', '')
+
+        return {
+            'plan_id': plan_id,
+            'created': datetime.datetime.utcnow(),
+            'application_id': app['id'],
+            'context': context_json_str,
+            'current_step': 0,
+            'active': True,
+        }
+
+
+class Incidents(IncidentCreateMixin):
     allow_read_only = True
 
     def on_get(self, req, resp):
@@ -828,95 +1228,54 @@ class Incidents(object):
         if fields is None:
             fields = incident_columns
         req.params.pop('fields', None)
-        query_limit = req.get_param_as_int('limit')
+        query_limit = page_limit(req.get_param_as_int('limit'))
         req.params.pop('limit', None)
         target = req.get_param_as_list('target')
         req.params.pop('target', None)
-
-        query = incident_query % ', '.join(incident_columns[f] for f in fields)
-
-        connection = db.engine.raw_connection()
-        where = gen_where_filter_clause(connection, incident_filters, incident_filter_types, req.params)
-        sql_values = []
+        page_cursor = req.params.pop('cursor', None)
+        # the next page cursor needs created and id, even when not requested
+        page_fields = [f for f in ('created', 'id') if f not in fields]
+        shape, values = parse_filters(incident_filter_types, req.params)
+
+        def build_query():
+            query = incident_query % ', '.join(incident_columns[f] for f in list(fields) + page_fields)
+            where = gen_where_filter_clause(incident_filters, shape)
+            if target:
+                where.append('''`incident`.`id` IN (
+                    SELECT `incident_id`
+                    FROM `message`
+                    JOIN `target` ON `message`.`target_id`=`target`.`id`
+                    WHERE `target`.`name` IN %s
+                )''')
+            if page_cursor:
+                where.append(page_after('incident'))
+            if where:
+                query = query + ' WHERE ' + ' AND '.join(where)
+            if page_cursor or query_limit is not None:
+                query += ' ORDER BY `incident`.`created` DESC, `incident`.`id` DESC'
+            if query_limit is not None:
+                query += ' LIMIT %s'
+            return query
+
+        query = cached_query(('incidents', tuple(fields), shape, bool(target), bool(page_cursor),
+                              query_limit is not None), build_query)
         if target:
-            where.append('''`incident`.`id` IN (
-                SELECT `incident_id`
-                FROM `message`
-                JOIN `target` ON `message`.`target_id`=`target`.`id`
-                WHERE `target`.`name` IN %s
-            )''')
-            sql_values.append(tuple(target))
-        if where:
-            query = query + ' WHERE ' + ' AND '.join(where)
+            values.append(tuple(target))
+        if page_cursor:
+            values += parse_page_cursor(page_cursor)
         if query_limit is not None:
-            query += ' ORDER BY `incident`.`created` DESC LIMIT %s' % query_limit
-
-        cursor = connection.cursor(db.dict_cursor)
-        cursor.execute(query, sql_values)
+            values.append(query_limit)
 
-        if 'context' in fields:
-            payload = ujson.dumps(stream_incidents_with_context(cursor))
-        else:
-            payload = ujson.dumps(cursor)
-        connection.close()
-        resp.status = HTTP_200
-        resp.body = payload
+        connection = db.read_engine().raw_connection()
+        row_filter = stream_incidents_with_context if 'context' in fields else None
+        respond_with_rows(resp, connection, query, values, query_limit, row_filter, page_fields)
 
     def on_post(self, req, resp):
-        session = db.Session()
         incident_params = ujson.loads(req.context['body'])
-        if 'plan' not in incident_params:
-            session.close()
-            raise HTTPBadRequest('missing plan name attribute', '')
-
-        plan_id = session.execute('SELECT `plan_id` FROM `plan_active` WHERE `name` = :plan',
-                                  {'plan': incident_params['plan']}).scalar()
-        if not plan_id:
-            logger.warn('Plan "%s" not found.', incident_params['plan'])
-            session.close()
-            raise HTTPNotFound()
-
-        app = req.context['app']
-
-        if 'application' in incident_params:
-            if not req.context['app']['allow_other_app_incidents']:
-                raise HTTPForbidden('This application does not allow creating incidents as other applications', '')
-
-            app = cache.applications.get(incident_params['application'])
-
-            if not app:
-                raise HTTPBadRequest('Invalid application', '')
+        data = self.validate_incident(incident_params, req.context['app'], set())
 
+        session = db.Session()
         try:
-            context = incident_params['context']
-            context_json_str = ujson.dumps({variable: context.get(variable)
-                                           for variable in app['variables']})
-            if len(context_json_str) > 65535:
-                raise HTTPBadRequest('Context too long', '')
-
-            app_template_count = session.execute('''
-                SELECT EXISTS (
-                  SELECT 1 FROM
-                  `plan_notification`
-                  JOIN `template` ON `template`.`name` = `plan_notification`.`template`
-                  JOIN `template_content` ON `template_content`.`template_id` = `template`.`id`
-                  WHERE `plan_notification`.`plan_id` = :plan_id
-                  AND `template_content`.`application_id` = :app_id
-                )
-            ''', {'app_id': app['id'], 'plan_id': plan_id}).scalar()
-
-            if not app_template_count:
-                raise HTTPBadRequest('No plan template actions exist for this app', '')
-
-            data = {
-                'plan_id': plan_id,
-                'created': datetime.datetime.utcnow(),
-                'application_id': app['id'],
-                'context': context_json_str,
-                'current_step': 0,
-                'active': True,
-            }
-
             incident_id = session.execute(
                 '''INSERT INTO `incident` (`plan_id`, `created`, `context`, `current_step`, `active`, `application_id`)
                    VALUES (:plan_id, :created, :context, 0, :active, :application_id)''',
@@ -927,29 +1286,98 @@ class Incidents(object):
             resp.status = HTTP_201
             resp.set_header('Location', '/incidents/%s' % incident_id)
             resp.body = ujson.dumps(incident_id)
-        except HTTPBadRequest:
+        except Exception:
+            session.close()
+            logger.exception('ERROR')
             raise
+
+
+class IncidentsBatch(IncidentCreateMixin):
+    '''
+    Takes a list of up to max_batch_size incidents, validates each distinct
+    plan once and inserts the valid incidents in one transaction. Responds
+    with a result per incident, in order: the new incident id or the reason
+    it was rejected.
+    '''
+    allow_read_only = False
+
+    def __init__(self, max_batch_size=100):
+        self.max_batch_size = max_batch_size
+
+    def on_post(self, req, resp):
+        incidents = ujson.loads(req.context['body'])
+        if not isinstance(incidents, list):
+            raise HTTPBadRequest('Invalid batch', 'Expected a list of incidents')
+        if len(incidents) > self.max_batch_size:
+            raise HTTPBadRequest('Batch too large', 'At most %d incidents per batch' % self.max_batch_size)
+
+        results = [None] * len(incidents)
+        rows = []
+        valid = []
+        reloaded_plans = set()
+        for idx, incident_params in enumerate(incidents):
+            try:
+                rows.append(self.validate_incident(incident_params, req.context['app'], reloaded_plans))
+            except HTTPError as e:
+                results[idx] = '%s: %s' % (e.title, e.description) if e.description else e.title
+                continue
+            valid.append(idx)
+
+        session = db.Session()
+        try:
+            if rows:
+                insert_query = '''INSERT INTO `incident` (`plan_id`, `created`, `context`, `current_step`, `active`,
+                                                         `application_id`)
+                                  VALUES '''
+                values = []
+                params = {}
+                for i, row in enumerate(rows):
+                    values.append('(:plan_id_{0}, :created_{0}, :context_{0}, 0, :active_{0}, :application_id_{0})'
+                                  .format(i))
+                    params.update(('%s_%d' % (key, i), value) for key, value in row.iteritems())
+                increment, lock_mode = session.execute(
+                    'SELECT @@auto_increment_increment, @@innodb_autoinc_lock_mode').fetchone()
+                if lock_mode < 2:
+                    # Outside interleaved lock mode, InnoDB gives the rows of a
+                    # multi-row INSERT one block of ids starting at lastrowid,
+                    # auto_increment_increment apart
+                    first_id = session.execute(insert_query + ', '.join(values), params).lastrowid
+                    ids = [first_id + i * increment for i in xrange(len(rows))]
+                else:
+                    # interleaved inserts can take ids from within the block,
+                    # so each row's id has to come from its own INSERT
+                    ids = [session.execute(insert_query + value, params).lastrowid for value in values]
+                session.commit()
+                for idx, incident_id in zip(valid, ids):
+                    results[idx] = incident_id
+            session.close()
         except Exception:
             session.close()
             logger.exception('ERROR')
             raise
 
+        resp.status = HTTP_200
+        resp.body = ujson.dumps(results)
+
 
 class Incident(object):
     allow_read_only = True
 
     def on_get(self, req, resp, incident_id):
-        connection = db.engine.raw_connection()
-        cursor = connection.cursor(db.dict_cursor)
         try:
-            cursor.execute(single_incident_query, int(incident_id))
+            incident_id = int(incident_id)
         except ValueError:
             raise HTTPBadRequest('Invalid incident id', '')
+        # clients often read an incident right after creating it, so single
+        # rows are read from the primary rather than a lagging replica
+        connection = db.engine.raw_connection()
+        cursor = connection.cursor(db.dict_cursor)
+        cursor.execute(single_incident_query, incident_id)
         results = cursor.fetchall()
 
         if results:
             incident = results[0]
-            cursor.execute(single_incident_query_steps, (auditlog.MODE_CHANGE, auditlog.TARGET_CHANGE, incident['id']))
+            cursor.execute(single_incident_query_steps, incident['id'])
             incident['steps'] = cursor.fetchall()
             connection.close()
 
@@ -1019,40 +1447,47 @@ class Messages(object):
         if fields is None:
             fields = message_columns
         req.params.pop('fields', None)
-        query_limit = req.get_param_as_int('limit')
+        query_limit = page_limit(req.get_param_as_int('limit'))
         req.params.pop('limit', None)
 
-        connection = db.engine.raw_connection()
-        escaped_params = {
-          'mode_change': connection.escape(auditlog.MODE_CHANGE),
-          'target_change': connection.escape(auditlog.TARGET_CHANGE)
-        }
-
-        query = message_query % ', '.join(message_columns[f] % escaped_params for f in fields)
-
-        where = gen_where_filter_clause(connection, message_filters, message_filter_types, req.params)
-        if where:
-            query = query + ' WHERE ' + ' AND '.join(where)
-
+        page_cursor = req.params.pop('cursor', None)
+        # the next page cursor needs created and id, even when not requested
+        page_fields = [f for f in ('created', 'id') if f not in fields]
+        shape, values = parse_filters(message_filter_types, req.params)
+
+        def build_query():
+            query = message_query % ', '.join(message_columns[f] for f in list(fields) + page_fields)
+            where = gen_where_filter_clause(message_filters, shape)
+            if page_cursor:
+                where.append(page_after('message'))
+            if where:
+                query = query + ' WHERE ' + ' AND '.join(where)
+            if page_cursor or query_limit is not None:
+                query += ' ORDER BY `message`.`created` DESC, `message`.`id` DESC'
+            if query_limit is not None:
+                query += ' LIMIT %s'
+            return query
+
+        query = cached_query(('messages', tuple(fields), shape, bool(page_cursor), query_limit is not None),
+                             build_query)
+        if page_cursor:
+            values += parse_page_cursor(page_cursor)
         if query_limit is not None:
-            query += ' ORDER BY `message`.`created` DESC LIMIT %s' % query_limit
-        cursor = connection.cursor(db.dict_cursor)
-        cursor.execute(query)
-        payload = ujson.dumps(cursor)
-        connection.close()
-        resp.status = HTTP_200
-        resp.body = payload
+            values.append(query_limit)
+        connection = db.read_engine().raw_connection()
+        respond_with_rows(resp, connection, query, values, query_limit, page_fields=page_fields)
 
 
 class Notifications(object):
     allow_read_only = False
     required_attrs = frozenset(['target', 'role', 'subject'])
 
-    def __init__(self, config):
-        self.sender_addr = (config['sender']['host'], config['sender']['port'])
+    def __init__(self, sender_pool):
+        self.sender_pool = sender_pool
 
-    def on_post(self, req, resp):
-        message = ujson.loads(req.context['body'])
+    def validate_notification(self, message, app):
+        if not isinstance(message, dict):
+            raise HTTPBadRequest('Invalid notification', 'Notification must be an object')
         msg_attrs = set(message)
         if not msg_attrs >= self.required_attrs:
             raise HTTPBadRequest('Missing required atrributes',
@@ -1073,11 +1508,21 @@ class Notifications(object):
             raise HTTPBadRequest(
                 'Both priority and mode are missing, at least one of it is required', '')
 
-        message['application'] = req.context['app']['name']
-        s = socket.create_connection(self.sender_addr)
-        s.send(msgpack.packb({'endpoint': 'v0/send', 'data': message}))
-        sender_resp = utils.msgpack_unpack_msg_from_socket(s)
-        s.close()
+        message['application'] = app['name']
+
+    def send(self, endpoint, data):
+        try:
+            return self.sender_pool.request({'endpoint': endpoint, 'data': data})
+        except utils.MsgpackFrameError as e:
+            raise HTTPBadRequest('Notification too large', str(e))
+        except socket.error:
+            logger.exception('Failed passing notification to sender')
+            raise HTTPServiceUnavailable('Sender unavailable', 'Failed passing notification to sender')
+
+    def on_post(self, req, resp):
+        message = ujson.loads(req.context['body'])
+        self.validate_notification(message, req.context['app'])
+        sender_resp = self.send('v0/send', message)
         if sender_resp == 'OK':
             resp.status = HTTP_200
             resp.body = '[]'
@@ -1085,9 +1530,49 @@ class Notifications(object):
             raise HTTPBadRequest('Request rejected by sender', sender_resp)
 
 
+class NotificationsBatch(Notifications):
+    '''
+    Takes a list of up to max_batch_size notifications and passes the valid
+    ones to the sender in a single request. Responds with a result per
+    notification, in order: "OK" or the reason it was rejected.
+    '''
+
+    def __init__(self, sender_pool, max_batch_size=100):
+        super(NotificationsBatch, self).__init__(sender_pool)
+        self.max_batch_size = max_batch_size
+
+    def on_post(self, req, resp):
+        messages = ujson.loads(req.context['body'])
+        if not isinstance(messages, list):
+            raise HTTPBadRequest('Invalid batch', 'Expected a list of notifications')
+        if len(messages) > self.max_batch_size:
+            raise HTTPBadRequest('Batch too large', 'At most %d notifications per batch' % self.max_batch_size)
+
+        results = [None] * len(messages)
+        valid = []
+        for idx, message in enumerate(messages):
+            try:
+                self.validate_notification(message, req.context['app'])
+            except HTTPBadRequest as e:
+                results[idx] = '%s: %s' % (e.title, e.description) if e.description else e.title
+                continue
+            valid.append(idx)
+
+        if valid:
+            sender_resp = self.send('v0/send_batch', [messages[idx] for idx in valid])
+            if not isinstance(sender_resp, list) or len(sender_resp) != len(valid):
+                raise HTTPBadRequest('Request rejected by sender', sender_resp)
+            for idx, result in zip(valid, sender_resp):
+                results[idx] = result
+
+        resp.status = HTTP_200
+        resp.body = ujson.dumps(results)
+
+
 class Template(object):
     allow_read_only = True
 
+    @cached_response('template', 'plan')
     def on_get(self, req, resp, template_id):
             if template_id.isdigit():
                 where = 'WHERE `template`.`id` = %s'
@@ -1141,8 +1626,13 @@ class Template(object):
             else:
                 session.execute('DELETE FROM `template_active` WHERE `template_id`=:template_id',
                                 {'template_id': template_id})
+            template_name = session.execute('SELECT `name` FROM `template` WHERE `id` = :template_id',
+                                            {'template_id': template_id}).scalar()
+            if template_name:
+                record_change(session, 'template', template_name)
             session.commit()
             session.close()
+            response_cache.invalidate('template')
             resp.status = HTTP_200
             resp.body = ujson.dumps(active)
         except HTTPBadRequest:
@@ -1151,6 +1641,8 @@ class Template(object):
             session.close()
             logger.exception('ERROR')
             raise
+        if template_name:
+            refresh_plan_coverage(template_names=[template_name])
 
 
 class Templates(object):
@@ -1164,33 +1656,30 @@ class Templates(object):
             fields = template_columns
         req.params.pop('fields', None)
 
-        query = template_query % ', '.join(template_columns[f] for f in fields)
-
-        where = []
         active = req.get_param_as_bool('active')
         req.params.pop('active', None)
-        if active is not None:
-            if active:
-                where.append('`template_active`.`template_id` IS NOT NULL')
-            else:
-                where.append('`template_active`.`template_id` IS NULL')
-
-        connection = db.engine.raw_connection()
-        where += gen_where_filter_clause(connection, template_filters, template_filter_types, req.params)
-
-        if where:
-            query = query + ' WHERE ' + ' AND '.join(where)
-
+        shape, values = parse_filters(template_filter_types, req.params)
+
+        def build_query():
+            query = template_query % ', '.join(template_columns[f] for f in fields)
+            where = []
+            if active is not None:
+                if active:
+                    where.append('`template_active`.`template_id` IS NOT NULL')
+                else:
+                    where.append('`template_active`.`template_id` IS NULL')
+            where += gen_where_filter_clause(template_filters, shape)
+            if where:
+                query = query + ' WHERE ' + ' AND '.join(where)
+            if query_limit is not None:
+                query += ' ORDER BY `template`.`created` DESC LIMIT %s'
+            return query
+
+        query = cached_query(('templates', tuple(fields), active, shape, query_limit is not None), build_query)
         if query_limit is not None:
-            query += ' ORDER BY `template`.`created` DESC LIMIT %s' % query_limit
-
-        cursor = connection.cursor(db.dict_cursor)
-        cursor.execute(query)
-
-        payload = ujson.dumps(cursor)
-        connection.close()
-        resp.status = HTTP_200
-        resp.body = payload
+            values.append(query_limit)
+        connection = db.read_engine().raw_connection()
+        respond_with_rows(resp, connection, query, values, query_limit)
 
     def on_post(self, req, resp):
         session = db.Session()
@@ -1236,14 +1725,17 @@ class Templates(object):
                                VALUES (:name, :template_id)
                                ON DUPLICATE KEY UPDATE `template_id`=:template_id''',
                             {'name': template_params['name'], 'template_id': template_id})
+            record_change(session, 'template', template_params['name'])
             session.commit()
             session.close()
+            response_cache.invalidate('template')
         except HTTPBadRequest:
             raise
         except Exception:
             session.close()
             logger.exception('ERROR')
             raise
+        refresh_plan_coverage(template_names=[template_params['name']])
 
         resp.status = HTTP_201
         resp.set_header('Location', '/templates/%s' % template_id)
@@ -1374,6 +1866,7 @@ class Target(object):
 class Application(object):
     allow_read_only = True
 
+    @cached_response('application')
     def on_get(self, req, resp, app_name):
         connection = db.engine.raw_connection()
         cursor = connection.cursor(db.dict_cursor)
@@ -1399,23 +1892,14 @@ class Application(object):
 class Applications(object):
     allow_read_only = True
 
+    @cached_response('application')
     def on_get(self, req, resp):
-        connection = db.engine.raw_connection()
-        cursor = connection.cursor(db.dict_cursor)
-        cursor.execute(get_applications_query)
-        apps = cursor.fetchall()
-        for app in apps:
-            cursor.execute(get_vars_query, app['id'])
-            app['variables'] = []
-            app['required_variables'] = []
-            for row in cursor:
-                app['variables'].append(row['name'])
-                if row['required']:
-                    app['required_variables'].append(row['name'])
-            del app['id']
-        payload = apps
-        cursor.close()
-        connection.close()
+        # reloading the application cache costs the same two queries as
+        # building the response, and keeps this worker's cache fresh
+        cache.cache_applications()
+        apps = sorted((app for app in cache.applications.itervalues() if not app['auth_only']),
+                      key=lambda app: app['id'])
+        payload = [{field: app[field] for field in application_fields} for app in apps]
         resp.status = HTTP_200
         resp.body = ujson.dumps(payload)
 
@@ -1423,6 +1907,7 @@ class Applications(object):
 class Modes(object):
     allow_read_only = False
 
+    @cached_response('mode')
     def on_get(self, req, resp):
         connection = db.engine.raw_connection()
         cursor = connection.cursor(db.dict_cursor)
@@ -1439,6 +1924,7 @@ class Modes(object):
 class Priorities(object):
     allow_read_only = False
 
+    @cached_response('priority', 'mode')
     def on_get(self, req, resp):
         connection = db.engine.raw_connection()
         cursor = connection.cursor(db.dict_cursor)
@@ -1506,15 +1992,187 @@ class User(object):
         resp.body = ujson.dumps(user_data)
 
 
+class ResponseQueue(object):
+    '''
+    Durable queue for user responses from provider webhooks.
+
+    Webhook bodies are stored in `response_queue` under a hash of the
+    provider's message id, so provider retries are acknowledged without being
+    processed twice. Each worker processes what it queued right away on a pool
+    of at most `size` greenlets. From the request path, at most once every
+    `interval` seconds, it also picks up rows nobody has finished within
+    `lease` seconds, e.g. because the pool was full or a worker died, and
+    drops rows processed, or given up on after `max_attempts`, more than
+    `retention` seconds ago.
+    '''
+
+    def __init__(self, size=10, interval=30, lease=300, max_attempts=5, retention=86400):
+        self.pool = Pool(size)
+        self.interval = interval
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.retention = retention
+        self.handlers = {}
+        self.last_sweep = time.time()
+
+    def register(self, kind, handler):
+        self.handlers[kind] = handler
+
+    def enqueue(self, kind, provider_id, body):
+        '''
+        Store a webhook body, returning False if it was already queued.
+        '''
+        if isinstance(provider_id, unicode):
+            provider_id = provider_id.encode('utf-8')
+        key = hashlib.sha1('%s:%s' % (kind, provider_id)).hexdigest()
+        # claim it up front if it can likely be processed now, otherwise leave it for a sweep
+        process_now = not self.pool.full()
+        connection = db.engine.raw_connection()
+        cursor = connection.cursor()
+        try:
+            cursor.execute('''INSERT IGNORE INTO `response_queue`
+                              (`idempotency_key`, `kind`, `body`, `created`, `claimed`, `attempts`)
+                              VALUES (%s, %s, %s, NOW(), IF(%s, NOW(), NULL), %s)''',
+                           (key, kind, body, process_now, int(process_now)))
+            queued = cursor.rowcount == 1
+            queue_id = cursor.lastrowid
+            connection.commit()
+        finally:
+            cursor.close()
+            connection.close()
+
+        if not queued:
+            stats['response_queue_duplicate_cnt'] += 1
+            return False
+        stats['response_queue_enqueue_cnt'] += 1
+        if process_now:
+            self.spawn([(queue_id, kind, body, 1)])
+        return True
+
+    def spawn(self, claimed):
+        '''
+        Process claimed rows on the pool. Rows that find it full, which could
+        otherwise block the request, are released to the next sweep.
+        '''
+        released = []
+        for row in claimed:
+            if self.pool.full():
+                released.append(row[0])
+            else:
+                self.pool.spawn(self.process, *row)
+        if not released:
+            return
+        connection = db.engine.raw_connection()
+        cursor = connection.cursor()
+        try:
+            cursor.execute('UPDATE `response_queue` SET `claimed` = NULL, `attempts` = `attempts` - 1 '
+                           'WHERE `id` IN %s', (tuple(released), ))
+            connection.commit()
+        finally:
+            cursor.close()
+            connection.close()
+
+    def process(self, queue_id, kind, body, attempts=1):
+        start = time.time()
+        try:
+            self.handlers[kind](body, queue_id)
+        except HTTPError as e:
+            # bad or unknown responses won't get better on retry
+            logger.warning('Dropping queued %s response %s: %s', kind, queue_id, e.description)
+            stats['response_queue_invalid_cnt'] += 1
+        except Exception:
+            logger.exception('Failed to process queued %s response %s', kind, queue_id)
+            stats['response_queue_fail_cnt'] += 1
+            if attempts >= self.max_attempts:
+                logger.error('Giving up on queued %s response %s after %d attempts', kind, queue_id, attempts)
+                stats['response_queue_dead_cnt'] += 1
+            return
+        connection = db.engine.raw_connection()
+        cursor = connection.cursor()
+        try:
+            cursor.execute('UPDATE `response_queue` SET `processed` = NOW() WHERE `id` = %s', queue_id)
+            connection.commit()
+        finally:
+            cursor.close()
+            connection.close()
+        stats['response_queue_process_cnt'] += 1
+        stats['response_queue_process_time'] = time.time() - start
+
+    def sweep(self):
+        free = self.pool.free_count()
+        connection = db.engine.raw_connection()
+        cursor = connection.cursor()
+        claimed = []
+        try:
+            cursor.execute('''DELETE FROM `response_queue`
+                              WHERE `processed` < DATE_SUB(NOW(), INTERVAL %s SECOND) LIMIT 1000''',
+                           self.retention)
+            cursor.execute('''DELETE FROM `response_queue`
+                              WHERE `processed` IS NULL AND `attempts` >= %s
+                              AND `created` < DATE_SUB(NOW(), INTERVAL %s SECOND) LIMIT 1000''',
+                           (self.max_attempts, self.retention))
+            if free:
+                stale = '''`processed` IS NULL AND `attempts` < %s
+                           AND (`claimed` IS NULL OR `claimed` < DATE_SUB(NOW(), INTERVAL %s SECOND))'''
+                cursor.execute('SELECT `id`, `kind`, `body`, `attempts` FROM `response_queue` WHERE ' + stale +
+                               ' ORDER BY `id` LIMIT %s', (self.max_attempts, self.lease, free))
+                for queue_id, kind, body, attempts in cursor.fetchall():
+                    # another worker may have claimed it since the select
+                    cursor.execute('UPDATE `response_queue` SET `claimed` = NOW(), `attempts` = `attempts` + 1 '
+                                   'WHERE `id` = %s AND ' + stale, (queue_id, self.max_attempts, self.lease))
+                    if cursor.rowcount == 1:
+                        claimed.append((queue_id, kind, body, attempts + 1))
+            connection.commit()
+        finally:
+            cursor.close()
+            connection.close()
+        stats['response_queue_sweep_cnt'] += len(claimed)
+        self.spawn(claimed)
+
+    def process_request(self, req, resp):
+        now = time.time()
+        if now - self.last_sweep >= self.interval:
+            self.last_sweep = now
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception('Failed to sweep response queue')
+
+
 class ResponseMixin(object):
     allow_read_only = False
+    queue_kind = None
+
+    def __init__(self, response_queue=None):
+        self.response_queue = response_queue if self.queue_kind else None
+        if self.response_queue:
+            self.response_queue.register(self.queue_kind, self.process_queued)
+
+    def enqueue_or_process(self, provider_id, body):
+        '''
+        Queue the webhook body if the response queue is enabled, otherwise
+        process it now and return the result.
+        '''
+        if self.response_queue:
+            self.response_queue.enqueue(self.queue_kind, provider_id, body)
+            return None
+        return self.process(body)
 
-    def create_response(self, msg_id, source, content):
+    def process_queued(self, body, queue_id):
+        self.process(body, queue_id)
+
+    def create_response(self, msg_id, source, content, queue_id=None):
         """
-        Return the result of the insert
+        Return the result of the insert, or None if an earlier attempt at the
+        queued response `queue_id` already inserted it
         """
         session = db.Session()
         try:
+            if queue_id is not None and not session.execute(
+                    '''UPDATE `response_queue` SET `responded` = NOW()
+                       WHERE `id` = :queue_id AND `responded` IS NULL''', {'queue_id': queue_id}).rowcount:
+                session.close()
+                return None
             response_dict = {
                 'source': source,
                 'message_id': msg_id,
@@ -1532,11 +2190,43 @@ class ResponseMixin(object):
             logger.exception('Failed to create response', e)
             raise
 
+    def create_responses(self, msg_ids, source, content, queue_id=None):
+        '''
+        Insert one response per message in a single multi-row INSERT, unless an
+        earlier attempt at the queued response `queue_id` already did.
+        '''
+        start = time.time()
+        connection = db.engine.raw_connection()
+        cursor = connection.cursor()
+        try:
+            if queue_id is not None:
+                cursor.execute('''UPDATE `response_queue` SET `responded` = NOW()
+                                  WHERE `id` = %s AND `responded` IS NULL''', queue_id)
+                if not cursor.rowcount:
+                    return
+            cursor.execute('''INSERT INTO `response` (`source`, `message_id`, `content`, `created`)
+                              VALUES %s''' % ', '.join(['(%s, %s, %s, NOW())'] * len(msg_ids)),
+                           [arg for msg_id in msg_ids for arg in (source, msg_id, content)])
+            connection.commit()
+        except Exception:
+            logger.exception('Failed to create responses for messages %s', msg_ids)
+            raise
+        finally:
+            cursor.close()
+            connection.close()
+        stats['response_batch_insert_time'] = time.time() - start
+        stats['response_batch_insert_cnt'] += len(msg_ids)
+
     def create_email_message(self, application, dest, subject, body):
+        return self.create_reply_message('email', application, dest, subject, body)
+
+    def create_reply_message(self, mode, application, dest, subject, body):
         if application not in cache.applications:
             return False, 'Application "%s" not found in %s.' % (application, cache.applications.keys())
 
         app = cache.applications[application]
+        if mode == 'sms':
+            dest = utils.normalize_phone_number(dest)
 
         session = db.Session()
         try:
@@ -1544,8 +2234,12 @@ class ResponseMixin(object):
             sql = '''SELECT `target`.`id` FROM `target`
                      JOIN `target_contact` on `target_contact`.`target_id` = `target`.`id`
                      JOIN `mode` on `mode`.`id` = `target_contact`.`mode_id`
-                     WHERE `mode`.`name` = 'email' AND `target_contact`.`destination` = :destination'''
-            target_id = session.execute(sql, {'destination': dest}).scalar()
+                     WHERE `mode`.`name` = :mode AND `target_contact`.`destination` = :destination'''
+            target = cache.contacts.get(cache.contact_key(mode, dest))
+            if target:
+                target_id = target[1]
+            else:
+                target_id = session.execute(sql, {'mode': mode, 'destination': dest}).scalar()
             if not target_id:
                 session.close()
                 msg = 'Failed to lookup target from destination: %s' % dest
@@ -1558,12 +2252,13 @@ class ResponseMixin(object):
                 'subject': subject,
                 'target_id': target_id,
                 'body': body,
-                'destination': dest
+                'destination': dest,
+                'mode': mode,
             }
 
             sql = '''INSERT INTO `message` (`created`, `application_id`, `subject`, `target_id`, `body`, `destination`, `mode_id`, `priority_id`)
                      VALUES (:created, :application_id, :subject, :target_id, :body, :destination,
-                      (SELECT `id` FROM `mode` WHERE `name` = 'email'),
+                      (SELECT `id` FROM `mode` WHERE `name` = :mode),
                       (SELECT `id` FROM `priority` WHERE `name` = 'low')
                      )'''
             message_id = session.execute(sql, data).lastrowid
@@ -1576,11 +2271,14 @@ class ResponseMixin(object):
             logger.exception('ERROR')
             raise
 
-    def handle_user_response(self, mode, msg_id, source, content):
+    def handle_user_response(self, mode, msg_id, source, content, queue_id=None):
         '''
         Insert user response into database, return:
             1. message id for user response
             2. forward plugin returns to caller
+
+        For a queued response, `queue_id` keeps retries from inserting it
+        again, and plugin failures are raised as is so the queue retries them.
         '''
         def validate_app(app):
             if not app:
@@ -1594,7 +2292,7 @@ class ResponseMixin(object):
             # FIXME: return error if message not found for id
             app = get_app_from_msg_id(session, msg_id)
             validate_app(app)
-            self.create_response(msg_id, source, content)
+            self.create_response(msg_id, source, content, queue_id)
         elif uuid4hex.match(msg_id):
             # msg id is not pure digit, might be a batch id
             sql = 'SELECT message.id FROM message WHERE message.batch=:batch_id'
@@ -1607,8 +2305,7 @@ class ResponseMixin(object):
             # the same app
             app = get_app_from_msg_id(session, mid_lst[0])
             validate_app(app)
-            for mid in mid_lst:
-                self.create_response(mid, source, content)
+            self.create_responses(mid_lst, source, content, queue_id)
             is_batch = True
         else:
             raise HTTPBadRequest('Invalid message id', 'invalid message id: %s' % msg_id.encode('utf-8'))
@@ -1617,16 +2314,31 @@ class ResponseMixin(object):
             resp = find_plugin(app).handle_response(
                 mode, msg_id, source, content, batch=is_batch)
         except Exception as e:
+            session.close()
+            if queue_id is not None:
+                raise
             raise HTTPBadRequest('Failed to handle response', 'failed to handle response: %s' % str(e))
         session.close()
         return app, resp
 
 
 class ResponseGmail(ResponseMixin):
+    queue_kind = 'gmail'
+
     def on_post(self, req, resp):
+        body = req.context['body']
+        provider_id = body
+        if self.response_queue:
+            for h in ujson.loads(body).get('headers', []):
+                if h.get('name', '').lower() == 'message-id':
+                    provider_id = h.get('value')
+        self.enqueue_or_process(provider_id, body)
+        resp.status = HTTP_204
+
+    def process(self, body, queue_id=None):
         source = None
         subject = None
-        gmail_params = ujson.loads(req.context['body'])
+        gmail_params = ujson.loads(body)
         # TODO(khrichar): there has to be a better way
         for h in gmail_params['headers']:
             key = h.get('name')
@@ -1639,7 +2351,7 @@ class ResponseGmail(ResponseMixin):
             raise HTTPBadRequest('Missing source', msg)
         # source is in the format of "First Last <user@email.com>",
         # but we only want the email part
-        source = source.split(' ')[-1].strip('<>'),
+        source = source.split(' ')[-1].strip('<>')
 
         # only parse first line of email content for now
         content = gmail_params['body']
@@ -1650,7 +2362,7 @@ class ResponseGmail(ResponseMixin):
             raise HTTPBadRequest('Invalid response', 'Invalid response: %s' % first_line)
 
         try:
-            app, response = self.handle_user_response('email', msg_id, source, cmd)
+            app, response = self.handle_user_response('email', msg_id, source, cmd, queue_id)
         except Exception:
             logger.exception('Failed to handle email response: %s' % first_line)
             raise
@@ -1659,12 +2371,18 @@ class ResponseGmail(ResponseMixin):
             if not success:
                 logger.error('Failed to send user response email: %s' % re)
                 raise HTTPBadRequest('Failed to send user response email', re)
-            resp.status = HTTP_204
 
 
 class ResponseGmailOneClick(ResponseMixin):
+    queue_kind = 'gmail-oneclick'
+
     def on_post(self, req, resp):
-        gmail_params = ujson.loads(req.context['body'])
+        # a repeated click carries the same body, so it is its own id
+        self.enqueue_or_process(req.context['body'], req.context['body'])
+        resp.status = HTTP_204
+
+    def process(self, body, queue_id=None):
+        gmail_params = ujson.loads(body)
 
         try:
             msg_id = gmail_params['msg_id']
@@ -1674,7 +2392,7 @@ class ResponseGmailOneClick(ResponseMixin):
             raise HTTPBadRequest('Post body missing required key', '')
 
         try:
-            app, response = self.handle_user_response('email', msg_id, email_address, cmd)
+            app, response = self.handle_user_response('email', msg_id, email_address, cmd, queue_id)
         except Exception:
             logger.exception('Failed to handle gmail one click response: %s' % gmail_params)
             raise
@@ -1683,10 +2401,10 @@ class ResponseGmailOneClick(ResponseMixin):
         if not success:
             logger.error('Failed to send user response email: %s' % re)
             raise HTTPBadRequest('Failed to send user response email', re)
-        resp.status = HTTP_204
 
 
 class ResponseTwilioCalls(ResponseMixin):
+    # callers wait on the line for the answer, so these are never queued
     def on_post(self, req, resp):
         post_dict = parse_qs(req.context['body'])
 
@@ -1711,13 +2429,38 @@ class ResponseTwilioCalls(ResponseMixin):
 
 
 class ResponseTwilioMessages(ResponseMixin):
+    queue_kind = 'twilio-messages'
+
     def on_post(self, req, resp):
-        post_dict = parse_qs(req.context['body'])
+        body = req.context['body']
+        post_dict = parse_qs(body)
         if 'Body' not in post_dict:
             raise HTTPBadRequest('SMS body not found', 'Missing Body argument in post body')
 
         if 'From' not in post_dict:
             raise HTTPBadRequest('From argument not found', 'Missing From in post body')
+
+        response = self.enqueue_or_process(post_dict.get('MessageSid', [body])[0], body)
+        if response is None:
+            # queued: the relay gets nothing to text back, process_queued
+            # sends the answer as an sms once the response is handled
+            response = ''
+        resp.status = HTTP_200
+        resp.body = ujson.dumps({'app_response': response})
+
+    def process(self, body):
+        _, response = self.handle_sms(body)
+        return response
+
+    def process_queued(self, body, queue_id):
+        app, response = self.handle_sms(body, queue_id)
+        source = parse_qs(body)['From'][0]
+        success, re = self.create_reply_message('sms', app, source, response, response)
+        if not success:
+            logger.error('Failed to send user response sms: %s' % re)
+
+    def handle_sms(self, body, queue_id=None):
+        post_dict = parse_qs(body)
         source = post_dict['From'][0]
         body = post_dict['Body'][0]
         try:
@@ -1726,13 +2469,10 @@ class ResponseTwilioMessages(ResponseMixin):
             raise HTTPBadRequest('Invalid response', 'failed to parse response')
 
         try:
-            _, response = self.handle_user_response('sms', msg_id, source, content)
+            return self.handle_user_response('sms', msg_id, source, content, queue_id)
         except Exception:
             logger.exception('Failed to handle sms response: %s' % body)
             raise
-        else:
-            resp.status = HTTP_200
-            resp.body = ujson.dumps({'app_response': response})
 
 
 class Reprioritization(object):
@@ -1800,6 +2540,7 @@ class Reprioritization(object):
             'count': count,
             'duration': duration,
         })
+        record_change(session, 'target_reprioritization', target_name)
         session.commit()
         session.close()
         resp.status = HTTP_200
@@ -1815,6 +2556,8 @@ class ReprioritizationMode(object):
           'target_name': target_name,
           'mode_name': src_mode_name,
         }).rowcount
+        if affected_rows:
+            record_change(session, 'target_reprioritization', target_name)
         session.commit()
         session.close()
 
@@ -1846,25 +2589,8 @@ class Stats(object):
     allow_read_only = True
 
     def on_get(self, req, resp):
-        queries = {
-          'total_plans': 'SELECT COUNT(*) FROM `plan`',
-          'total_incidents': 'SELECT COUNT(*) FROM `incident`',
-          'total_messages_sent': 'SELECT COUNT(*) FROM `message`',
-          'total_incidents_today': 'SELECT COUNT(*) FROM `incident` WHERE `created` >= CURDATE()',
-          'total_messages_sent_today': 'SELECT COUNT(*) FROM `message` WHERE `sent` >= CURDATE()',
-          'total_active_users': 'SELECT COUNT(*) FROM `target` WHERE `type_id` = (SELECT `id` FROM `target_type` WHERE `name` = "user") AND `active` = TRUE',
-        }
-
-        stats = {}
-
-        session = db.Session()
-        for key, query in queries.iteritems():
-            result = session.execute(query).scalar()
-            stats[key] = result
-
-        session.close()
         resp.status = HTTP_200
-        resp.body = ujson.dumps(stats)
+        resp.body = ujson.dumps(counters.read(db.read_engine()))
 
 
 def get_api_app():
@@ -1875,11 +2601,23 @@ def get_api_app():
 
 
 def get_api(config):
+    global stream_chunk_size
     db.init(config)
+    # take the change log version before loading anything, so changes made
+    # while the caches load are applied on the first poll
+    change_log = ChangeLog(db.engine)
+    change_log.poll()
     cache.init()
+    cache.subscribe(change_log)
+    stream_chunk_size = config.get('api_stream_chunk_size', stream_chunk_size)
+    response_cache.max_size = config.get('api_response_cache_size', 1000)
+    response_cache.ttl = config.get('api_response_cache_ttl', 60)
+    response_cache.subscribe(change_log, cached_change_types)
     init_plugins(config.get('plugins', {}))
     init_validators(config.get('validators', []))
     healthcheck_path = config['healthcheck_path']
+    init_metrics(config, 'iris-api', default_api_metrics)
+    sender_pool = init_sender_pool(config['sender'])
 
     debug = False
     if config['server'].get('disable_auth'):
@@ -1887,7 +2625,15 @@ def get_api(config):
     req = ReqBodyMiddleware()
     header = HeaderMiddleware()
     auth = AuthMiddleware(debug=debug)
-    middleware = [req, auth, header]
+    metrics = MetricsMiddleware(config.get('api_metrics_interval', 60))
+    changes = ChangeLogMiddleware(change_log, config.get('api_change_log_interval', 10))
+    middleware = [changes, req, auth, header, metrics]
+
+    response_queue = None
+    response_queue_config = dict(config.get('response_queue', {}))
+    if response_queue_config.pop('enabled', False):
+        response_queue = ResponseQueue(**response_queue_config)
+        middleware.append(response_queue)
 
     app = API(middleware=middleware)
 
@@ -1896,12 +2642,15 @@ def get_api(config):
 
     app.add_route('/v0/incidents/{incident_id}', Incident())
     app.add_route('/v0/incidents', Incidents())
+    app.add_route('/v0/incidents/batch', IncidentsBatch(config.get('incident_batch_max', 100)))
 
     app.add_route('/v0/messages/{message_id}', Message())
     app.add_route('/v0/messages/{message_id}/auditlog', MessageAuditLog())
     app.add_route('/v0/messages', Messages())
 
-    app.add_route('/v0/notifications', Notifications(config))
+    app.add_route('/v0/notifications', Notifications(sender_pool))
+    app.add_route('/v0/notifications/batch',
+                  NotificationsBatch(sender_pool, config.get('notification_batch_max', 100)))
 
     app.add_route('/v0/targets/{target_type}', Target())
     app.add_route('/v0/targets', Targets())
@@ -1921,10 +2670,10 @@ def get_api(config):
 
     app.add_route('/v0/priorities', Priorities())
 
-    app.add_route('/v0/response/gmail', ResponseGmail())
-    app.add_route('/v0/response/gmail-oneclick', ResponseGmailOneClick())
+    app.add_route('/v0/response/gmail', ResponseGmail(response_queue))
+    app.add_route('/v0/response/gmail-oneclick', ResponseGmailOneClick(response_queue))
     app.add_route('/v0/response/twilio/calls', ResponseTwilioCalls())
-    app.add_route('/v0/response/twilio/messages', ResponseTwilioMessages())
+    app.add_route('/v0/response/twilio/messages', ResponseTwilioMessages(response_queue))
 
     app.add_route('/v0/stats', Stats())
 
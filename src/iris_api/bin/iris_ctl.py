@@ -12,6 +12,9 @@ import ujson
 import yaml
 import click
 
+from iris_api.sender.auditlog import change_flags
+from iris_api.change_log import record_change_with_cursor
+
 
 @click.group()
 @click.pass_context
@@ -71,6 +74,7 @@ def sample_context(ctx, app, sample_context, config):
     with db_from_config(config) as (conn, cursor):
         cursor.execute('UPDATE `application` SET `sample_context`=%s WHERE `name`=%s;',
                        (sample_ctx, app))
+        record_change_with_cursor(cursor, 'application', app)
         conn.commit()
     click.echo(click.style('All done!', fg='green'))
 app_import.add_command(sample_context)
@@ -93,6 +97,7 @@ def context_template(ctx, app, context_template, config):
     with db_from_config(config) as (conn, cursor):
         cursor.execute('UPDATE application SET `context_template`=%s WHERE `name`=%s;',
                        (tpl_content, app))
+        record_change_with_cursor(cursor, 'application', app)
         conn.commit()
     click.echo(click.style('All done!', fg='green'))
 app_import.add_command(context_template)
@@ -116,6 +121,7 @@ def summary_template(ctx, app, summary_template, config):
     with db_from_config(config) as (conn, cursor):
         cursor.execute('UPDATE application SET `summary_template`=%s WHERE `name`=%s;',
                        (tpl_content, app))
+        record_change_with_cursor(cursor, 'application', app)
         conn.commit()
     click.echo(click.style('All done!', fg='green'))
 app_import.add_command(summary_template)
@@ -144,6 +150,7 @@ def delete_template(ctx, template, config):
             cursor.execute('DELETE FROM template WHERE `name` = %s', template)
             if cursor.rowcount == 0:
                 raise click.ClickException('No template found with given name')
+            record_change_with_cursor(cursor, 'template', template)
         except IntegrityError as e:
             cursor.execute('''SELECT `message`.`id` FROM
                                   message JOIN template ON `message`.`template_id` = `template`.`id`
@@ -199,6 +206,7 @@ def delete_plan(ctx, plan, config):
             cursor.execute('DELETE FROM plan WHERE `name` = %s', plan)
             if cursor.rowcount == 0:
                 raise click.ClickException('No plan found with given name')
+            record_change_with_cursor(cursor, 'plan', plan)
         except IntegrityError as e:
             cursor.execute('''SELECT `message`.`id` FROM
                                   message JOIN plan ON `message`.`plan_id` = `plan`.`id`
@@ -226,6 +234,42 @@ def delete_plan(ctx, plan, config):
 plan.add_command(delete_plan)
 
 
+@click.group()
+@click.pass_context
+def message(ctx):
+    pass
+iris_ctl.add_command(message)
+
+
+@click.command('backfill-change-flags')
+@click.option('--config', default='./config.yaml')
+@click.option('--batch-size', default=10000, help='message_changelog rows per transaction')
+@click.pass_context
+def backfill_change_flags(ctx, config, batch_size):
+    with open(config, 'r') as config_file:
+        config = yaml.safe_load(config_file)
+
+    with db_from_config(config) as (conn, cursor):
+        cursor.execute('SELECT COALESCE(MAX(`id`), 0) FROM `message_changelog`')
+        max_id = cursor.fetchone()[0]
+        # a multi-table UPDATE changes each message once however many log
+        # rows match, so each flag gets its own pass
+        for change_type, column in change_flags.iteritems():
+            updated = 0
+            for start in xrange(0, max_id, batch_size):
+                cursor.execute('''UPDATE `message`
+                                  JOIN `message_changelog` ON `message_changelog`.`message_id` = `message`.`id`
+                                  SET `message`.`%s` = TRUE
+                                  WHERE `message_changelog`.`change_type` = %%s
+                                  AND `message_changelog`.`id` > %%s AND `message_changelog`.`id` <= %%s''' % column,
+                               (change_type, start, start + batch_size))
+                updated += cursor.rowcount
+                conn.commit()
+            click.echo('Set %s on %d messages' % (column, updated))
+    click.echo(click.style('All done!', fg='green'))
+message.add_command(backfill_change_flags)
+
+
 def main():
     iris_ctl(obj={})
 
@@ -22,6 +22,7 @@ from iris_api.sender import rpc, cache
 from iris_api.sender.message import update_message_mode
 from iris_api.sender.oneclick import oneclick_email_markup, generate_oneclick_url
 from iris_api import cache as api_cache
+from iris_api import counters
 
 # sql
 
@@ -163,6 +164,8 @@ WHERE `id`=%s'''
 
 PRUNE_OLD_AUDIT_LOGS_SQL = '''DELETE FROM `message_changelog` WHERE `date` < DATE_SUB(CURDATE(), INTERVAL 3 MONTH)'''
 
+PRUNE_OLD_CHANGE_LOG_SQL = '''DELETE FROM `change_log` WHERE `created` < DATE_SUB(NOW(), INTERVAL 1 DAY)'''
+
 # logging
 
 logger = logging.getLogger()
@@ -207,11 +210,15 @@ default_sender_metrics = {
     'sms_sent': 0, 'sms_max': 0, 'sms_min': 0, 'sms_avg': 0, 'call_cnt': 0, 'call_total': 0,
     'call_fail': 0, 'call_sent': 0, 'call_max': 0, 'call_min': 0, 'call_avg': 0, 'task_failure': 0,
     'oncall_error': 0, 'role_target_lookup_error': 0, 'target_not_found': 0, 'message_send_cnt': 0,
-    'notification_cnt': 0, 'api_request_cnt': 0, 'api_request_timeout_cnt': 0,
+    'notification_cnt': 0, 'notification_batch_cnt': 0, 'api_request_cnt': 0, 'api_request_timeout_cnt': 0,
+    'api_request_invalid_cnt': 0, 'role_target_cache_hit_cnt': 0, 'role_target_cache_miss_cnt': 0,
+    'role_target_cache_stale_cnt': 0, 'role_target_cache_negative_hit_cnt': 0,
     'rpc_message_pass_success_cnt': 0, 'rpc_message_pass_fail_cnt': 0,
     'slave_message_send_success_cnt': 0, 'slave_message_send_fail_cnt': 0
 }
 
+default_sender_metrics.update(cache.default_cache_metrics)
+
 # TODO: make this configurable
 target_fallback_mode = 'email'
 should_mock_gwatch_renewer = False
@@ -301,12 +308,34 @@ def deactivate():
     logger.info('[*] deactivate task finished')
 
 
+def prefetch_escalation(repeats, escalations):
+    # load every row create_messages is about to look up with one query per
+    # cache, rather than one query per row
+    incident_ids = {incident_id for incident_id, _ in repeats}
+    incident_ids.update(escalations)
+    plan_notification_ids = {plan_notification_id for _, plan_notification_id in repeats}
+    for plan_id, step in escalations.itervalues():
+        plan_notification_ids.update(cache.plans[plan_id]['steps'].get(step, []))
+
+    cache.incidents.get_many(incident_ids)
+    plan_notifications = [n for n in cache.plan_notifications.get_many(plan_notification_ids).itervalues() if n]
+    roles = cache.roles.get_many({n['role_id'] for n in plan_notifications})
+    targets = cache.targets.get_many({n['target_id'] for n in plan_notifications})
+    # users don't need a role lookup, so their names are known up front
+    cache.target_names.get_many({targets[n['target_id']]['name'] for n in plan_notifications
+                                 if roles.get(n['role_id']) and targets.get(n['target_id']) and
+                                 roles[n['role_id']]['name'] == 'user'})
+
+
 def escalate():
     # make notifications for things that should repeat or escalate
     logger.info('[-] start escalate task...')
 
     # first, handle new incidents
     start_notifications = time.time()
+    role_lookup = cache.targets_for_role.role_lookup
+    oncall_api_calls = getattr(role_lookup, 'api_call_cnt', 0)
+    oncall_snapshot_hits = getattr(role_lookup, 'snapshot_hit_cnt', 0)
 
     connection = db.engine.raw_connection()
     cursor = connection.cursor()
@@ -368,13 +397,19 @@ def escalate():
     msg_count = 0
     cursor = connection.cursor(db.dict_cursor)
     cursor.execute(QUEUE_SQL)
+    repeats = []
     for n in cursor.fetchall():
         if n['count'] < n['max']:
-            if create_messages(n['incident_id'], n['plan_notification_id']):
-                msg_count += 1
+            repeats.append((n['incident_id'], n['plan_notification_id']))
         else:
             escalations[n['incident_id']] = (n['plan_id'], n['current_step'] + 1)
 
+    prefetch_escalation(repeats, escalations)
+
+    for incident_id, plan_notification_id in repeats:
+        if create_messages(incident_id, plan_notification_id):
+            msg_count += 1
+
     for incident_id, (plan_id, step) in escalations.iteritems():
         plan = cache.plans[plan_id]
         steps = plan['steps'].get(step, [])
@@ -397,6 +432,11 @@ def escalate():
     connection.close()
 
     logger.info('[*] %s new messages', msg_count)
+    # role lookups served from the on-call snapshot are oncall-api calls saved
+    stats['escalate_oncall_api_calls'] = getattr(role_lookup, 'api_call_cnt', 0) - oncall_api_calls
+    stats['escalate_oncall_snapshot_hits'] = getattr(role_lookup, 'snapshot_hit_cnt', 0) - oncall_snapshot_hits
+    logger.info('[*] %s oncall-api calls, %s served from on-call snapshot',
+                stats['escalate_oncall_api_calls'], stats['escalate_oncall_snapshot_hits'])
     logger.info('[*] escalate task finished')
     stats['notifications'] = time.time() - start_notifications
 
@@ -872,12 +912,29 @@ def prune_old_audit_logs_worker():
         cursor = connection.cursor()
         cursor.execute(PRUNE_OLD_AUDIT_LOGS_SQL)
         connection.commit()
+        # separately, so a missing or locked change_log doesn't roll back the
+        # audit log prune or kill the worker
+        try:
+            cursor.execute(PRUNE_OLD_CHANGE_LOG_SQL)
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            logger.exception('Failed pruning old change log entries')
         cursor.close()
         connection.close()
         logger.info('Ran task to prune old audit logs. Waiting 4 hours until next run.')
         sleep(60*60*4)
 
 
+def stats_counters_worker(interval, batch_size):
+    while True:
+        try:
+            counters.aggregate(db.engine, batch_size)
+        except Exception:
+            logger.exception('Failed aggregating stats counters')
+        sleep(interval)
+
+
 def mock_gwatch_renewer():
     while True:
         logger.info('[-] start mock gmail watcher loop...')
@@ -931,6 +988,8 @@ def main():
         else:
             spawn(gwatch_renewer)
         spawn(prune_old_audit_logs_worker)
+        spawn(stats_counters_worker, config['sender'].get('stats_counters_interval', 60),
+              config['sender'].get('stats_counters_batch_size', 100000))
 
     rpc.init(config['sender'], dict(send_message=send_message, add_stat=add_stat))
     rpc.run(config['sender'])
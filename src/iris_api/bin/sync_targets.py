@@ -17,6 +17,7 @@ from phonenumbers.phonenumberutil import NumberParseException
 from ldap.controls import SimplePagedResultsControl
 from iris_api.api import load_config_file
 from iris_api.role_lookup import get_role_lookup
+from iris_api.change_log import record_change
 from iris_api.metrics import stats, init as init_metrics, emit_metrics
 
 from requests.packages.urllib3.exceptions import (
@@ -79,6 +80,7 @@ def prune_user(engine, username):
 
     try:
         engine.execute('DELETE FROM `target` WHERE `name` = %s', username)
+        record_change(engine, 'target', username)
         logger.info('Deleted inactive user %s', username)
 
     # The user has messages or some other user data which should be preserved.
@@ -86,6 +88,7 @@ def prune_user(engine, username):
     except IntegrityError:
         logger.info('Marking user %s inactive', username)
         engine.execute('UPDATE `target` SET `active` = FALSE WHERE `name` = %s', username)
+        record_change(engine, 'target', username)
 
     except SQLAlchemyError as e:
         logger.error('Deleting user %s failed: %s', username, e)
@@ -243,6 +246,8 @@ def sync(config, engine, purge_old_users=True):
             if value and key in modes:
                 logger.info('%s: %s -> %s' % (username, key, value))
                 engine.execute(target_contact_add_sql, (target_id, modes[key], value, value))
+        # after the contacts, so API workers reloading the user see them
+        record_change(engine, 'target', username)
 
     # update users that need to be
     contact_update_sql = 'UPDATE target_contact SET destination = %s WHERE target_id = (SELECT id FROM target WHERE name = %s) AND mode_id = %s'
@@ -251,6 +256,7 @@ def sync(config, engine, purge_old_users=True):
 
     logger.info('Users to update (%d)' % len(users_to_update))
     for username in users_to_update:
+        contacts_updated = stats['user_contacts_updated']
         try:
             db_contacts = iris_users[username]
             ldap_contacts = ldap_users[username]
@@ -271,6 +277,8 @@ def sync(config, engine, purge_old_users=True):
                     engine.execute(contact_delete_sql, (username, modes[mode]))
                 else:
                     logger.debug('%s: missing %s' % (username, mode))
+            if contacts_updated != stats['user_contacts_updated']:
+                record_change(engine, 'target', username)
         except SQLAlchemyError as e:
             stats['users_failed_to_update'] += 1
             stats['sql_errors'] += 1
@@ -285,6 +293,7 @@ def sync(config, engine, purge_old_users=True):
         logger.info('Inserting %s' % t)
         try:
             target_id = engine.execute(target_add_sql, (t, target_types['team'])).lastrowid
+            record_change(engine, 'target', t)
             stats['teams_added'] += 1
         except SQLAlchemyError as e:
             logger.exception('Error inserting team %s: %s' % (t, e))
@@ -9,21 +9,58 @@ priorities = {}
 target_types = {}
 target_roles = {}
 modes = {}
+# active plan name: (plan id, ids of applications with content for one of its templates)
+plan_coverage = {}
+# contact_key(mode, destination): (target name, target id), for attributing responses
+contacts = {}
+# target name: contact keys, to drop a target's old contacts on reload
+contact_keys_by_target = {}
+
+
+def replace(cache, data):
+    # drop rows that were deleted, keeping the dict other modules imported
+    for key in cache.viewkeys() - data.viewkeys():
+        del cache[key]
+    cache.update(data)
+
+
+applications_query = '''SELECT `id`, `name`, `key`, `allow_other_app_incidents`, `auth_only`,
+                             `context_template`, `sample_context`, `summary_template`
+                      FROM `application`'''
+
+template_variables_query = '''SELECT `application_id`, `name`, `required` FROM `template_variable`
+                            ORDER BY `required` DESC, `name` ASC'''
+
+
+def load_applications(cursor):
+    '''
+    Load all applications by name along with their template variables, in two
+    queries however many applications there are.
+    '''
+    cursor.execute(applications_query)
+    apps = {}
+    apps_by_id = {}
+    for app in cursor.fetchall():
+        app['variables'] = []
+        app['required_variables'] = []
+        apps[app['name']] = apps_by_id[app['id']] = app
+    cursor.execute(template_variables_query)
+    for row in cursor:
+        app = apps_by_id.get(row['application_id'])
+        if app is None:
+            continue
+        app['variables'].append(row['name'])
+        if row['required']:
+            app['required_variables'].append(row['name'])
+    return apps
 
 
 def cache_applications():
     connection = db.engine.raw_connection()
     cursor = connection.cursor(db.dict_cursor)
-    cursor.execute('''SELECT `name`, `id`, `key`, `allow_other_app_incidents` FROM `application`''')
-    apps = cursor.fetchall()
-    for app in apps:
-        cursor.execute(
-            'SELECT `name` FROM `template_variable` WHERE `application_id` = %s',
-            app['id'])
-        app['variables'] = [row['name'] for row in cursor]
-        applications[app['name']] = app
-    connection.close()
+    replace(applications, load_applications(cursor))
     cursor.close()
+    connection.close()
 
 
 def cache_priorities():
@@ -31,8 +68,7 @@ def cache_priorities():
     cursor = connection.cursor(db.dict_cursor)
     cursor.execute('''SELECT `priority`.`id`, `priority`.`name`, `priority`.`mode_id`
                       FROM `priority`''')
-    for row in cursor:
-        priorities[row['name']] = row
+    replace(priorities, {row['name']: row for row in cursor})
     cursor.close()
     connection.close()
 
@@ -41,8 +77,7 @@ def cache_target_types():
     connection = db.engine.raw_connection()
     cursor = connection.cursor(db.dict_cursor)
     cursor.execute('''SELECT `name`, `id` FROM target_type''')
-    for row in cursor:
-        target_types[row['name']] = row['id']
+    replace(target_types, {row['name']: row['id'] for row in cursor})
     cursor.close()
     connection.close()
 
@@ -51,8 +86,7 @@ def cache_target_roles():
     connection = db.engine.raw_connection()
     cursor = connection.cursor(db.dict_cursor)
     cursor.execute('''SELECT `name`, `id` FROM target_role''')
-    for row in cursor:
-        target_roles[row['name']] = row['id']
+    replace(target_roles, {row['name']: row['id'] for row in cursor})
     cursor.close()
     connection.close()
 
@@ -61,11 +95,114 @@ def cache_modes():
     connection = db.engine.raw_connection()
     cursor = connection.cursor(db.dict_cursor)
     cursor.execute('''SELECT `name`, `id` FROM mode''')
-    for row in cursor:
-        modes[row['name']] = row['id']
+    replace(modes, {row['name']: row['id'] for row in cursor})
+    cursor.close()
+    connection.close()
+
+
+plan_coverage_query = '''SELECT DISTINCT `plan_active`.`name`, `plan_active`.`plan_id`, `template_content`.`application_id`
+                         FROM `plan_active`
+                         LEFT JOIN `plan_notification` ON `plan_notification`.`plan_id` = `plan_active`.`plan_id`
+                         LEFT JOIN `template` ON `template`.`name` = `plan_notification`.`template`
+                         LEFT JOIN `template_content` ON `template_content`.`template_id` = `template`.`id`'''
+
+
+def cache_plan_coverage(plan_names=None, template_names=None):
+    '''
+    Reload plan_coverage, or only the given plans or the plans using the
+    given templates. Returns the reloaded entries.
+    '''
+    query = plan_coverage_query
+    args = None
+    if plan_names is not None:
+        if not plan_names:
+            return {}
+        query += ' WHERE `plan_active`.`name` IN %s'
+        args = (tuple(plan_names), )
+    elif template_names is not None:
+        if not template_names:
+            return {}
+        query += ''' WHERE `plan_active`.`plan_id` IN (SELECT `plan_id` FROM `plan_notification`
+                                                       WHERE `template` IN %s)'''
+        args = (tuple(template_names), )
+
+    connection = db.engine.raw_connection()
+    cursor = connection.cursor()
+    cursor.execute(query, args)
+    coverage = {}
+    for name, plan_id, application_id in cursor:
+        app_ids = coverage.setdefault(name, (plan_id, set()))[1]
+        if application_id is not None:
+            app_ids.add(application_id)
+    cursor.close()
+    connection.close()
+
+    if plan_names is None and template_names is None:
+        replace(plan_coverage, coverage)
+    else:
+        # plans missing from the result were deactivated
+        for name in plan_names or ():
+            if name not in coverage:
+                plan_coverage.pop(name, None)
+        plan_coverage.update(coverage)
+    return coverage
+
+
+contacts_query = '''SELECT `mode`.`name`, `target_contact`.`destination`, `target`.`name`, `target`.`id`
+                     FROM `target_contact`
+                     JOIN `target` ON `target`.`id` = `target_contact`.`target_id`
+                     JOIN `mode` ON `mode`.`id` = `target_contact`.`mode_id`'''
+
+
+def contact_key(mode, destination):
+    '''
+    Phone numbers are matched on their digits, so "+14155551234" from a
+    provider finds the stored "+1 415-555-1234" without parsing either.
+    '''
+    if mode in ('sms', 'call'):
+        destination = ''.join(c for c in destination if c.isdigit())
+    else:
+        destination = destination.lower()
+    return mode, destination
+
+
+def cache_contacts(target_names=None):
+    '''
+    Reload the reverse contact index, or only the contacts of the given
+    targets.
+    '''
+    query = contacts_query
+    args = None
+    if target_names is not None:
+        if not target_names:
+            return
+        query += ' WHERE `target`.`name` IN %s'
+        args = (tuple(target_names), )
+
+    connection = db.engine.raw_connection()
+    cursor = connection.cursor()
+    cursor.execute(query, args)
+    index = {}
+    keys_by_target = {}
+    for mode, destination, name, target_id in cursor:
+        key = contact_key(mode, destination)
+        index[key] = (name, target_id)
+        keys_by_target.setdefault(name, set()).add(key)
     cursor.close()
     connection.close()
 
+    if target_names is None:
+        replace(contacts, index)
+        replace(contact_keys_by_target, keys_by_target)
+        return
+    # targets missing from the result were deleted or lost their contacts
+    for name in target_names:
+        for key in contact_keys_by_target.pop(name, ()):
+            if contacts.get(key, (name, ))[0] == name:
+                del contacts[key]
+    contacts.update(index)
+    contact_keys_by_target.update(keys_by_target)
+
 
 def init():
     cache_applications()
@@ -73,3 +210,14 @@ def init():
     cache_target_types()
     cache_target_roles()
     cache_modes()
+    cache_plan_coverage()
+    cache_contacts()
+
+
+def subscribe(change_log):
+    # priorities, modes, target types and roles only change with the schema,
+    # so they are loaded once at startup
+    change_log.subscribe('application', lambda names: cache_applications(), cache_applications)
+    change_log.subscribe('plan', lambda names: cache_plan_coverage(plan_names=names), cache_plan_coverage)
+    change_log.subscribe('template', lambda names: cache_plan_coverage(template_names=names), cache_plan_coverage)
+    change_log.subscribe('target', lambda names: cache_contacts(target_names=names), cache_contacts)
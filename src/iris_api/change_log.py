@@ -0,0 +1,117 @@
+# Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
+# See LICENSE in the project root for license information.
+
+from __future__ import absolute_import
+
+from sqlalchemy import text
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+record_change_sql = text('INSERT INTO `change_log` (`type`, `name`) VALUES (:type, :name)')
+
+
+def record_change(connectable, change_type, name):
+    '''
+    Tell API workers and senders that `name` of `change_type` changed.
+    `connectable` is a session or engine; record changes in the same
+    transaction as the change itself.
+    '''
+    connectable.execute(record_change_sql, {'type': change_type, 'name': name})
+
+
+def record_change_with_cursor(cursor, change_type, name):
+    '''
+    record_change for code holding a raw DB-API cursor.
+    '''
+    cursor.execute('INSERT INTO `change_log` (`type`, `name`) VALUES (%s, %s)', (change_type, name))
+
+
+class ChangeLog(object):
+    '''
+    Polls the change_log table and passes changed names to subscribers.
+
+    Rows are committed out of id order, so rows created within the last
+    `window` seconds are read again on every poll and applied once.
+
+    Failed polls are retried with exponential backoff, up to `max_backoff`
+    seconds apart, and the first poll that succeeds after a failure reloads
+    everything once.
+    '''
+
+    def __init__(self, engine, window=120, max_backoff=300):
+        self.engine = engine
+        self.window = window
+        self.max_backoff = max_backoff
+        self.version = None
+        self.seen = set()
+        self.failures = 0
+        self.retry_at = 0
+        # type: [(on_change, on_reload)]
+        self.subscribers = {}
+
+    def subscribe(self, change_type, on_change, on_reload):
+        '''
+        on_change is called with the set of changed names. on_reload is
+        called with no arguments when changes may have been missed.
+        '''
+        self.subscribers.setdefault(change_type, []).append((on_change, on_reload))
+
+    def poll(self):
+        '''
+        Returns {type: set of names} changed since the last poll, or None if
+        everything needs to be reloaded.
+        '''
+        now = time.time()
+        if now < self.retry_at:
+            return {}
+        try:
+            connection = self.engine.raw_connection()
+            cursor = connection.cursor()
+            try:
+                if self.version is None:
+                    cursor.execute('SELECT COALESCE(MAX(`id`), 0) FROM `change_log`')
+                    self.version = cursor.fetchone()[0]
+                    self.failures = 0
+                    return None
+                cursor.execute('''SELECT `id`, `type`, `name` FROM `change_log`
+                                  WHERE `id` > %s OR `created` > DATE_SUB(NOW(), INTERVAL %s SECOND)''',
+                               (self.version, self.window))
+                rows = cursor.fetchall()
+            finally:
+                cursor.close()
+                connection.close()
+        except Exception:
+            self.failures += 1
+            backoff = min(2 ** self.failures, self.max_backoff)
+            self.retry_at = now + backoff
+            logger.exception('Failed polling change_log, retrying in %s seconds', backoff)
+            return {}
+
+        changes = {}
+        for change_id, change_type, name in rows:
+            if change_id not in self.seen:
+                changes.setdefault(change_type, set()).add(name)
+            self.version = max(self.version, change_id)
+        self.seen = {row[0] for row in rows}
+        if self.failures:
+            # changes may have been pruned while polls were failing
+            self.failures = 0
+            return None
+        return changes
+
+    def dispatch(self):
+        changes = self.poll()
+        for change_type, subscribers in self.subscribers.iteritems():
+            if changes is not None and change_type not in changes:
+                continue
+            for on_change, on_reload in subscribers:
+                try:
+                    if changes is None:
+                        on_reload()
+                    else:
+                        on_change(changes[change_type])
+                except Exception:
+                    logger.exception('Failed applying %s changes', change_type)
+        return changes
@@ -0,0 +1,119 @@
+# Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
+# See LICENSE in the project root for license information.
+
+'''
+Precomputed counters for /v0/stats.
+
+The master sender calls aggregate() periodically. Messages and incidents are
+counted incrementally by id, with a watermark per counter and per day rollups
+by `created`, so each run only reads rows added since the last one. Everything
+else is cheap enough to recount on every run. read() only does primary key
+lookups.
+'''
+
+from __future__ import absolute_import
+
+# counter name: (table, daily counter name)
+incremental_counters = {
+    'total_incidents': ('incident', 'incidents'),
+    'total_messages_sent': ('message', 'messages'),
+}
+
+snapshot_counters = {
+    'total_plans': 'SELECT COUNT(*) FROM `plan`',
+    'total_active_users': '''SELECT COUNT(*) FROM `target`
+                             WHERE `type_id` = (SELECT `id` FROM `target_type` WHERE `name` = "user")
+                             AND `active` = TRUE''',
+}
+
+# served by ix_message_sent, so this only reads today's messages
+daily_snapshot_counters = {
+    'messages_sent': 'SELECT COUNT(*) FROM `message` WHERE `sent` >= CURDATE()',
+}
+
+# /v0/stats key: daily counter name, for today
+daily_stats = {
+    'total_incidents_today': 'incidents',
+    'total_messages_sent_today': 'messages_sent',
+}
+
+upsert_counter_sql = '''INSERT INTO `stats_counter` (`name`, `value`) VALUES (%s, %s)
+                        ON DUPLICATE KEY UPDATE `value` = VALUES(`value`)'''
+
+add_daily_counter_sql = '''INSERT INTO `stats_daily_counter` (`day`, `name`, `value`) VALUES (%s, %s, %s)
+                           ON DUPLICATE KEY UPDATE `value` = `value` + VALUES(`value`)'''
+
+upsert_today_counter_sql = '''INSERT INTO `stats_daily_counter` (`day`, `name`, `value`) VALUES (CURDATE(), %s, %s)
+                              ON DUPLICATE KEY UPDATE `value` = VALUES(`value`)'''
+
+
+def count_batch(cursor, name, table, daily_name, batch_size, settle_time):
+    '''
+    Add the next `batch_size` ids of `table` to counter `name` and its daily
+    rollup, returning whether anything was counted. Rows created in the last
+    `settle_time` seconds are left for the next run, since ids below them may
+    belong to transactions that haven't committed yet.
+    '''
+    cursor.execute('INSERT IGNORE INTO `stats_counter` (`name`) VALUES (%s)', name)
+    cursor.execute('SELECT `watermark` FROM `stats_counter` WHERE `name` = %s FOR UPDATE', name)
+    watermark = cursor.fetchone()[0]
+    cursor.execute('SELECT MAX(`id`) FROM `%s`' % table)
+    end = min(cursor.fetchone()[0] or 0, watermark + batch_size)
+    cursor.execute('''SELECT MIN(`id`) FROM `%s`
+                      WHERE `id` > %%s AND `id` <= %%s AND `created` > DATE_SUB(NOW(), INTERVAL %%s SECOND)''' % table,
+                   (watermark, end, settle_time))
+    recent = cursor.fetchone()[0]
+    if recent is not None:
+        end = recent - 1
+    if end <= watermark:
+        return False
+
+    cursor.execute('''SELECT DATE(`created`), COUNT(*) FROM `%s`
+                      WHERE `id` > %%s AND `id` <= %%s GROUP BY DATE(`created`)''' % table,
+                   (watermark, end))
+    days = cursor.fetchall()
+    for day, count in days:
+        cursor.execute(add_daily_counter_sql, (day, daily_name, count))
+    cursor.execute('UPDATE `stats_counter` SET `value` = `value` + %s, `watermark` = %s WHERE `name` = %s',
+                   (sum(count for _, count in days), end, name))
+    return True
+
+
+def aggregate(engine, batch_size=100000, settle_time=60):
+    connection = engine.raw_connection()
+    cursor = connection.cursor()
+    try:
+        for name, (table, daily_name) in incremental_counters.iteritems():
+            # commit per batch, so catching up on a large table doesn't hold
+            # one long transaction
+            while count_batch(cursor, name, table, daily_name, batch_size, settle_time):
+                connection.commit()
+            connection.commit()
+        for name, query in snapshot_counters.iteritems():
+            cursor.execute(query)
+            cursor.execute(upsert_counter_sql, (name, cursor.fetchone()[0]))
+        for name, query in daily_snapshot_counters.iteritems():
+            cursor.execute(query)
+            cursor.execute(upsert_today_counter_sql, (name, cursor.fetchone()[0]))
+        connection.commit()
+    finally:
+        cursor.close()
+        connection.close()
+
+
+def read(engine):
+    connection = engine.raw_connection()
+    cursor = connection.cursor()
+    try:
+        cursor.execute('SELECT `name`, `value` FROM `stats_counter`')
+        counters = dict(cursor.fetchall())
+        cursor.execute('SELECT `name`, `value` FROM `stats_daily_counter` WHERE `day` = CURDATE()')
+        daily = dict(cursor.fetchall())
+    finally:
+        cursor.close()
+        connection.close()
+
+    stats = {name: counters.get(name, 0) for name in incremental_counters.keys() + snapshot_counters.keys()}
+    for key, name in daily_stats.iteritems():
+        stats[key] = daily.get(name, 0)
+    return stats
@@ -1,20 +1,95 @@
 # Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
 # See LICENSE in the project root for license information.
 
+from gevent import sleep, spawn
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
+import random
+
+import logging
+logger = logging.getLogger(__name__)
 
 Session = None
 dict_cursor = None
+ss_dict_cursor = None
 engine = None
+replicas = []
+max_replica_lag = 30
+replica_check_interval = 10
+replica_checker = None
+
+
+class Replica(object):
+    def __init__(self, engine):
+        self.engine = engine
+        # seconds behind the primary, None if unknown or not replicating
+        self.lag = None
+
+    def check(self):
+        try:
+            connection = self.engine.raw_connection()
+            cursor = connection.cursor(dict_cursor)
+            try:
+                cursor.execute('SHOW SLAVE STATUS')
+                status = cursor.fetchone()
+            finally:
+                cursor.close()
+                connection.close()
+        except Exception:
+            logger.exception('Failed checking replica %s', self.engine.url)
+            status = None
+        lag = status and status['Seconds_Behind_Master']
+        if (lag is None or lag > max_replica_lag) and self.healthy:
+            logger.warning('Replica %s is %s seconds behind, reading from the primary',
+                           self.engine.url, lag)
+        self.lag = lag
+
+    @property
+    def healthy(self):
+        return self.lag is not None and self.lag <= max_replica_lag
 
 
 def init(config):
     global engine
     global dict_cursor
+    global ss_dict_cursor
     global Session
+    global max_replica_lag
+    global replica_check_interval
+    global replica_checker
 
-    engine = create_engine(config['db']['conn']['str'] % config['db']['conn']['kwargs'],
-                           **config['db']['kwargs'])
+    conn = config['db']['conn']
+    engine = create_engine(conn['str'] % conn['kwargs'], **config['db']['kwargs'])
     dict_cursor = engine.dialect.dbapi.cursors.DictCursor
+    ss_dict_cursor = engine.dialect.dbapi.cursors.SSDictCursor
     Session = sessionmaker(bind=engine)
+
+    # each replica only lists the connection kwargs that differ from the primary
+    del replicas[:]
+    for replica_kwargs in config['db'].get('replicas', []):
+        replica_conn_kwargs = dict(conn['kwargs'], **replica_kwargs)
+        replicas.append(Replica(create_engine(conn['str'] % replica_conn_kwargs, **config['db']['kwargs'])))
+    max_replica_lag = config['db'].get('max_replica_lag', max_replica_lag)
+    replica_check_interval = config['db'].get('replica_check_interval', replica_check_interval)
+    if replica_checker:
+        replica_checker.kill()
+    replica_checker = spawn(check_replicas) if replicas else None
+
+
+def check_replicas():
+    while True:
+        for replica in replicas:
+            replica.check()
+        sleep(replica_check_interval)
+
+
+def read_engine():
+    '''
+    Engine for reads that can be up to `max_replica_lag` seconds stale: a
+    random replica within that lag, or the primary if there is none. Replica
+    lag is checked in the background every `replica_check_interval` seconds.
+    '''
+    healthy = [replica for replica in replicas if replica.healthy]
+    if not healthy:
+        return engine
+    return random.choice(healthy).engine
@@ -12,7 +12,8 @@ metrics_provider = None
 
 
 def get_metrics_provider(config, app_name):
-    return import_custom_module('iris_api.metrics', config['metrics'])(config, app_name)
+    # without a configured backend, metrics are only logged at debug level
+    return import_custom_module('iris_api.metrics', config.get('metrics') or 'dummy')(config, app_name)
 
 
 def emit_metrics():
@@ -1,8 +1,10 @@
 # Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
 # See LICENSE in the project root for license information.
 
+from gevent.pool import Pool
 import requests
 from requests.exceptions import RequestException
+import time
 import logging
 
 logger = logging.getLogger()
@@ -13,9 +15,19 @@ class oncall(object):
         self.requests = requests.session()
         self.requests.verify = False
         self.endpoint = config['oncall-api'] + '/api/v0'
+        # on-call lookups only change at shift handoffs, so they are served
+        # from a snapshot that expires at the earliest end of the current
+        # shifts, capped at snapshot_max_ttl to pick up overrides
+        self.snapshot_max_ttl = config.get('oncall_snapshot_max_ttl', 1800)
+        self.prefetch_concurrency = config.get('oncall_prefetch_concurrency', 10)
+        # (team_name, oncall_type): (usernames, expires)
+        self.snapshot = {}
+        self.api_call_cnt = 0
+        self.snapshot_hit_cnt = 0
 
     def call_oncall(self, url):
         url = str(self.endpoint + url)
+        self.api_call_cnt += 1
         try:
             r = self.requests.get(url)
         except RequestException:
@@ -45,10 +57,38 @@ class oncall(object):
         return result['users']
 
     def team_oncall(self, team_name, oncall_type='primary'):
-        result = self.call_oncall('/teams/%s/oncall/%s' % (team_name, oncall_type))
+        key = (team_name, oncall_type)
+        snapshot = self.snapshot.get(key)
+        if snapshot and snapshot[1] > time.time():
+            self.snapshot_hit_cnt += 1
+            return list(snapshot[0])
+        return self.fetch_oncall(key)
+
+    def fetch_oncall(self, key):
+        now = time.time()
+        result = self.call_oncall('/teams/%s/oncall/%s' % key)
         if not result:
+            self.snapshot.pop(key, None)
             return None
-        return [user['username'] for user in result]
+        usernames = [user['username'] for user in result]
+        expires = now + self.snapshot_max_ttl
+        for user in result:
+            end = user.get('end')
+            if isinstance(end, (int, long, float)) and now < end < expires:
+                expires = end
+        self.snapshot[key] = (usernames, expires)
+        return usernames
+
+    def prefetch_oncall(self, teams):
+        '''
+        Concurrently fetch the on-call snapshot for (team_name, oncall_type)
+        pairs that aren't already cached.
+        '''
+        now = time.time()
+        expired = [key for key in set(teams) if self.snapshot.get(key, (None, 0))[1] <= now]
+        if expired:
+            Pool(self.prefetch_concurrency).map(self.fetch_oncall, expired)
+        return len(expired)
 
     def team_list(self):
         result = self.call_oncall('/teams')
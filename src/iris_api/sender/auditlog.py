@@ -9,6 +9,13 @@ MODE_CHANGE = 'mode-change'
 TARGET_CHANGE = 'target-change'
 SENT_CHANGE = 'sent-change'
 
+# change type: flag on the message, so listing messages doesn't have to look
+# through message_changelog
+change_flags = {
+    MODE_CHANGE: 'mode_changed',
+    TARGET_CHANGE: 'target_changed',
+}
+
 
 def message_change(message_id, change_type, old, new, description):
     if not message_id:
@@ -20,6 +27,9 @@ def message_change(message_id, change_type, old, new, description):
       INSERT INTO `message_changelog` (`message_id`, `change_type`, `old`, `new`, `description`, `date`)
       VALUES (:message_id, :change_type, :old, :new, :description, NOW())
     ''', dict(message_id=message_id, change_type=change_type, old=old, new=new, description=description))
+    if change_type in change_flags:
+        session.execute('UPDATE `message` SET `%s` = TRUE WHERE `id` = :message_id' % change_flags[change_type],
+                        {'message_id': message_id})
     session.commit()
     session.close()
     logger.info('Logged change information for message (ID %s)', message_id)
@@ -3,14 +3,19 @@
 
 from __future__ import absolute_import
 
-from collections import deque
+from collections import OrderedDict
+import math
+import sys
+import time
 import requests
 import jinja2
+import ujson
 from jinja2.sandbox import SandboxedEnvironment
 from gevent import spawn, sleep
 from gevent.pool import Pool
 from .message import update_message_mode
 from .. import db
+from ..change_log import ChangeLog
 from ..role_lookup import get_role_lookup
 from ..metrics import stats
 from . import auditlog
@@ -24,7 +29,12 @@ requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 logging.getLogger('requests').setLevel(logging.WARNING)
 
 
-iris_client = None
+default_cache_metrics = {
+    '%s_cache_%s' % (name, metric): 0
+    for name in ('incidents', 'roles', 'targets', 'plan_notifications', 'target_names')
+    for metric in ('hit_cnt', 'miss_cnt', 'expired_cnt', 'eviction_cnt', 'size', 'bytes')
+}
+
 plans = None
 templates = None
 incidents = None
@@ -34,53 +44,150 @@ plan_notifications = None
 target_reprioritization = None
 target_names = None
 targets_for_role = None
+change_log = None
+full_refresh_interval = 600
+last_full_refresh = 0
+
 
+def row_size(row):
+    # rough number of bytes held by a cached row
+    size = sys.getsizeof(row)
+    if isinstance(row, dict):
+        for key, value in row.iteritems():
+            size += sys.getsizeof(key) + sys.getsizeof(value)
+    return size
 
-class IrisClient(requests.Session):
-    def __init__(self, base, version=0):
-        super(IrisClient, self).__init__()
-        self.url = base + '/v%d/' % version
-        adapter = requests.adapters.HTTPAdapter(pool_connections=100, pool_maxsize=100)
-        self.mount('http://', adapter)
-        self.mount('https://', adapter)
 
-    def get(self, path, *args, **kwargs):
-        return super(IrisClient, self).get(self.url + path, *args, **kwargs)
+class Cache():
+    '''
+    Row cache keyed by the single parameter of `sql`.
 
-    def post(self, path, *args, **kwargs):
-        return super(IrisClient, self).post(self.url + path, *args, **kwargs)
+    Holds at most `max_size` rows, evicting the least recently used one, and
+    reloads rows older than `ttl` seconds. Hits, misses, evictions, the
+    number of rows and their approximate size in bytes are reported as
+    `<name>_cache_*` stats.
 
+    `many_sql` takes a tuple of keys and returns the rows for all of them,
+    which get_many uses to fill misses with a single query. Rows are matched
+    back to keys by their `key` column.
+    '''
 
-class Cache():
-    def __init__(self, engine, sql, active):
+    def __init__(self, engine, sql, active, name=None, max_size=None, ttl=None, many_sql=None, key='id'):
         self.engine = engine
         self.sql = sql
         self.active = active
-        self.data = {}
+        self.many_sql = many_sql
+        self.key = key
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        # key: (row, loaded, size), least recently used first
+        self.data = OrderedDict()
+        self.size = 0
 
     def __getitem__(self, key):
         try:
-            return self.data[key]
+            row, loaded, size = self.data.pop(key)
         except KeyError:
-            connection = self.engine.raw_connection()
-            cursor = connection.cursor(db.dict_cursor)
-            cursor.execute(self.sql, key)
-            ret = self.data[key] = cursor.fetchone()
-            cursor.close()
-            connection.close()
+            self.stat('miss_cnt')
+        else:
+            if self.ttl is None or time.time() - loaded < self.ttl:
+                self.data[key] = (row, loaded, size)
+                self.stat('hit_cnt')
+                return row
+            self.size -= size
+            self.stat('expired_cnt')
+        connection = self.engine.raw_connection()
+        cursor = connection.cursor(db.dict_cursor)
+        cursor.execute(self.sql, key)
+        ret = cursor.fetchone()
+        cursor.close()
+        connection.close()
+        self.add(key, ret)
+        return ret
+
+    def get_many(self, keys):
+        now = time.time()
+        ret = {}
+        missing = []
+        for key in set(keys):
+            cached = self.data.get(key)
+            if cached and (self.ttl is None or now - cached[1] < self.ttl):
+                ret[key] = self[key]
+            else:
+                missing.append(key)
+        if not missing:
+            return ret
+        if not self.many_sql:
+            for key in missing:
+                ret[key] = self[key]
             return ret
 
+        filled = 0
+        connection = self.engine.raw_connection()
+        cursor = connection.cursor(db.dict_cursor)
+        for idx in xrange(0, len(missing), 1000):
+            cursor.execute(self.many_sql, [tuple(missing[idx:idx + 1000])])
+            for row in cursor:
+                self.add(row[self.key], row)
+                ret[row[self.key]] = row
+                filled += 1
+        cursor.close()
+        connection.close()
+        self.stat('miss_cnt', filled)
+        # keys without an exact match fall back to the single row query
+        for key in missing:
+            if key not in ret:
+                ret[key] = self[key]
+        return ret
+
+    def add(self, key, row):
+        size = row_size(row)
+        self.discard(key)
+        self.data[key] = (row, time.time(), size)
+        self.size += size
+        if self.max_size is not None:
+            while len(self.data) > self.max_size:
+                self.size -= self.data.popitem(last=False)[1][2]
+                self.stat('eviction_cnt')
+        self.update_size_stats()
+
+    def discard(self, key):
+        cached = self.data.pop(key, None)
+        if cached:
+            self.size -= cached[2]
+
+    def stat(self, metric, count=1):
+        if self.name:
+            stats['%s_cache_%s' % (self.name, metric)] += count
+
+    def update_size_stats(self):
+        if self.name:
+            stats['%s_cache_size' % self.name] = len(self.data)
+            stats['%s_cache_bytes' % self.name] = self.size
+
     def purge(self):
         if self.data and self.active:
             connection = self.engine.raw_connection()
             cursor = connection.cursor()
             cursor.execute(self.active, [tuple(self.data)])
             for key in self.data.viewkeys() - {row[0] for row in cursor}:
-                del self.data[key]
+                self.size -= self.data.pop(key)[2]
             cursor.close()
             connection.close()
 
 
+def load_active(engine, sql, names=None):
+    # id: name of the active templates or plans, optionally only those named
+    connection = engine.raw_connection()
+    cursor = connection.cursor()
+    cursor.execute(sql, None if names is None else [tuple(names)])
+    active = dict(cursor)
+    cursor.close()
+    connection.close()
+    return active
+
+
 class Templates():
     def __init__(self, engine):
         # Autoescape needs to be False to avoid html-encoding ampersands in emails. This
@@ -159,9 +266,7 @@ class Templates():
     def refresh(self):
         logger.info('refreshing templates')
 
-        templates_response = iris_client.get('templates/?active=1&fields=id&fields=name').json()
-
-        active = {item['id']: item['name'] for item in templates_response}
+        active = load_active(self.engine, 'SELECT `template_id`, `name` FROM `template_active`')
 
         new_active_ids = active.viewkeys()
         old_active_ids = self.active.viewkeys()
@@ -179,8 +284,40 @@ class Templates():
 
         self.active = active
 
+    def refresh_changed(self, names):
+        logger.info('refreshing changed templates: %s', ', '.join(names))
+        active = load_active(self.engine,
+                             'SELECT `template_id`, `name` FROM `template_active` WHERE `name` IN %s', names)
+        for template_id, name in self.active.items():
+            if name in names:
+                del self.active[template_id]
+        for name in names:
+            self.data.pop(name, None)
+        self.active.update(active)
+        for name in active.itervalues():
+            self[name]
+
 
 class Plans():
+    '''
+    Plans keyed by id, loaded straight from the database. Any number of plans
+    are loaded with two queries: one for the plans and one for their steps.
+    '''
+
+    plans_sql = '''SELECT `plan`.`id` as `id`, `plan`.`name` as `name`,
+        `plan`.`threshold_window` as `threshold_window`, `plan`.`threshold_count` as `threshold_count`,
+        `plan`.`aggregation_window` as `aggregation_window`, `plan`.`aggregation_reset` as `aggregation_reset`,
+        `plan`.`description` as `description`, UNIX_TIMESTAMP(`plan`.`created`) as `created`,
+        `target`.`name` as `creator`, IF(`plan_active`.`plan_id` IS NULL, FALSE, TRUE) as `active`,
+        `plan`.`tracking_type` as `tracking_type`, `plan`.`tracking_key` as `tracking_key`,
+        `plan`.`tracking_template` as `tracking_template`
+    FROM `plan` JOIN `target` ON `plan`.`user_id` = `target`.`id`
+    LEFT OUTER JOIN `plan_active` ON `plan`.`id` = `plan_active`.`plan_id`
+    WHERE `plan`.`id` IN %s'''
+
+    steps_sql = '''SELECT `plan_id`, `step`, `id` FROM `plan_notification`
+    WHERE `plan_id` IN %s ORDER BY `plan_id`, `step`'''
+
     def __init__(self, engine):
         self.engine = engine
         self.active = {}
@@ -191,41 +328,54 @@ class Plans():
         try:
             return self.data[key]
         except KeyError:
-            fields = ['threshold_window', 'threshold_count', 'aggregation_window', 'creator',
-                      'aggregation_reset', 'name', 'tracking_type', 'tracking_key', 'tracking_template']
-            plan = iris_client.get('plans/%s/' % key, params={'fields': fields}).json()
-            logger.debug('[+] adding plan: %s', key)
+            return self.load([key])[key]
 
+    def load(self, plan_ids):
+        loaded = {}
+        plan_ids = list(plan_ids)
+        if not plan_ids:
+            return loaded
+        connection = self.engine.raw_connection()
+        cursor = connection.cursor(db.dict_cursor)
+        for start in xrange(0, len(plan_ids), 1000):
+            chunk = tuple(plan_ids[start:start + 1000])
+            cursor.execute(self.plans_sql, [chunk])
+            plans = {plan['id']: plan for plan in cursor}
             steps = {}
-            for idx, notifications in enumerate(plan['steps']):
-                steps[idx + 1] = [n['id'] for n in notifications]
-            plan['steps'] = steps
-
-            if plan['tracking_template']:
-                tracking_template = plan['tracking_template']
-                if plan['tracking_type'] == 'email':
-                    for application, application_templates in tracking_template.iteritems():
-                        tracking_template[application] = {
-                            'email_subject': self.template_env.from_string(application_templates['email_subject']),
-                            'email_text': self.template_env.from_string(application_templates['email_text']),
-                        }
-                        html_template = application_templates.get('email_html')
-                        if html_template:
-                            tracking_template[application]['email_html'] = self.template_env.from_string(html_template)
-                    plan['tracking_template'] = tracking_template
-                else:
-                    # not supported type, set to None
-                    plan['tracking_template'] = None
-
-            self.data[key] = plan
-            return plan
+            cursor.execute(self.steps_sql, [chunk])
+            for plan_id, step, notification_id in ((n['plan_id'], n['step'], n['id']) for n in cursor):
+                steps.setdefault(plan_id, OrderedDict()).setdefault(step, []).append(notification_id)
+            for plan_id, plan in plans.iteritems():
+                logger.debug('[+] adding plan: %s', plan_id)
+                # steps are numbered from 1 in order, as the API returns them
+                plan['steps'] = {idx + 1: ids for idx, ids in enumerate(steps.get(plan_id, {}).itervalues())}
+                plan['tracking_template'] = self.compile_tracking_template(plan)
+                loaded[plan_id] = self.data[plan_id] = plan
+        cursor.close()
+        connection.close()
+        return loaded
+
+    def compile_tracking_template(self, plan):
+        if not plan['tracking_template']:
+            return None
+        if plan['tracking_type'] != 'email':
+            # not supported type
+            return None
+        tracking_template = ujson.loads(plan['tracking_template'])
+        for application, application_templates in tracking_template.iteritems():
+            tracking_template[application] = {
+                'email_subject': self.template_env.from_string(application_templates['email_subject']),
+                'email_text': self.template_env.from_string(application_templates['email_text']),
+            }
+            html_template = application_templates.get('email_html')
+            if html_template:
+                tracking_template[application]['email_html'] = self.template_env.from_string(html_template)
+        return tracking_template
 
     def refresh(self):
         logger.info('refreshing plans')
 
-        plans_response = iris_client.get('plans/?active=1&fields=id&fields=name').json()
-
-        active = {item['id']: item['name'] for item in plans_response}
+        active = load_active(self.engine, 'SELECT `plan_id`, `name` FROM `plan_active`')
 
         new_active_ids = active.viewkeys()
         old_active_ids = self.active.viewkeys()
@@ -239,77 +389,160 @@ class Plans():
             except KeyError:
                 logger.exception('Failed pruning old plan_id %s', plan_id)
 
-        Pool(30).map(self.__getitem__, (active[id] for id in new_ids))
+        self.load(new_ids - self.data.viewkeys())
 
         self.active = active
 
+    def refresh_changed(self, names):
+        logger.info('refreshing changed plans: %s', ', '.join(names))
+        active = load_active(self.engine, 'SELECT `plan_id`, `name` FROM `plan_active` WHERE `name` IN %s', names)
+        for plan_id, name in self.active.items():
+            if name in names and plan_id not in active:
+                del self.active[plan_id]
+                self.data.pop(plan_id, None)
+        self.load(active.viewkeys() - self.data.viewkeys())
+        self.active.update(active)
+
+
+class RateCounter(object):
+    '''
+    Counts events over the last `duration` seconds in a ring of buckets
+    `resolution` seconds wide. The ring is advanced by elapsed time whenever
+    it is touched, and a running total is kept, so adding and reading are
+    O(1).
+    '''
+
+    def __init__(self, duration, resolution):
+        self.duration = duration
+        self.resolution = resolution
+        self.buckets = [0] * max(int(math.ceil(float(duration) / resolution)), 1)
+        self.idx = 0
+        self.tick = int(time.time() // resolution)
+        self.total = 0
+
+    def advance(self, now):
+        tick = int(now // self.resolution)
+        steps = tick - self.tick
+        if steps <= 0:
+            return
+        self.tick = tick
+        if steps >= len(self.buckets):
+            self.buckets = [0] * len(self.buckets)
+            self.total = 0
+            return
+        for _ in xrange(steps):
+            self.idx = (self.idx + 1) % len(self.buckets)
+            self.total -= self.buckets[self.idx]
+            self.buckets[self.idx] = 0
+
+    def add(self, now=None):
+        self.advance(time.time() if now is None else now)
+        self.buckets[self.idx] += 1
+        self.total += 1
+        return self.total
+
+    def count(self, now=None):
+        self.advance(time.time() if now is None else now)
+        return self.total
+
+    def resize(self, duration):
+        '''
+        Returns a counter over `duration` that keeps the most recent counts.
+        '''
+        counter = RateCounter(duration, self.resolution)
+        self.advance(time.time())
+        size = len(counter.buckets)
+        # oldest to newest, ending at the current bucket
+        recent = [self.buckets[(self.idx - i) % len(self.buckets)]
+                  for i in reversed(xrange(min(size, len(self.buckets))))]
+        counter.buckets[:len(recent)] = recent
+        counter.idx = len(recent) - 1
+        counter.tick = self.tick
+        counter.total = sum(recent)
+        return counter
+
 
 class TargetReprioritization(object):
-    def __init__(self, engine):
+    '''
+    Reprioritization rules, updated for the targets named in the change log
+    and fully reloaded every `reload_interval` seconds as a fallback.
+    '''
+
+    rules_sql = '''SELECT
+        `target`.`name`,
+        `src_mode`.`name`,
+        `dst_mode`.`name`,
+        `target_contact`.`destination`,
+        `target_reprioritization`.`count`,
+        `target_reprioritization`.`duration`
+    FROM `target_reprioritization`
+    JOIN `target` ON `target_reprioritization`.`target_id` = `target`.`id`
+    JOIN `mode` as `src_mode` ON `target_reprioritization`.`src_mode_id` = `src_mode`.`id`
+    JOIN `mode` as `dst_mode` ON `target_reprioritization`.`dst_mode_id` = `dst_mode`.`id`
+    JOIN `target_contact` ON `target_contact`.`target_id`=`target`.`id` AND `target_contact`.`mode_id` = `dst_mode`.`id`'''
+
+    def __init__(self, engine, resolution=5, reload_interval=3600):
         self.engine = engine
-        # (target, src_mode): (dst_mode, destination, count, deque)
+        self.resolution = resolution
+        self.reload_interval = reload_interval
+        # (target, src_mode): (dst_mode, destination, count, RateCounter)
         self.rates = {}
 
     def refresh(self):
         while True:
-            rates = {}
-            connection = db.engine.raw_connection()
-            cursor = connection.cursor()
-            cursor.execute(
-                '''SELECT
-                    `target`.`name`,
-                    `src_mode`.`name`,
-                    `dst_mode`.`name`,
-                    `target_contact`.`destination`,
-                    `target_reprioritization`.`count`,
-                    `target_reprioritization`.`duration`
-                FROM `target_reprioritization`
-                JOIN `target` ON `target_reprioritization`.`target_id` = `target`.`id`
-                JOIN `mode` as `src_mode` ON `target_reprioritization`.`src_mode_id` = `src_mode`.`id`
-                JOIN `mode` as `dst_mode` ON `target_reprioritization`.`dst_mode_id` = `dst_mode`.`id`
-                JOIN `target_contact` ON `target_contact`.`target_id`=`target`.`id` AND `target_contact`.`mode_id` = `dst_mode`.`id`'''
-            )
-            for target, src_mode, dst_mode, destination, count, duration in cursor:
-                if destination is None:
-                    logger.info('invalid target reprioritization rule (%s, %s): (%s, %s, %d, %d)',
-                                target, src_mode, dst_mode, destination, count, duration)
-                    continue
-                rates[(target, src_mode)] = (dst_mode, destination, count, duration / 60)
+            self.load_rules()
+            sleep(self.reload_interval)
+
+    def load_rules(self, targets=None):
+        '''
+        Reload the rules of `targets`, or of every target if it is None.
+        '''
+        rates = {}
+        # changed targets are reloaded from the primary, right after the change
+        connection = (db.read_engine() if targets is None else db.engine).raw_connection()
+        cursor = connection.cursor()
+        if targets is None:
+            cursor.execute(self.rules_sql)
+        else:
+            cursor.execute(self.rules_sql + ' WHERE `target`.`name` IN %s', [tuple(targets)])
+        for target, src_mode, dst_mode, destination, count, duration in cursor:
+            if destination is None:
+                logger.info('invalid target reprioritization rule (%s, %s): (%s, %s, %d, %d)',
+                            target, src_mode, dst_mode, destination, count, duration)
+                continue
+            rates[(target, src_mode)] = (dst_mode, destination, count, duration)
 
-            cursor.close()
-            connection.close()
+        cursor.close()
+        connection.close()
 
-            current = rates.viewkeys()
+        current = rates.viewkeys()
+        if targets is None:
             old = self.rates.viewkeys()
-
-            # purge old rate entries
-            for key in old - current:
-                logger.debug('deleting target reprioritization rule for %r: %r', key, self.rates[key])
-                del self.rates[key]
-
-            # new rate entries:
-            for key in current - old:
-                logger.debug('creating target reprioritization rule for %r: %r', key, rates[key])
-                dst_mode, destination, count, duration_min = rates[key]
-                self.rates[key] = (dst_mode, destination, count, deque([0] * duration_min, maxlen=duration_min))
-
-            # loop through existing entries
-            # if the settings have changed, gracefully alter them
-            # either way, push in a new bucket
-            for key in current & old:
-                current_dst_mode, current_destination, current_count, current_duration_min = rates[key]
-                old_dst_mode, old_destination, old_count, old_buckets = self.rates[key]
-                if old_dst_mode != current_dst_mode or old_destination != current_destination or old_count != current_count or len(old_buckets) != current_duration_min:  # noqa FIXME: refactor this line
-                    logger.debug('updating target reprioritization rule for %r: %r | %r', key, self.rates[key], rates[key])
-                    # create a new bucket truncating if it's smaller and growing if it is larger, while preserving the counts
-                    current_buckets = deque(old_buckets, maxlen=current_duration_min)
-                    self.rates[key] = (current_dst_mode, current_destination, current_count, current_buckets)
-                # add the new interval bucket to each
-                self.rates[key][-1].append(0)
-
-            logger.info('refreshed target reprioritization rules: %d', len(self.rates))
-            logger.debug(self.rates)
-            sleep(60)
+        else:
+            old = {key for key in self.rates if key[0] in targets}
+
+        # purge old rate entries
+        for key in old - current:
+            logger.debug('deleting target reprioritization rule for %r: %r', key, self.rates[key])
+            del self.rates[key]
+
+        # new rate entries:
+        for key in current - old:
+            logger.debug('creating target reprioritization rule for %r: %r', key, rates[key])
+            dst_mode, destination, count, duration = rates[key]
+            self.rates[key] = (dst_mode, destination, count, RateCounter(duration, self.resolution))
+
+        # if the settings of existing entries have changed, gracefully alter
+        # them while keeping their counts
+        for key in current & old:
+            current_dst_mode, current_destination, current_count, current_duration = rates[key]
+            old_dst_mode, old_destination, old_count, counter = self.rates[key]
+            if old_dst_mode != current_dst_mode or old_destination != current_destination or old_count != current_count or counter.duration != current_duration:  # noqa FIXME: refactor this line
+                logger.debug('updating target reprioritization rule for %r: %r | %r', key, self.rates[key], rates[key])
+                self.rates[key] = (current_dst_mode, current_destination, current_count, counter.resize(current_duration))
+
+        logger.info('refreshed target reprioritization rules: %d', len(rates))
+        logger.debug(self.rates)
 
     def __call__(self, message, seen=None):
         if seen is None:
@@ -322,14 +555,12 @@ class TargetReprioritization(object):
             else:
                 seen.add(message['mode'])
         try:
-            dst_mode, destination, count, buckets = self.rates[(message['target'], message['mode'])]
+            dst_mode, destination, count, counter = self.rates[(message['target'], message['mode'])]
             logger.debug('reprioritization (%s, %s): (%s, %s, %d, %r)',
-                         message['target'], message['mode'], dst_mode, destination, count, buckets)
-            # increment the bucket for this minute
-            buckets[-1] += 1
-            if sum(buckets) > count:
+                         message['target'], message['mode'], dst_mode, destination, count, counter.buckets)
+            if counter.add() > count:
                 logger.debug('target reprioritization rule triggered (%s, %s): (%s, %s, %d, %r)',
-                             message['target'], message['mode'], dst_mode, destination, count, buckets)
+                             message['target'], message['mode'], dst_mode, destination, count, counter.buckets)
                 # sum of all counts for duration exceeds count
                 # reprioritize to destination mode
                 old_mode = message['mode']
@@ -346,46 +577,106 @@ class TargetReprioritization(object):
             return
 
 
+def oncall_type(role):
+    return 'primary' if role == 'oncall' else role[7:]
+
+
 class RoleTargets():
-    def __init__(self, role_lookup, engine):
+    '''
+    Expands role:target pairs to target names.
+
+    Entries are fresh for `ttl` seconds. After that they are still served for
+    up to `stale_ttl` seconds while a background greenlet looks them up again,
+    so a slow or unavailable role lookup doesn't hold up the sender. Failed
+    lookups are cached for `negative_ttl` seconds; if an expansion that is
+    still within its stale window exists it keeps being served instead.
+    '''
+
+    def __init__(self, role_lookup, engine, ttl=60, stale_ttl=3600, negative_ttl=30):
+        # (role, target): (names, expires, stale_until)
         self.data = {}
+        self.refreshing = set()
         self.role_lookup = role_lookup
         self.engine = engine
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.negative_ttl = negative_ttl
         self.active_targets = set()
         self.initialize_active_targets()
 
     def __call__(self, role, target):
+        key = (role, target)
+        now = time.time()
         try:
-            return self.data[(role, target)]
+            names, expires, stale_until = self.data[key]
         except KeyError:
-            names = []
-            if role == 'user':
-                names = [target]
-            elif role == 'team':
+            stats['role_target_cache_miss_cnt'] += 1
+            names = self.refresh(key)
+        else:
+            if now >= expires:
+                if names is None or now >= stale_until:
+                    stats['role_target_cache_miss_cnt'] += 1
+                    names = self.refresh(key)
+                else:
+                    stats['role_target_cache_stale_cnt'] += 1
+                    if key not in self.refreshing:
+                        self.refreshing.add(key)
+                        spawn(self.background_refresh, key)
+            elif names is None:
+                stats['role_target_cache_negative_hit_cnt'] += 1
+            else:
+                stats['role_target_cache_hit_cnt'] += 1
+
+        if names is None:
+            return None
+        return self.prune_inactive_targets(names)
+
+    def lookup(self, role, target):
+        if role == 'user':
+            return [target]
+        try:
+            if role == 'team':
                 names = self.role_lookup.team_members(target)
-                if names is None:
-                    stats['oncall_error'] += 1
-                    return None
             elif role == 'manager':
                 names = self.role_lookup.team_manager(target)
-                if names is None:
-                    stats['oncall_error'] += 1
-                    return None
             elif role.startswith('oncall'):
-                names = self.role_lookup.team_oncall(target, 'primary' if role == 'oncall' else role[7:])
-                if names is None:
-                    stats['oncall_error'] += 1
-                    return None
+                names = self.role_lookup.team_oncall(target, oncall_type(role))
             else:
-                names = []
-
-            names = self.prune_inactive_targets(names)
-
-            self.data[(role, target)] = names
+                return []
+        except Exception:
+            logger.exception('Failed looking up %s:%s', role, target)
+            names = None
+        if names is None:
+            stats['oncall_error'] += 1
+        return names
+
+    def refresh(self, key):
+        names = self.lookup(*key)
+        now = time.time()
+        if names is not None:
+            names = frozenset(names)
+            self.data[key] = (names, now + self.ttl, now + self.ttl + self.stale_ttl)
             return names
+        # keep serving the last good expansion and retry it later
+        old_names, expires, stale_until = self.data.get(key, (None, now, now))
+        if old_names is not None and now < stale_until:
+            self.data[key] = (old_names, now + self.negative_ttl, stale_until)
+            return old_names
+        self.data[key] = (None, now + self.negative_ttl, now + self.negative_ttl)
+        return None
+
+    def background_refresh(self, key):
+        # only the greenlet that set the refreshing marker clears it
+        try:
+            self.refresh(key)
+        finally:
+            self.refreshing.discard(key)
 
     def purge(self):
-        self.data = {}
+        now = time.time()
+        for key, (names, expires, stale_until) in self.data.items():
+            if now >= stale_until:
+                del self.data[key]
         self.initialize_active_targets()
 
     def prune_inactive_targets(self, usernames):
@@ -402,39 +693,108 @@ class RoleTargets():
         connection.close()
 
 
+def prefetch_oncall():
+    role_lookup = targets_for_role.role_lookup
+    if not hasattr(role_lookup, 'prefetch_oncall'):
+        return
+    connection = db.read_engine().raw_connection()
+    cursor = connection.cursor()
+    cursor.execute('''SELECT DISTINCT `target_role`.`name`, `target`.`name`
+                      FROM `plan_notification`
+                      JOIN `plan_active` ON `plan_notification`.`plan_id` = `plan_active`.`plan_id`
+                      JOIN `target_role` ON `plan_notification`.`role_id` = `target_role`.`id`
+                      JOIN `target` ON `plan_notification`.`target_id` = `target`.`id`
+                      WHERE `target_role`.`name` LIKE 'oncall%' ''')
+    teams = [(target, oncall_type(role)) for role, target in cursor]
+    cursor.close()
+    connection.close()
+    fetched = role_lookup.prefetch_oncall(teams)
+    logger.info('prefetched on-call for %d of %d teams in active plans', fetched, len(teams))
+
+
+def targets_changed(names):
+    # targets were added, deactivated or renamed
+    for key, (row, loaded, size) in targets.data.items():
+        if row and row['name'] in names:
+            targets.discard(key)
+    for name in names:
+        target_names.discard(name)
+    targets_for_role.initialize_active_targets()
+    # rules follow the target's contact for the destination mode
+    target_reprioritization.load_rules(names)
+
+
 def refresh():
-    plans.refresh()
-    templates.refresh()
+    global last_full_refresh
+    change_log.dispatch()
+    # plans and templates written outside the API don't always publish to
+    # the change log, so the active ones are also relisted periodically
+    now = time.time()
+    if now - last_full_refresh >= full_refresh_interval:
+        last_full_refresh = now
+        plans.refresh()
+        templates.refresh()
+    try:
+        prefetch_oncall()
+    except Exception:
+        logger.exception('Failed prefetching on-call snapshot')
 
 
 def purge():
     target_names.purge()
     targets_for_role.purge()
     incidents.purge()
+    for row_cache in (incidents, roles, targets, plan_notifications, target_names):
+        row_cache.update_size_stats()
 
 
 def init(config):
     global targets_for_role, target_names, target_reprioritization, plan_notifications, targets
-    global roles, incidents, templates, plans, iris_client
+    global roles, incidents, templates, plans, change_log
+    global full_refresh_interval, last_full_refresh
 
-    iris_client = IrisClient(config['sender'].get('api_host', 'http://localhost:16649'))
     plans = Plans(db.engine)
     templates = Templates(db.engine)
+    cache_kwargs = {'max_size': config['sender'].get('cache_max_size', 10000),
+                    'ttl': config['sender'].get('cache_ttl', 3600)}
     incidents = Cache(db.engine,
                       'SELECT * FROM `incident` WHERE `id`=%s',
-                      'SELECT `id` from `incident` WHERE `active`=True AND `id` IN %s')
-    roles = Cache(db.engine, 'SELECT * FROM `target_role` WHERE `id`=%s', None)
+                      'SELECT `id` from `incident` WHERE `active`=True AND `id` IN %s',
+                      'incidents', many_sql='SELECT * FROM `incident` WHERE `id` IN %s', **cache_kwargs)
+    roles = Cache(db.engine, 'SELECT * FROM `target_role` WHERE `id`=%s', None, 'roles',
+                  many_sql='SELECT * FROM `target_role` WHERE `id` IN %s', **cache_kwargs)
     # TODO: purge based on target acive column?
-    targets = Cache(db.engine, 'SELECT * FROM `target` WHERE `id`=%s', None)
+    targets = Cache(db.engine, 'SELECT * FROM `target` WHERE `id`=%s', None, 'targets',
+                    many_sql='SELECT * FROM `target` WHERE `id` IN %s', **cache_kwargs)
     # TODO: also purge this cache?
     plan_notifications = Cache(db.engine,
                                'SELECT * FROM `plan_notification` WHERE `id`=%s',
                                ('SELECT `plan_notification`.`id` FROM `plan_notification` '
                                 'JOIN `plan_active` ON `plan_notification`.`plan_id` = `plan_active`.`plan_id` '
-                                'AND `plan_notification`.`id` IN %s'))
-    target_reprioritization = TargetReprioritization(db.engine)
-    target_names = Cache(db.engine, 'SELECT * FROM `target` WHERE `name`=%s', None)
+                                'AND `plan_notification`.`id` IN %s'),
+                               'plan_notifications', many_sql='SELECT * FROM `plan_notification` WHERE `id` IN %s',
+                               **cache_kwargs)
+    target_reprioritization = TargetReprioritization(
+        db.engine, config['sender'].get('reprioritization_resolution', 5),
+        config['sender'].get('reprioritization_reload_interval', 3600))
+    target_names = Cache(db.engine, 'SELECT * FROM `target` WHERE `name`=%s', None, 'target_names',
+                         many_sql='SELECT * FROM `target` WHERE `name` IN %s', key='name', **cache_kwargs)
     role_lookup = get_role_lookup(config)
-    targets_for_role = RoleTargets(role_lookup, db.engine)
+    role_targets_kwargs = {}
+    for key, option in (('ttl', 'role_target_ttl'), ('stale_ttl', 'role_target_stale_ttl'),
+                        ('negative_ttl', 'role_target_negative_ttl')):
+        if option in config['sender']:
+            role_targets_kwargs[key] = int(config['sender'][option])
+    targets_for_role = RoleTargets(role_lookup, db.engine, **role_targets_kwargs)
+
+    full_refresh_interval = config['sender'].get('cache_refresh_interval', full_refresh_interval)
+    # the first change log poll loads everything
+    last_full_refresh = time.time()
+    change_log = ChangeLog(db.engine)
+    change_log.subscribe('plan', plans.refresh_changed, plans.refresh)
+    change_log.subscribe('template', templates.refresh_changed, templates.refresh)
+    change_log.subscribe('target', targets_changed, targets_for_role.initialize_active_targets)
+    change_log.subscribe('target_reprioritization', target_reprioritization.load_rules,
+                         target_reprioritization.load_rules)
 
     spawn(target_reprioritization.refresh)
@@ -0,0 +1,192 @@
+# Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
+# See LICENSE in the project root for license information.
+
+from __future__ import absolute_import
+
+from collections import deque
+from gevent import socket
+from gevent.lock import BoundedSemaphore
+from gevent.select import select
+import time
+import msgpack
+from ..metrics import stats
+from ..utils import MsgpackFramedSocket, MsgpackFrameError, default_max_frame_size
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+default_pool_metrics = {
+    'sender_pool_request_cnt': 0, 'sender_pool_request_fail_cnt': 0, 'sender_pool_connect_cnt': 0,
+    'sender_pool_connect_fail_cnt': 0, 'sender_pool_reuse_cnt': 0, 'sender_pool_stale_cnt': 0,
+    'sender_pool_failover_cnt': 0, 'sender_pool_idle': 0, 'sender_pool_in_use': 0,
+}
+
+
+class SenderConnectionClosed(socket.error):
+    pass
+
+
+class SenderConnectionStale(socket.error):
+    '''
+    Raised when a request couldn't be written, so the sender never saw it
+    and it is safe to retry.
+    '''
+    pass
+
+
+class SenderConnection(object):
+    def __init__(self, address, timeout, max_frame_size=None):
+        self.address = address
+        self.socket = MsgpackFramedSocket(socket.create_connection(address, timeout), max_frame_size)
+        self.last_used = time.time()
+        self.request_cnt = 0
+
+    def request(self, payload):
+        self.request_cnt += 1
+        try:
+            self.socket.send_packed(payload)
+        except socket.error as e:
+            raise SenderConnectionStale('Failed sending to %s:%s: %s' % (self.address + (e,)))
+        try:
+            resp = self.socket.recv()
+        except MsgpackFrameError as e:
+            raise SenderConnectionClosed('Invalid response from sender %s:%s: %s' % (self.address + (e,)))
+        if resp is None:
+            raise SenderConnectionClosed('Connection to %s:%s closed by sender' % self.address)
+        self.last_used = time.time()
+        return resp
+
+    def idle_closed(self):
+        '''
+        Whether an idle connection was closed by the sender. Nothing is sent
+        to an idle connection, so any readable data or EOF means it is
+        unusable.
+        '''
+        try:
+            return bool(self.socket.buffered or select([self.socket.socket], [], [], 0)[0])
+        except socket.error:
+            return True
+
+    def close(self):
+        try:
+            self.socket.close()
+        except socket.error:
+            pass
+
+
+class SenderConnectionPool(object):
+    '''
+    Per process pool of persistent connections to the sender RPC server.
+
+    Addresses are tried in order, so the first one is the preferred sender and
+    the rest are only used when it can't be reached. An address that fails to
+    connect is skipped for `down_interval` seconds unless every address is
+    down.
+    '''
+
+    def __init__(self, addresses, size=10, timeout=30, idle_timeout=30, down_interval=30, max_frame_size=None):
+        self.addresses = addresses
+        self.timeout = timeout
+        self.max_frame_size = max_frame_size or default_max_frame_size
+        self.idle_timeout = idle_timeout
+        self.down_interval = down_interval
+        self.size = size
+        self.slots = BoundedSemaphore(size)
+        self.idle = deque()
+        self.down = {}
+        self.in_use = 0
+
+    def connect(self):
+        now = time.time()
+        up = [address for address in self.addresses
+              if now - self.down.get(address, 0) > self.down_interval]
+        for address in up or self.addresses:
+            try:
+                connection = SenderConnection(address, self.timeout, self.max_frame_size)
+            except socket.error:
+                logger.exception('Failed connecting to sender %s:%s', *address)
+                stats['sender_pool_connect_fail_cnt'] += 1
+                self.down[address] = time.time()
+                continue
+            self.down.pop(address, None)
+            stats['sender_pool_connect_cnt'] += 1
+            if address != self.addresses[0]:
+                stats['sender_pool_failover_cnt'] += 1
+            return connection
+        raise socket.error('Failed connecting to all senders: %s' % ', '.join('%s:%s' % a for a in self.addresses))
+
+    def get_connection(self):
+        now = time.time()
+        while self.idle:
+            connection = self.idle.pop()
+            if now - connection.last_used < self.idle_timeout:
+                if connection.idle_closed():
+                    stats['sender_pool_stale_cnt'] += 1
+                    connection.close()
+                    continue
+                stats['sender_pool_reuse_cnt'] += 1
+                return connection
+            connection.close()
+        return self.connect()
+
+    def release(self, connection):
+        self.idle.append(connection)
+
+    def request(self, req):
+        payload = msgpack.packb(req)
+        if len(payload) > self.max_frame_size:
+            raise MsgpackFrameError('Request of %d bytes exceeds max frame size %d' % (len(payload), self.max_frame_size))
+        stats['sender_pool_request_cnt'] += 1
+        with self.slots:
+            self.in_use += 1
+            try:
+                return self._request(payload)
+            except socket.error:
+                stats['sender_pool_request_fail_cnt'] += 1
+                raise
+            finally:
+                self.in_use -= 1
+                stats['sender_pool_in_use'] = self.in_use
+                stats['sender_pool_idle'] = len(self.idle)
+
+    def _request(self, payload):
+        while True:
+            connection = self.get_connection()
+            try:
+                resp = connection.request(payload)
+            except SenderConnectionStale:
+                connection.close()
+                # The sender drops connections that sat idle for too long, so
+                # a pooled connection that can't be written to is retried on a
+                # fresh one rather than failing the request. Failures after the
+                # request was written are not retried, since the sender may
+                # already have acted on it.
+                if connection.request_cnt > 1:
+                    stats['sender_pool_stale_cnt'] += 1
+                    continue
+                raise
+            except socket.error:
+                connection.close()
+                raise
+            self.release(connection)
+            return resp
+
+    def close(self):
+        while self.idle:
+            self.idle.pop().close()
+
+
+def init_sender_pool(sender_config):
+    addresses = [(sender_config['host'], sender_config['port'])]
+    addresses += [(sender['host'], sender['port']) for sender in sender_config.get('api_failover', [])]
+    kwargs = {}
+    for key, option in (('size', 'api_pool_size'), ('timeout', 'api_rpc_timeout'),
+                        ('idle_timeout', 'api_pool_idle_timeout'), ('max_frame_size', 'rpc_max_frame_size')):
+        if option in sender_config:
+            try:
+                kwargs[key] = int(sender_config[option])
+            except ValueError:
+                logger.exception('Failed parsing %s in config', option)
+    logger.info('Sender pool configured with: %s', ', '.join('%s:%s' % address for address in addresses))
+    return SenderConnectionPool(addresses, **kwargs)
@@ -8,7 +8,7 @@ from gevent.server import StreamServer
 from itertools import cycle
 import msgpack
 from ..metrics import stats
-from ..utils import msgpack_unpack_msg_from_socket
+from ..utils import MsgpackFramedSocket, MsgpackFrameError
 from . import cache
 from .shared import send_queue
 
@@ -20,6 +20,8 @@ sender_slaves = None
 num_slaves = 0
 send_funcs = {}
 rpc_timeout = None
+rpc_idle_timeout = None
+rpc_max_frame_size = None
 
 
 def msgpack_handle_sets(obj):
@@ -42,11 +44,11 @@ def send_message_to_slave(message, address):
     pretty_address = '%s:%s' % address
     message_id = message.get('message_id', '?')
     try:
-        s = socket.create_connection(address)
-        s.send(payload)
-        sender_resp = msgpack_unpack_msg_from_socket(s)
-        s.close()
-    except socket.error:
+        connection = MsgpackFramedSocket(socket.create_connection(address), rpc_max_frame_size)
+        connection.send_packed(payload)
+        sender_resp = connection.recv()
+        connection.close()
+    except (socket.error, MsgpackFrameError):
         logging.exception('Failed connecting to %s to send message (ID %s)', pretty_address, message_id)
         stats['rpc_message_pass_fail_cnt'] += 1
         return False
@@ -62,7 +64,7 @@ def send_message_to_slave(message, address):
 
 
 def init(sender_config, _send_funcs):
-    global sender_slaves, num_slaves, rpc_timeout
+    global sender_slaves, num_slaves, rpc_timeout, rpc_idle_timeout, rpc_max_frame_size
 
     send_funcs.update(_send_funcs)
 
@@ -74,6 +76,20 @@ def init(sender_config, _send_funcs):
         rpc_timeout = default_rpc_timeout
     logger.info('RPC timeout is set to %s seconds', rpc_timeout)
 
+    default_rpc_idle_timeout = 60
+    try:
+        rpc_idle_timeout = int(sender_config.get('rpc_idle_timeout', default_rpc_idle_timeout))
+    except ValueError:
+        logger.exception('Failed parsing rpc_idle_timeout in config')
+        rpc_idle_timeout = default_rpc_idle_timeout
+
+    try:
+        rpc_max_frame_size = int(sender_config['rpc_max_frame_size'])
+    except KeyError:
+        pass
+    except ValueError:
+        logger.exception('Failed parsing rpc_max_frame_size in config')
+
     if not sender_config.get('is_master'):
         return
 
@@ -86,27 +102,25 @@ def init(sender_config, _send_funcs):
         logger.info('Sender configured with no slaves')
 
 
-def reject_api_request(socket, address, err_msg):
+def reject_api_request(connection, address, err_msg):
     logger.info('-> %s %s', address, err_msg)
-    socket.sendall(msgpack.packb(err_msg))
+    connection.send(err_msg)
 
 
-def handle_api_notification_request(socket, address, req):
-    notification = req['data']
+def queue_notification(address, notification, expand_targets):
+    # Returns None once the notification is queued, or the reason it was
+    # rejected.
     notification['subject'] = '[%(application)s] %(subject)s' % notification
     role = notification.get('role')
     if not role:
-        reject_api_request(socket, address, 'INVALID role')
-        return
+        return 'INVALID role'
     target = notification.get('target')
     if not target:
-        reject_api_request(socket, address, 'INVALID target')
-        return
+        return 'INVALID target'
 
-    expanded_targets = cache.targets_for_role(role, target)
+    expanded_targets = expand_targets(role, target)
     if not expanded_targets:
-        reject_api_request(socket, address, 'INVALID role:target')
-        return
+        return 'INVALID role:target'
 
     logger.info('-> %s OK, to %s:%s (%s)',
                 address, role, target, notification.get('priority', notification.get('mode', '?')))
@@ -116,10 +130,46 @@ def handle_api_notification_request(socket, address, req):
         temp_notification['target'] = _target
         send_queue.put(temp_notification)
     stats['notification_cnt'] += 1
-    socket.sendall(msgpack.packb('OK'))
 
 
-def handle_slave_send(socket, address, req):
+def handle_api_notification_request(connection, address, req):
+    error = queue_notification(address, req['data'], cache.targets_for_role)
+    if error:
+        reject_api_request(connection, address, error)
+        return
+    connection.send('OK')
+
+
+def handle_api_notification_batch_request(connection, address, req):
+    notifications = req['data']
+    if not isinstance(notifications, list):
+        reject_api_request(connection, address, 'INVALID batch')
+        return
+
+    # batches commonly page the same role:target many times, so only expand
+    # each pair once
+    expanded = {}
+
+    def expand_targets(role, target):
+        key = (role, target)
+        if key not in expanded:
+            expanded[key] = cache.targets_for_role(role, target)
+        return expanded[key]
+
+    results = []
+    for notification in notifications:
+        if not isinstance(notification, dict):
+            results.append('INVALID notification')
+            continue
+        error = queue_notification(address, notification, expand_targets)
+        if error:
+            logger.info('-> %s %s', address, error)
+        results.append(error or 'OK')
+    stats['notification_batch_cnt'] += 1
+    connection.send(results)
+
+
+def handle_slave_send(connection, address, req):
     message = req['data']
     message_id = message.get('message_id', '?')
 
@@ -139,34 +189,64 @@ def handle_slave_send(socket, address, req):
         logger.exception('Sending message (ID %s) from master %s failed.')
         stats['slave_message_send_fail_cnt'] += 1
 
-    socket.sendall(msgpack.packb(response))
+    connection.send(response)
 
 
 api_request_handlers = {
     'v0/send': handle_api_notification_request,
+    'v0/send_batch': handle_api_notification_batch_request,
     'v0/slave_send': handle_slave_send
 }
 
 
-def handle_api_request(socket, address):
-    stats['api_request_cnt'] += 1
-    timeout = Timeout.start_new(rpc_timeout)
+def wait_for_api_request(connection):
+    # Block on a kept alive connection until the client starts its next
+    # request. Returns False if the client went away or stayed idle for longer
+    # than rpc_idle_timeout.
+    timeout = Timeout.start_new(rpc_idle_timeout)
     try:
-        req = msgpack_unpack_msg_from_socket(socket)
-        logger.info('%s %s', address, req['endpoint'])
-        handler = api_request_handlers.get(req['endpoint'])
-        if handler is not None:
-            handler(socket, address, req)
-        else:
-            logger.info('-> %s unknown request', address)
-            socket.sendall(msgpack.packb('UNKNOWN'))
+        return connection.fill(1)
     except Timeout:
-        stats['api_request_timeout_cnt'] += 1
-        logger.info('-> %s timeout', address)
-        socket.sendall(msgpack.packb('TIMEOUT'))
+        return False
     finally:
         timeout.cancel()
-    socket.close()
+
+
+def handle_api_request(socket, address):
+    # API workers keep connections open and send further requests over them,
+    # so keep serving requests until the client closes the connection.
+    connection = MsgpackFramedSocket(socket, rpc_max_frame_size)
+    keepalive = False
+    while True:
+        # a client may have sent its next request along with the previous one
+        if keepalive and not connection.buffered and not wait_for_api_request(connection):
+            break
+        timeout = Timeout.start_new(rpc_timeout)
+        try:
+            req = connection.recv()
+            if req is None:
+                break
+            stats['api_request_cnt'] += 1
+            logger.info('%s %s', address, req['endpoint'])
+            handler = api_request_handlers.get(req['endpoint'])
+            if handler is not None:
+                handler(connection, address, req)
+            else:
+                logger.info('-> %s unknown request', address)
+                connection.send('UNKNOWN')
+        except Timeout:
+            stats['api_request_timeout_cnt'] += 1
+            logger.info('-> %s timeout', address)
+            connection.send('TIMEOUT')
+            break
+        except MsgpackFrameError:
+            stats['api_request_invalid_cnt'] += 1
+            logger.exception('-> %s invalid request frame', address)
+            break
+        finally:
+            timeout.cancel()
+        keepalive = True
+    connection.close()
 
 
 def run(sender_config):
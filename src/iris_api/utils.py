@@ -7,13 +7,18 @@ from __future__ import absolute_import
 from phonenumbers import (format_number as pn_format_number, parse as pn_parse,
                           PhoneNumberFormat)
 import datetime
+import time
 import ujson
 from . import db
+from . import cache
+from .metrics import stats
 import re
+import struct
 import msgpack
 
 uuid4hex = re.compile('[0-9a-f]{32}\Z', re.I)
 allowed_text_response_actions = frozenset(['suppress', 'claim'])
+default_max_frame_size = 16 * 1024 * 1024
 
 
 def normalize_phone_number(num):
@@ -109,6 +114,11 @@ def get_incident_context_from_batch_id(batch_id):
 
 
 def lookup_username_from_contact(mode, destination, session=None):
+    target = cache.contacts.get(cache.contact_key(mode, destination))
+    if target:
+        stats['contact_cache_hit_cnt'] += 1
+        return target[0]
+    stats['contact_cache_miss_cnt'] += 1
     if not session:
         session = db.Session()
     if mode == 'sms' or mode == 'call':
@@ -142,36 +152,117 @@ def claim_incident(incident_id, owner, session=None):
 
 
 def claim_incidents_from_batch_id(batch_id, owner):
-    session = db.Session()
-    sql = ('UPDATE incident '
-           'INNER JOIN message ON (message.incident_id=incident.id) '
-           'SET incident.owner_id=(SELECT target.id FROM target WHERE target.name=:owner) '
-           '  , incident.updated=:now, incident.active=0 '
-           'WHERE message.batch=:batch_id ')
-    args = {
-        'batch_id': batch_id,
-        'owner': owner,
-        'now': datetime.datetime.utcnow(),
-    }
-    session.execute(sql, args)
-    session.execute('''UPDATE `message` `a`
-                       JOIN `message` `b` ON `a`.`incident_id` = `b`.`incident_id`
-                       SET `a`.`active`=0 WHERE `b`.`batch`=:batch''',
-                    {'batch': batch_id})
-    session.commit()
-    session.close()
+    '''
+    Claim every incident with a message in the batch. The incident ids are
+    looked up once so both updates hit primary key and incident_id indexes
+    instead of joining message against itself.
+    '''
+    start = time.time()
+    connection = db.engine.raw_connection()
+    cursor = connection.cursor()
+    try:
+        cursor.execute('''SELECT DISTINCT `incident_id` FROM `message`
+                          WHERE `batch` = %s AND `incident_id` IS NOT NULL''', batch_id)
+        incident_ids = tuple(row[0] for row in cursor)
+        if incident_ids:
+            cursor.execute('''UPDATE `incident`
+                              SET `owner_id` = (SELECT `id` FROM `target` WHERE `name` = %s),
+                                  `updated` = %s, `active` = FALSE
+                              WHERE `id` IN %s''',
+                           (owner, datetime.datetime.utcnow(), incident_ids))
+            cursor.execute('UPDATE `message` SET `active` = FALSE WHERE `incident_id` IN %s', [incident_ids])
+            connection.commit()
+    finally:
+        cursor.close()
+        connection.close()
+    stats['batch_claim_incidents'] = len(incident_ids)
+    stats['batch_claim_time'] = time.time() - start
+
+
+class MsgpackFrameError(Exception):
+    pass
+
+
+class MsgpackFramedSocket(object):
+    '''
+    Length prefixed msgpack messages over a stream socket.
 
+    Each frame is a 4 byte big endian payload length followed by the msgpack
+    payload. Reads go through recv_into a buffer that is reused for the
+    lifetime of the connection, so one recv can pick up several frames and
+    payloads are unpacked straight out of the buffer without copying them.
+    '''
+    header = struct.Struct('!I')
 
-def msgpack_unpack_msg_from_socket(socket):
-    unpacker = msgpack.Unpacker()
-    while True:
-        buf = socket.recv(1024)
-        if not buf:
-            break
-        unpacker.feed(buf)
-        try:
-            item = unpacker.next()
-        except StopIteration:
-            pass
+    def __init__(self, socket, max_frame_size=None, buffer_size=65536):
+        self.socket = socket
+        self.max_frame_size = max_frame_size or default_max_frame_size
+        self.buf = bytearray(buffer_size)
+        self.view = memoryview(self.buf)
+        # unread data lives in buf[start:end]
+        self.start = 0
+        self.end = 0
+
+    @property
+    def buffered(self):
+        return self.end - self.start
+
+    def fill(self, size):
+        '''
+        Read until at least size bytes are buffered. Returns False if the peer
+        closed the connection first.
+        '''
+        while self.end - self.start < size:
+            if len(self.buf) - self.start < size:
+                self.make_room(size)
+            n = self.socket.recv_into(self.view[self.end:])
+            if not n:
+                return False
+            self.end += n
+        return True
+
+    def make_room(self, size):
+        pending = self.end - self.start
+        if size > len(self.buf):
+            buf = bytearray(max(size, len(self.buf) * 2))
+            buf[:pending] = self.view[self.start:self.end]
+            self.buf = buf
+            self.view = memoryview(buf)
         else:
-            return item
+            self.buf[:pending] = self.buf[self.start:self.end]
+        self.start = 0
+        self.end = pending
+
+    def recv(self):
+        '''
+        Return the next message, or None if the peer closed the connection
+        between messages.
+        '''
+        header_size = self.header.size
+        if not self.fill(header_size):
+            if self.buffered:
+                raise MsgpackFrameError('Connection closed mid frame header')
+            return None
+        size, = self.header.unpack_from(self.buf, self.start)
+        if size > self.max_frame_size:
+            raise MsgpackFrameError('Frame of %d bytes exceeds max frame size %d' % (size, self.max_frame_size))
+        if not self.fill(header_size + size):
+            raise MsgpackFrameError('Connection closed mid frame')
+        offset = self.start + header_size
+        self.start = offset + size
+        if self.start == self.end:
+            self.start = self.end = 0
+        # msgpack only takes old style buffers, which on py2 slice bytearrays
+        # without copying
+        return msgpack.unpackb(buffer(self.buf, offset, size))
+
+    def send(self, obj, default=None):
+        self.send_packed(msgpack.packb(obj, default=default))
+
+    def send_packed(self, payload):
+        if len(payload) > self.max_frame_size:
+            raise MsgpackFrameError('Frame of %d bytes exceeds max frame size %d' % (len(payload), self.max_frame_size))
+        self.socket.sendall(self.header.pack(len(payload)) + payload)
+
+    def close(self):
+        self.socket.close()
@@ -658,6 +658,27 @@ def test_post_incident(sample_user, sample_team, sample_application_name, sample
     assert re.json() == {'owner': sample_user, 'incident_id': incident_id, 'active': False}
 
 
+def test_post_incident_batch(sample_user, sample_application_name):
+    # reuses the plan created by test_post_incident
+    headers = {'Authorization': 'hmac %s:abc' % sample_application_name}
+    re = requests.post(base_url + 'incidents/batch', json=[
+        {'plan': sample_user + '-test-incident-post', 'context': {}},
+        {'plan': 'fake-plan-does-not-exist', 'context': {}},
+        {'plan': sample_user + '-test-incident-post', 'context': {}},
+    ], headers=headers)
+    assert re.status_code == 200
+    results = re.json()
+    assert results[1] == 'Plan not found: fake-plan-does-not-exist'
+    assert results[2] > results[0]
+    for incident_id in (results[0], results[2]):
+        re = requests.get(base_url + 'incidents/%d' % incident_id)
+        assert re.status_code == 200
+        assert re.json()['plan'] == sample_user + '-test-incident-post'
+
+    re = requests.post(base_url + 'incidents/batch', json={}, headers=headers)
+    assert re.status_code == 400
+
+
 def test_post_incident_change_application(sample_user, sample_application_name, sample_application_name2, superuser_application):
 
     # superuser_application (iris-frontend) is allowed to create incidents as other apps, so this works
@@ -1349,6 +1370,35 @@ def test_post_invalid_notification(sample_user):
     assert 'Invalid mode' in re.text
 
 
+def test_post_invalid_notification_batch(sample_user):
+    re = requests.post(base_url + 'notifications/batch', json={})
+    assert re.status_code == 400
+    assert 'Invalid batch' in re.text
+
+    re = requests.post(base_url + 'notifications/batch', json=[{}] * 101)
+    assert re.status_code == 400
+    assert 'Batch too large' in re.text
+
+    re = requests.post(base_url + 'notifications/batch', json=[
+        {
+            'role': 'user',
+            'target': sample_user,
+            'subject': 'test',
+            'priority': 'fakepriority'
+        },
+        {
+            'role': 'user',
+            'subject': 'test',
+            'mode': 'email'
+        },
+    ])
+    assert re.status_code == 200
+    results = re.json()
+    assert len(results) == 2
+    assert results[0] == 'Invalid priority: fakepriority'
+    assert results[1] == 'Missing required atrributes: target'
+
+
 class TestDelete(object):
     def setup_method(self, method):
         with iris_ctl.db_from_config(sample_db_config) as (conn, cursor):
@@ -8,6 +8,7 @@ from iris_api.api import ReqBodyMiddleware, AuthMiddleware, Healthcheck
 import time
 import hmac
 import hashlib
+import ujson
 import base64
 from mock import patch, mock_open
 
@@ -97,3 +98,596 @@ class TestAuth(falcon.testing.TestCase):
         result = self.simulate_get(path='/foo/bar')
         self.assertEqual(result.status_code, 200)
         self.assertEqual(result.content, 'Hello world')
+
+
+class TestChangeLog(falcon.testing.TestCase):
+    def test_change_log_reloads_api_cache(self):
+        from iris_api.api import ChangeLogMiddleware
+        from iris_api.change_log import ChangeLog
+        from mock import MagicMock
+
+        engine = MagicMock()
+        cursor = engine.raw_connection.return_value.cursor.return_value
+        cursor.fetchone.return_value = (1,)
+        change_log = ChangeLog(engine)
+        change_log.poll()
+
+        with patch('iris_api.cache.cache_applications') as cache_applications, \
+                patch('iris_api.cache.cache_plan_coverage') as cache_plan_coverage, \
+                patch('iris_api.cache.cache_contacts') as cache_contacts:
+            iris_api.cache.subscribe(change_log)
+            self.api = falcon.API(middleware=[ChangeLogMiddleware(change_log, 0)])
+            self.api.add_route('/healthcheck', Healthcheck('healthcheck_path'))
+
+            cursor.fetchall.return_value = ((2, 'application', 'app'), )
+            with patch('__builtin__.open', mock_open(read_data='GOOD')):
+                self.simulate_get(path='/healthcheck')
+            cache_applications.assert_called_once_with()
+            self.assertFalse(cache_contacts.called)
+
+            # missed changes reload everything
+            change_log.version = None
+            with patch('__builtin__.open', mock_open(read_data='GOOD')):
+                self.simulate_get(path='/healthcheck')
+            self.assertEqual(cache_applications.call_count, 2)
+            self.assertTrue(cache_plan_coverage.called)
+            cache_contacts.assert_called_once_with()
+
+
+    def test_committed_plan_write_survives_coverage_failure(self):
+        from iris_api.api import Plan
+
+        self.api = falcon.API(middleware=[ReqBodyMiddleware()])
+        self.api.add_route('/v0/plans/{plan_id}', Plan())
+        with patch('iris_api.api.db') as db, patch('iris_api.api.response_cache'), \
+                patch('iris_api.cache.cache_plan_coverage', side_effect=Exception('lock wait timeout')):
+            db.Session.return_value.execute.return_value.scalar.return_value = 'plan'
+            result = self.simulate_post(path='/v0/plans/1', body=ujson.dumps({'active': 1}))
+            self.assertEqual(result.status, falcon.HTTP_200)
+            self.assertEqual(result.json, 1)
+            db.Session.return_value.commit.assert_called_once_with()
+
+
+class TestMetrics(falcon.testing.TestCase):
+    def test_metrics_default_to_dummy(self):
+        from iris_api.metrics import get_metrics_provider
+        from iris_api.metrics.dummy import dummy
+        self.assertIsInstance(get_metrics_provider({}, 'iris-api'), dummy)
+
+    def test_metrics_emitted_in_background(self):
+        from iris_api.api import MetricsMiddleware
+
+        middleware = MetricsMiddleware(0)
+        with patch('iris_api.api.spawn') as spawn, patch('iris_api.api.emit_metrics') as emit_metrics:
+            middleware.process_response(None, None, None)
+            spawn.assert_called_once_with(emit_metrics)
+            emit_metrics.assert_not_called()
+
+
+class TestResponseCache(falcon.testing.TestCase):
+    def test_etag_and_invalidation(self):
+        from iris_api.api import Modes, response_cache, default_api_metrics
+        from iris_api.metrics import stats
+
+        self.api.add_route('/v0/modes', Modes())
+        response_cache.data.clear()
+        response_cache.keys_by_type.clear()
+        with patch('iris_api.api.db') as db, patch.dict(stats, default_api_metrics):
+            cursor = db.engine.raw_connection.return_value.cursor.return_value
+            cursor.fetchall.return_value = [{'id': 1, 'name': 'email'}]
+
+            result = self.simulate_get(path='/v0/modes')
+            self.assertEqual(result.json, ['email'])
+            etag = result.headers['etag']
+
+            result = self.simulate_get(path='/v0/modes')
+            self.assertEqual(result.json, ['email'])
+            self.assertEqual(result.headers['etag'], etag)
+            self.assertEqual(cursor.execute.call_count, 1)
+
+            result = self.simulate_get(path='/v0/modes', headers={'If-None-Match': 'W/"foo", %s' % etag})
+            self.assertEqual(result.status, falcon.HTTP_304)
+            self.assertEqual(result.content, '')
+
+            response_cache.invalidate('mode')
+            cursor.fetchall.return_value = [{'id': 1, 'name': 'email'}, {'id': 2, 'name': 'sms'}]
+            result = self.simulate_get(path='/v0/modes', headers={'If-None-Match': etag})
+            self.assertEqual(result.status, falcon.HTTP_200)
+            self.assertEqual(result.json, ['email', 'sms'])
+            self.assertNotEqual(result.headers['etag'], etag)
+            self.assertEqual(cursor.execute.call_count, 2)
+            self.assertEqual(stats['response_cache_hit_cnt'], 2)
+            self.assertEqual(stats['response_cache_not_modified_cnt'], 1)
+
+            # entries expire even without an invalidation
+            with patch('iris_api.api.time.time', return_value=time.time() + response_cache.ttl + 1):
+                self.simulate_get(path='/v0/modes')
+            self.assertEqual(cursor.execute.call_count, 3)
+
+    def test_priorities_etag(self):
+        from iris_api.api import Priorities, response_cache, default_api_metrics
+        from iris_api.metrics import stats
+
+        self.api.add_route('/v0/priorities', Priorities())
+        response_cache.data.clear()
+        response_cache.keys_by_type.clear()
+        with patch('iris_api.api.db') as db, patch.dict(stats, default_api_metrics):
+            cursor = db.engine.raw_connection.return_value.cursor.return_value
+            cursor.__iter__.side_effect = lambda: iter([{'id': 1, 'name': 'high', 'default_mode': 'sms'}])
+
+            result = self.simulate_get(path='/v0/priorities')
+            self.assertEqual(result.json, [{'name': 'high', 'default_mode': 'sms'}])
+            etag = result.headers['etag']
+
+            result = self.simulate_get(path='/v0/priorities', headers={'If-None-Match': etag})
+            self.assertEqual(result.status, falcon.HTTP_304)
+            self.assertEqual(cursor.execute.call_count, 1)
+
+            # priorities name their default mode, so mode changes drop them too
+            response_cache.invalidate('mode')
+            result = self.simulate_get(path='/v0/priorities', headers={'If-None-Match': etag})
+            self.assertEqual(result.status, falcon.HTTP_304)
+            self.assertEqual(cursor.execute.call_count, 2)
+
+
+class TestStreamRows(falcon.testing.TestCase):
+    def test_unlimited_query_streams(self):
+        from iris_api.api import Messages, default_api_metrics
+        from iris_api.metrics import stats
+
+        self.api.add_route('/v0/messages', Messages())
+        with patch('iris_api.api.db') as db, patch('iris_api.api.stream_chunk_size', 2), \
+                patch.dict(stats, default_api_metrics):
+            connection = db.read_engine.return_value.raw_connection.return_value
+            connection.escape.side_effect = lambda value: "'%s'" % value
+            cursor = connection.cursor.return_value
+            cursor.fetchmany.side_effect = [[{'id': 1, 'created': 3}, {'id': 2, 'created': 2}],
+                                            [{'id': 3, 'created': 1}], []]
+
+            result = self.simulate_get(path='/v0/messages', query_string='fields=id')
+            self.assertEqual(result.json, [{'id': 1}, {'id': 2}, {'id': 3}])
+            connection.cursor.assert_called_once_with(db.ss_dict_cursor)
+            cursor.fetchmany.assert_called_with(2)
+            connection.close.assert_called_once_with()
+
+            # small limits are still buffered
+            cursor.fetchmany.reset_mock()
+            self.simulate_get(path='/v0/messages', query_string='fields=id&limit=1')
+            connection.cursor.assert_called_with(db.dict_cursor)
+            self.assertFalse(cursor.fetchmany.called)
+
+    def test_stream_errors_close_the_connection(self):
+        from iris_api.api import Messages, RowStream, default_api_metrics
+        from iris_api.metrics import stats
+
+        self.api.add_route('/v0/messages', Messages())
+        with patch('iris_api.api.db') as db, patch.dict(stats, default_api_metrics):
+            connection = db.read_engine.return_value.raw_connection.return_value
+            connection.escape.side_effect = lambda value: "'%s'" % value
+            cursor = connection.cursor.return_value
+            cursor.fetchmany.side_effect = Exception('Lost connection')
+
+            # errors before the first chunk fail the request instead of sending a 200
+            with self.assertRaises(Exception):
+                self.simulate_get(path='/v0/messages')
+            connection.close.assert_called_once_with()
+
+            # a stream that is never read still releases its connection
+            connection.close.reset_mock()
+            cursor.fetchmany.side_effect = [[{'id': 1}]]
+            stream = RowStream(connection, cursor)
+            del stream
+            connection.close.assert_called_once_with()
+
+    def test_keyset_pagination(self):
+        from iris_api.api import Messages, next_page_cursor, default_api_metrics
+        from iris_api.metrics import stats
+
+        self.api.add_route('/v0/messages', Messages())
+        with patch('iris_api.api.db') as db, patch.dict(stats, default_api_metrics):
+            connection = db.read_engine.return_value.raw_connection.return_value
+            connection.escape.side_effect = lambda value: "'%s'" % value
+            cursor = connection.cursor.return_value
+            cursor.fetchall.side_effect = lambda: ({'id': 5, 'created': 100, 'subject': 'a'},
+                                                   {'id': 4, 'created': 100, 'subject': 'b'})
+
+            result = self.simulate_get(path='/v0/messages', query_string='fields=subject&limit=2')
+            self.assertEqual(result.json, [{'subject': 'a'}, {'subject': 'b'}])
+            page_cursor = result.headers['x-next-cursor']
+            self.assertEqual(page_cursor, next_page_cursor({'id': 4, 'created': 100}))
+
+            self.simulate_get(path='/v0/messages', query_string='fields=subject&limit=2&cursor=' + page_cursor)
+            query, values = cursor.execute.call_args[0]
+            self.assertIn('`message`.`created` = FROM_UNIXTIME(%s) AND `message`.`id` < %s', query)
+            self.assertIn('ORDER BY `message`.`created` DESC, `message`.`id` DESC LIMIT %s', query)
+            self.assertEqual(values, [100, 100, 4, 2])
+
+            # a short page is the last one
+            cursor.fetchall.side_effect = lambda: ({'id': 3, 'created': 90, 'subject': 'c'}, )
+            result = self.simulate_get(path='/v0/messages', query_string='fields=subject&limit=2&cursor=' + page_cursor)
+            self.assertNotIn('x-next-cursor', result.headers)
+
+            db.read_engine.reset_mock()
+            result = self.simulate_get(path='/v0/messages', query_string='limit=2&cursor=foo')
+            self.assertEqual(result.status, falcon.HTTP_400)
+            # rejected before a connection is checked out, which it would leak
+            db.read_engine.return_value.raw_connection.assert_not_called()
+
+            # a cursor without a limit still walks the same order
+            cursor.fetchmany.side_effect = [[{'id': 3, 'created': 90, 'subject': 'c'}], []]
+            self.simulate_get(path='/v0/messages', query_string='fields=subject&cursor=' + page_cursor)
+            query, values = cursor.execute.call_args[0]
+            self.assertTrue(query.endswith('ORDER BY `message`.`created` DESC, `message`.`id` DESC'))
+            self.assertEqual(values, [100, 100, 4])
+
+            # pages larger than a stream chunk are rejected instead of cut short
+            db.read_engine.reset_mock()
+            with patch('iris_api.api.stream_chunk_size', 2):
+                result = self.simulate_get(path='/v0/messages', query_string='fields=subject&limit=1000')
+            self.assertEqual(result.status, falcon.HTTP_400)
+            db.read_engine.return_value.raw_connection.assert_not_called()
+
+
+class TestFilterQueries(falcon.testing.TestCase):
+    def test_filters_are_bound_and_cached(self):
+        from iris_api.api import Plans, default_api_metrics, query_cache
+        from iris_api.metrics import stats
+
+        self.api.add_route('/v0/plans', Plans())
+        query_cache.clear()
+        with patch('iris_api.api.db') as db, patch.dict(stats, default_api_metrics):
+            cursor = db.read_engine.return_value.raw_connection.return_value.cursor.return_value
+            cursor.fetchall.return_value = ()
+
+            self.simulate_get(path='/v0/plans', query_string='name__contains=foo&id__in=1,2&active=1&limit=10')
+            query, values = cursor.execute.call_args[0]
+            self.assertIn('`plan_active`.`plan_id` IS NOT NULL', query)
+            self.assertIn('`plan`.`id` in %s', query)
+            self.assertIn('`plan`.`name` LIKE CONCAT("%%", %s, "%%")', query)
+            self.assertEqual(values, [(1, 2), 'foo', 10])
+
+            self.simulate_get(path='/v0/plans', query_string='name__contains=bar&id__in=3,4,5&active=1&limit=5')
+            self.assertEqual(cursor.execute.call_args[0], (query, [(3, 4, 5), 'bar', 5]))
+            self.assertEqual(stats['query_cache_miss_cnt'], 1)
+            self.assertEqual(stats['query_cache_hit_cnt'], 1)
+
+
+class TestApplications(falcon.testing.TestCase):
+    def test_applications_load_in_constant_queries(self):
+        from iris_api.api import Applications, default_api_metrics, response_cache
+        from iris_api.metrics import stats
+
+        self.api.add_route('/v0/applications', Applications())
+        response_cache.data.clear()
+        apps = [{'id': i, 'name': 'app%d' % i, 'key': 'secret', 'allow_other_app_incidents': 0,
+                 'auth_only': i == 2, 'context_template': None, 'sample_context': None, 'summary_template': None}
+                for i in xrange(1, 4)]
+        variables = [{'application_id': 1, 'name': 'foo', 'required': 1},
+                     {'application_id': 3, 'name': 'bar', 'required': 0}]
+        with patch('iris_api.cache.db') as db, patch.dict(stats, default_api_metrics), \
+                patch.dict(iris_api.cache.applications, clear=True):
+            cursor = db.engine.raw_connection.return_value.cursor.return_value
+            cursor.fetchall.return_value = apps
+            cursor.__iter__.return_value = iter(variables)
+
+            result = self.simulate_get(path='/v0/applications')
+            self.assertEqual(cursor.execute.call_count, 2)
+            self.assertEqual([app['name'] for app in result.json], ['app1', 'app3'])
+            self.assertEqual(result.json[0]['required_variables'], ['foo'])
+            self.assertEqual(result.json[1]['variables'], ['bar'])
+            self.assertNotIn('key', result.json[0])
+            self.assertEqual(iris_api.cache.applications['app2']['variables'], [])
+
+
+class TestContactCache(falcon.testing.TestCase):
+    def test_contacts(self):
+        from iris_api.utils import lookup_username_from_contact
+        from iris_api.api import default_api_metrics
+        from iris_api.metrics import stats
+
+        with patch('iris_api.cache.db') as db, patch('iris_api.utils.db') as utils_db, \
+                patch.dict(stats, default_api_metrics), patch.dict(iris_api.cache.contacts, clear=True), \
+                patch.dict(iris_api.cache.contact_keys_by_target, clear=True):
+            cursor = db.engine.raw_connection.return_value.cursor.return_value
+            cursor.__iter__.return_value = iter([('sms', '+1 415-555-1234', 'demo', 1),
+                                                 ('email', 'Demo@example.com', 'demo', 1),
+                                                 ('sms', '+1 415-555-9876', 'foo', 2)])
+            iris_api.cache.cache_contacts()
+            self.assertEqual(lookup_username_from_contact('sms', '+14155551234'), 'demo')
+            self.assertEqual(lookup_username_from_contact('email', 'demo@example.com'), 'demo')
+            self.assertEqual(stats['contact_cache_hit_cnt'], 2)
+            utils_db.Session.assert_not_called()
+
+            # demo lost their phone number
+            cursor.__iter__.return_value = iter([('email', 'demo@example.com', 'demo', 1)])
+            iris_api.cache.cache_contacts(target_names={'demo'})
+            self.assertEqual(cursor.execute.call_args[0][1], (('demo', ), ))
+            self.assertNotIn(('sms', '14155551234'), iris_api.cache.contacts)
+            self.assertEqual(iris_api.cache.contacts[('sms', '14155559876')], ('foo', 2))
+
+            # unknown contacts fall back to the database
+            utils_db.Session.return_value.execute.return_value.scalar.return_value = 'bar'
+            self.assertEqual(lookup_username_from_contact('sms', '+14155551234'), 'bar')
+            self.assertEqual(stats['contact_cache_miss_cnt'], 1)
+
+
+class TestReadReplicas(falcon.testing.TestCase):
+    def test_read_engine(self):
+        from iris_api import db
+        from mock import MagicMock
+
+        primary = MagicMock()
+        replica = db.Replica(MagicMock())
+        status = replica.engine.raw_connection.return_value.cursor.return_value.fetchone
+        with patch.object(db, 'engine', primary), patch.object(db, 'replicas', [replica]), \
+                patch.object(db, 'max_replica_lag', 30):
+            # replicas are unused until checked
+            self.assertIs(db.read_engine(), primary)
+            status.return_value = {'Seconds_Behind_Master': 5}
+            replica.check()
+            self.assertIs(db.read_engine(), replica.engine)
+
+            status.return_value = {'Seconds_Behind_Master': 60}
+            replica.check()
+            self.assertIs(db.read_engine(), primary)
+
+            # stopped replication
+            status.return_value = {'Seconds_Behind_Master': None}
+            replica.check()
+            self.assertIs(db.read_engine(), primary)
+
+    def test_replicas_are_checked_in_the_background(self):
+        from iris_api import db
+        from mock import MagicMock
+
+        replica = MagicMock()
+        with patch.object(db, 'replicas', [replica]), \
+                patch('iris_api.db.sleep', side_effect=[None, Exception]) as sleep:
+            self.assertRaises(Exception, db.check_replicas)
+            self.assertEqual(replica.check.call_count, 2)
+            sleep.assert_called_with(db.replica_check_interval)
+
+
+class TestCounters(falcon.testing.TestCase):
+    def test_count_batch(self):
+        from iris_api.counters import count_batch
+        from mock import MagicMock
+        import datetime
+
+        cursor = MagicMock()
+        today = datetime.date.today()
+        # watermark, max id, first recent id
+        cursor.fetchone.side_effect = [(10, ), (500, ), (None, )]
+        cursor.fetchall.return_value = [(today, 100)]
+        self.assertTrue(count_batch(cursor, 'total_messages_sent', 'message', 'messages', 100, 60))
+        self.assertEqual(cursor.execute.call_args_list[4][0][1], (10, 110))
+        cursor.execute.assert_any_call(
+            'UPDATE `stats_counter` SET `value` = `value` + %s, `watermark` = %s WHERE `name` = %s',
+            (100, 110, 'total_messages_sent'))
+
+        # stop before rows that may still have uncommitted ids below them
+        cursor.reset_mock()
+        cursor.fetchone.side_effect = [(110, ), (500, ), (111, )]
+        self.assertFalse(count_batch(cursor, 'total_messages_sent', 'message', 'messages', 100, 60))
+        self.assertEqual(cursor.execute.call_count, 4)
+
+
+class TestBatchResponses(falcon.testing.TestCase):
+    def test_create_responses(self):
+        from iris_api.api import ResponseMixin, default_api_metrics
+        from iris_api.metrics import stats
+
+        with patch('iris_api.api.db') as db, patch.dict(stats, default_api_metrics):
+            connection = db.engine.raw_connection.return_value
+            cursor = connection.cursor.return_value
+            ResponseMixin().create_responses([1, 2, 3], 'demo', 'claim')
+            cursor.execute.assert_called_once()
+            query, args = cursor.execute.call_args[0]
+            self.assertEqual(query.count('NOW()'), 3)
+            self.assertEqual(args, ['demo', 1, 'claim', 'demo', 2, 'claim', 'demo', 3, 'claim'])
+            connection.commit.assert_called_once_with()
+            self.assertEqual(stats['response_batch_insert_cnt'], 3)
+
+    def test_claim_incidents_from_batch_id(self):
+        from iris_api.utils import claim_incidents_from_batch_id
+        from iris_api.metrics import stats
+
+        with patch('iris_api.utils.db') as db, patch.dict(stats):
+            connection = db.engine.raw_connection.return_value
+            cursor = connection.cursor.return_value
+            cursor.__iter__.return_value = iter([(10, ), (11, )])
+            claim_incidents_from_batch_id('abc', 'demo')
+            self.assertEqual(cursor.execute.call_count, 3)
+            self.assertEqual(cursor.execute.call_args_list[1][0][1][2], (10, 11))
+            self.assertEqual(cursor.execute.call_args_list[2][0][1], [(10, 11)])
+            connection.commit.assert_called_once_with()
+            self.assertEqual(stats['batch_claim_incidents'], 2)
+
+            # nothing to claim
+            cursor.reset_mock()
+            connection.reset_mock()
+            cursor.__iter__.return_value = iter([])
+            claim_incidents_from_batch_id('abc', 'demo')
+            self.assertEqual(cursor.execute.call_count, 1)
+            connection.commit.assert_not_called()
+
+
+class TestResponseQueue(falcon.testing.TestCase):
+    def test_enqueue_and_process(self):
+        from iris_api.api import ResponseQueue, default_api_metrics
+        from iris_api.metrics import stats
+        from mock import MagicMock
+
+        queue = ResponseQueue(size=2)
+        handler = MagicMock()
+        queue.register('twilio-messages', handler)
+
+        with patch('iris_api.api.db') as db, patch.dict(stats, default_api_metrics):
+            cursor = db.engine.raw_connection.return_value.cursor.return_value
+            cursor.rowcount = 1
+            cursor.lastrowid = 7
+            self.assertTrue(queue.enqueue('twilio-messages', 'SM123', 'Body=claim'))
+            queue.pool.join()
+            handler.assert_called_once_with('Body=claim', 7)
+            cursor.execute.assert_called_with('UPDATE `response_queue` SET `processed` = NOW() WHERE `id` = %s', 7)
+            key = cursor.execute.call_args_list[0][0][1][0]
+
+            # provider retries are acknowledged but not processed again
+            cursor.reset_mock()
+            cursor.rowcount = 0
+            self.assertFalse(queue.enqueue('twilio-messages', 'SM123', 'Body=claim'))
+            self.assertEqual(cursor.execute.call_args[0][1][0], key)
+            queue.pool.join()
+            handler.assert_called_once_with('Body=claim', 7)
+            self.assertEqual(stats['response_queue_duplicate_cnt'], 1)
+
+            # failures are left for a later sweep, invalid responses are not
+            handler.side_effect = Exception('db lock')
+            cursor.reset_mock()
+            queue.process(8, 'twilio-messages', 'Body=claim')
+            cursor.execute.assert_not_called()
+            handler.side_effect = falcon.HTTPBadRequest('Invalid response', 'failed to parse response')
+            queue.process(8, 'twilio-messages', 'Body=claim')
+            cursor.execute.assert_called_once_with(
+                'UPDATE `response_queue` SET `processed` = NOW() WHERE `id` = %s', 8)
+
+            # the last attempt is counted as dead
+            handler.side_effect = Exception('db lock')
+            queue.process(8, 'twilio-messages', 'Body=claim', queue.max_attempts)
+            self.assertEqual(stats['response_queue_dead_cnt'], 1)
+
+            # rows that find the pool full are released rather than blocking
+            handler.reset_mock()
+            handler.side_effect = None
+            cursor.reset_mock()
+            cursor.rowcount = 1
+            cursor.lastrowid = 9
+            with patch.object(queue.pool, 'full', side_effect=[False, True]):
+                self.assertTrue(queue.enqueue('twilio-messages', 'SM456', 'Body=claim'))
+            cursor.execute.assert_called_with('UPDATE `response_queue` SET `claimed` = NULL, '
+                                              '`attempts` = `attempts` - 1 WHERE `id` IN %s', ((9, ), ))
+            queue.pool.join()
+            handler.assert_not_called()
+
+            # sweeps pick it up again
+            cursor.reset_mock()
+            cursor.fetchall.return_value = [(9, 'twilio-messages', 'Body=claim', 0)]
+            queue.sweep()
+            queue.pool.join()
+            handler.assert_called_once_with('Body=claim', 9)
+            self.assertEqual(stats['response_queue_sweep_cnt'], 1)
+
+    def test_twilio_messages_queued(self):
+        from iris_api.api import ResponseQueue, ResponseTwilioMessages
+
+        queue = ResponseQueue()
+        self.api = falcon.API(middleware=[ReqBodyMiddleware()])
+        resource = ResponseTwilioMessages(queue)
+        self.api.add_route('/v0/response/twilio/messages', resource)
+
+        with patch.object(queue, 'enqueue') as enqueue:
+            body = 'Body=123%20claim&From=%2B14155551234&MessageSid=SM123'
+            result = self.simulate_post(path='/v0/response/twilio/messages', body=body)
+            self.assertEqual(result.status, falcon.HTTP_200)
+            self.assertEqual(result.json, {'app_response': ''})
+            enqueue.assert_called_once_with('twilio-messages', 'SM123', body)
+
+            # malformed webhooks are still rejected inline
+            result = self.simulate_post(path='/v0/response/twilio/messages', body='From=%2B14155551234')
+            self.assertEqual(result.status, falcon.HTTP_400)
+            enqueue.assert_called_once()
+
+        # once processed, the answer is texted back to the sender
+        with patch.object(resource, 'handle_user_response', return_value=('app', 'Iris incident(123) claimed.')), \
+                patch.object(resource, 'create_reply_message', return_value=(True, 1)) as create_reply_message:
+            queue.handlers['twilio-messages'](body, 3)
+            resource.handle_user_response.assert_called_once_with('sms', '123', '+14155551234', 'claim', 3)
+            create_reply_message.assert_called_once_with('sms', 'app', '+14155551234', 'Iris incident(123) claimed.',
+                                                         'Iris incident(123) claimed.')
+
+
+    def test_queued_responses_are_retried_once_recorded(self):
+        from iris_api.api import ResponseTwilioMessages
+
+        resource = ResponseTwilioMessages()
+        with patch('iris_api.api.db') as db, patch('iris_api.api.get_app_from_msg_id', return_value='app'), \
+                patch('iris_api.api.find_plugin') as find_plugin:
+            session = db.Session.return_value
+            session.execute.return_value.rowcount = 1
+            find_plugin.return_value.handle_response.side_effect = Exception('plugin down')
+
+            # plugin failures of queued responses are retryable, not bad requests
+            with self.assertRaises(Exception) as context:
+                resource.handle_user_response('sms', '123', '+14155551234', 'claim', 7)
+            self.assertNotIsInstance(context.exception, falcon.HTTPError)
+            self.assertIn('`responded` IS NULL', session.execute.call_args_list[0][0][0])
+            self.assertEqual(session.execute.call_count, 2)
+            with self.assertRaises(falcon.HTTPBadRequest):
+                resource.handle_user_response('sms', '123', '+14155551234', 'claim')
+
+            # a retry doesn't insert the response again
+            session.execute.reset_mock()
+            session.execute.return_value.rowcount = 0
+            find_plugin.return_value.handle_response.side_effect = None
+            find_plugin.return_value.handle_response.return_value = 'claimed'
+            self.assertEqual(resource.handle_user_response('sms', '123', '+14155551234', 'claim', 7),
+                             ('app', 'claimed'))
+            session.execute.assert_called_once()
+
+
+class TestIncidentsBatch(falcon.testing.TestCase):
+    def test_batch_validates_plans_once(self):
+        from iris_api.api import IncidentsBatch
+        from mock import MagicMock
+
+        app = {'id': 1, 'name': 'app', 'variables': ['foo'], 'allow_other_app_incidents': False}
+
+        class AppMiddleware(object):
+            def process_request(self, req, resp):
+                req.context['app'] = app
+
+        self.api = falcon.API(middleware=[ReqBodyMiddleware(), AppMiddleware()])
+        self.api.add_route('/v0/incidents/batch', IncidentsBatch(max_batch_size=6))
+
+        with patch('iris_api.api.db') as db, patch('iris_api.cache.db') as cache_db, \
+                patch.dict(iris_api.cache.plan_coverage, {'plan': (10, {1}), 'other': (11, {2})}, clear=True):
+            session = db.Session.return_value
+            session.execute.return_value.lastrowid = 100
+            # ids are auto_increment_increment apart
+            session.execute.return_value.fetchone.return_value = (2, 1)
+            cursor = cache_db.engine.raw_connection.return_value.cursor.return_value
+            cursor.__iter__.side_effect = [iter([]), iter([('other', 12, 1)])]
+
+            incidents = [{'plan': 'plan', 'context': {'foo': 1}}, {'plan': 'missing', 'context': {}},
+                         {'plan': 'plan', 'context': {'foo': 2}}, {'plan': 'plan'}, {'plan': 'missing', 'context': {}},
+                         {'plan': 'other', 'context': {}}]
+            result = self.simulate_post(path='/v0/incidents/batch', body=ujson.dumps(incidents))
+            self.assertEqual(result.json, [100, 'Plan not found: missing', 102, 'missing context attribute',
+                                           'Plan not found: missing', 104])
+            # plans missing from the index, or not covering the app, are reloaded once
+            self.assertEqual(cursor.execute.call_count, 2)
+            self.assertEqual(iris_api.cache.plan_coverage['other'], (12, {1}))
+            self.assertNotIn('missing', iris_api.cache.plan_coverage)
+            # and the incidents are inserted at once
+            self.assertEqual(session.execute.call_count, 2)
+            insert_params = session.execute.call_args[0][1]
+            self.assertEqual(insert_params['context_1'], '{"foo":2}')
+            self.assertEqual(insert_params['plan_id_2'], 12)
+            session.commit.assert_called_once_with()
+
+            # in interleaved lock mode, each row is inserted for its own id
+            session.execute.reset_mock()
+            session.execute.return_value.fetchone.return_value = (1, 2)
+            session.execute.return_value.lastrowid = 200
+            cursor.__iter__.side_effect = [iter([])]
+            result = self.simulate_post(path='/v0/incidents/batch', body=ujson.dumps(incidents[:3]))
+            self.assertEqual(result.json, [200, 'Plan not found: missing', 200])
+            self.assertEqual(session.execute.call_count, 3)
+            self.assertIn(':plan_id_1,', session.execute.call_args[0][0])
+
+            result = self.simulate_post(path='/v0/incidents/batch', body=ujson.dumps(incidents * 2))
+            self.assertEqual(result.status, falcon.HTTP_400)
+
+            # the batch route only creates incidents
+            result = self.simulate_get(path='/v0/incidents/batch')
+            self.assertEqual(result.status, falcon.HTTP_405)
@@ -6,7 +6,9 @@
 # -*- coding:utf-8 -*-
 
 from iris_api.bin.sender import init_sender
+import gevent
 import msgpack
+import pytest
 
 
 def test_configure(mocker):
@@ -84,9 +86,19 @@ fake_plan = {
 }
 
 
+def mock_plan_rows(mocker, plan):
+    plan_row = dict(plan)
+    del plan_row['steps']
+    step_rows = [{'plan_id': plan['id'], 'step': n['step'], 'id': n['id']}
+                 for notifications in plan['steps'] for n in notifications]
+    mock_cursor = mocker.patch('iris_api.sender.cache.plans.engine').raw_connection.return_value.cursor.return_value
+    mock_cursor.__iter__.side_effect = [iter([plan_row]), iter(step_rows)]
+    mocker.patch.dict('iris_api.sender.cache.plans.data', clear=True)
+    return mock_cursor
+
+
 def test_fetch_and_prepare_message(mocker):
-    mock_iris_client = mocker.patch('iris_api.sender.cache.iris_client')
-    mock_iris_client.get.return_value.json.return_value = fake_plan
+    mock_plan_rows(mocker, fake_plan)
     from iris_api.bin.sender import (
         fetch_and_prepare_message, message_queue, send_queue
     )
@@ -122,8 +134,6 @@ def test_fetch_and_send_message(mocker):
     mock_mark_message_sent = mocker.patch('iris_api.bin.sender.mark_message_as_sent')
     mock_mark_message_sent.side_effect = check_mark_message_sent
     mocker.patch('iris_api.bin.sender.set_target_contact').side_effect = mock_set_target_contact
-    mock_iris_client = mocker.patch('iris_api.sender.cache.iris_client')
-    mock_iris_client.get.return_value.json.return_value = fake_plan
     from iris_api.bin.sender import (
         fetch_and_send_message, send_queue
     )
@@ -139,6 +149,27 @@ def test_fetch_and_send_message(mocker):
     mock_mark_message_sent.assert_called_once()
 
 
+def frame(req):
+    from iris_api.utils import MsgpackFramedSocket
+    payload = msgpack.packb(req)
+    return MsgpackFramedSocket.header.pack(len(payload)) + payload
+
+
+def fake_recv_into(*chunks):
+    chunks = list(chunks)
+
+    def recv_into(buf):
+        if not chunks:
+            return 0
+        chunk = chunks.pop(0)
+        if len(chunk) > len(buf):
+            chunk, rest = chunk[:len(buf)], chunk[len(buf):]
+            chunks.insert(0, rest)
+        buf[:len(chunk)] = chunk
+        return len(chunk)
+    return recv_into
+
+
 def test_handle_api_request_v0_send(mocker):
     from iris_api.sender.rpc import handle_api_request
     from iris_api.sender.shared import send_queue
@@ -148,10 +179,10 @@ def test_handle_api_request_v0_send(mocker):
 
     mock_address = mocker.MagicMock()
     mock_socket = mocker.MagicMock()
-    mock_socket.recv.return_value = msgpack.packb({
+    mock_socket.recv_into.side_effect = fake_recv_into(frame({
         'endpoint': 'v0/send',
         'data': fake_notification,
-    })
+    }))
 
     while send_queue.qsize() > 0:
         send_queue.get()
@@ -178,10 +209,10 @@ def test_handle_api_request_v0_send_with_mode(mocker):
 
     mock_address = mocker.MagicMock()
     mock_socket = mocker.MagicMock()
-    mock_socket.recv.return_value = msgpack.packb({
+    mock_socket.recv_into.side_effect = fake_recv_into(frame({
         'endpoint': 'v0/send',
         'data': fake_mode_notification,
-    })
+    }))
 
     while send_queue.qsize() > 0:
         send_queue.get()
@@ -194,6 +225,36 @@ def test_handle_api_request_v0_send_with_mode(mocker):
                                         fake_mode_notification['subject'])
 
 
+def test_handle_api_request_v0_send_batch(mocker):
+    from iris_api.sender.rpc import handle_api_request
+    from iris_api.sender.shared import send_queue
+
+    mock_targets_for_role = mocker.patch('iris_api.sender.cache.RoleTargets.__call__',
+                                         side_effect=lambda role, target: [target] if target != 'nobody' else [])
+
+    missing_target = dict(fake_notification)
+    del missing_target['target']
+    unknown_target = dict(fake_notification, target='nobody')
+
+    mock_address = mocker.MagicMock()
+    mock_socket = mocker.MagicMock()
+    mock_socket.recv_into.side_effect = fake_recv_into(frame({
+        'endpoint': 'v0/send_batch',
+        'data': [dict(fake_notification), missing_target, unknown_target, dict(fake_notification)],
+    }))
+
+    while send_queue.qsize() > 0:
+        send_queue.get()
+
+    handle_api_request(mock_socket, mock_address)
+
+    assert send_queue.qsize() == 2
+    # the repeated role:target is only expanded once
+    assert mock_targets_for_role.call_count == 2
+    mock_socket.sendall.assert_called_once_with(
+        frame(['OK', 'INVALID target', 'INVALID role:target', 'OK']))
+
+
 def test_handle_api_request_v0_send_timeout(mocker):
     import iris_api.sender.rpc
     iris_api.sender.rpc.rpc_timeout = 5
@@ -204,7 +265,7 @@ def test_handle_api_request_v0_send_timeout(mocker):
 
     mock_address = mocker.MagicMock()
     mock_socket = mocker.MagicMock()
-    mock_socket.recv.side_effect = slee_10
+    mock_socket.recv_into.side_effect = slee_10
 
     iris_api.sender.rpc.handle_api_request(mock_socket, mock_address)
 
@@ -243,3 +304,461 @@ def test_generate_slave_message_payload():
         'ids': [1, 2, 3, 4]
       }
     }
+
+
+def test_handle_api_request_keepalive(mocker):
+    from iris_api.sender.rpc import handle_api_request
+    from iris_api.sender.shared import send_queue
+
+    mocker.patch('iris_api.sender.cache.RoleTargets.__call__', lambda _, role, target: [target])
+
+    payload = frame({'endpoint': 'v0/send', 'data': fake_notification})
+    mock_address = mocker.MagicMock()
+    mock_socket = mocker.MagicMock()
+    # two requests in a single read, then a third one split across reads,
+    # then the client hangs up
+    mock_socket.recv_into.side_effect = fake_recv_into(payload * 2, payload[:3], payload[3:])
+
+    while send_queue.qsize() > 0:
+        send_queue.get()
+
+    handle_api_request(mock_socket, mock_address)
+
+    assert send_queue.qsize() == 3
+    assert mock_socket.sendall.call_count == 3
+    mock_socket.close.assert_called_once()
+
+
+def start_rpc_server():
+    from gevent.server import StreamServer
+    from iris_api.sender.rpc import handle_api_request
+    server = StreamServer(('127.0.0.1', 0), handle_api_request)
+    server.start()
+    return server
+
+
+def test_sender_pool_reuses_connections(mocker):
+    from iris_api.sender.pool import SenderConnectionPool, default_pool_metrics
+    from iris_api.metrics import stats
+    mocker.patch.dict(stats, default_pool_metrics)
+    mocker.patch.dict(stats, {'api_request_cnt': 0})
+
+    server = start_rpc_server()
+    pool = SenderConnectionPool([('127.0.0.1', server.server_port)])
+    try:
+        for _ in xrange(3):
+            assert pool.request({'endpoint': 'v0/foo'}) == 'UNKNOWN'
+    finally:
+        pool.close()
+        server.stop()
+
+    assert stats['sender_pool_connect_cnt'] == 1
+    assert stats['sender_pool_reuse_cnt'] == 2
+    assert stats['api_request_cnt'] == 3
+
+
+def test_sender_pool_retries_only_unsent_requests(mocker):
+    from gevent.server import StreamServer
+    from iris_api.sender.pool import SenderConnectionPool, SenderConnectionClosed, default_pool_metrics
+    from iris_api.utils import MsgpackFramedSocket
+    from iris_api.metrics import stats
+    mocker.patch.dict(stats, default_pool_metrics)
+    received = []
+
+    def one_request_per_connection(sock, address):
+        # answers the first request unless told to drop it, then hangs up
+        connection = MsgpackFramedSocket(sock)
+        req = connection.recv()
+        received.append(req)
+        if req['endpoint'] != 'v0/drop':
+            connection.send('OK')
+        connection.close()
+
+    server = StreamServer(('127.0.0.1', 0), one_request_per_connection)
+    server.start()
+    pool = SenderConnectionPool([('127.0.0.1', server.server_port)])
+    try:
+        assert pool.request({'endpoint': 'v0/foo'}) == 'OK'
+        gevent.sleep(0.01)
+        # the pooled connection was closed while idle, so a fresh one is used
+        assert pool.request({'endpoint': 'v0/foo'}) == 'OK'
+        assert stats['sender_pool_stale_cnt'] == 1
+        assert stats['sender_pool_connect_cnt'] == 2
+
+        # the sender may have acted on a request it got, so it isn't resent
+        pool.close()
+        with pytest.raises(SenderConnectionClosed):
+            pool.request({'endpoint': 'v0/drop'})
+        assert len(received) == 3
+    finally:
+        pool.close()
+        server.stop()
+
+
+def test_sender_pool_failover(mocker):
+    from iris_api.sender.pool import SenderConnectionPool, default_pool_metrics
+    from iris_api.metrics import stats
+    mocker.patch.dict(stats, default_pool_metrics)
+    mocker.patch.dict(stats, {'api_request_cnt': 0})
+
+    # grab a port nothing listens on
+    dead = start_rpc_server()
+    dead_address = ('127.0.0.1', dead.server_port)
+    dead.stop()
+
+    server = start_rpc_server()
+    pool = SenderConnectionPool([dead_address, ('127.0.0.1', server.server_port)])
+    try:
+        assert pool.request({'endpoint': 'v0/foo'}) == 'UNKNOWN'
+    finally:
+        pool.close()
+        server.stop()
+
+    assert stats['sender_pool_connect_fail_cnt'] == 1
+    assert stats['sender_pool_failover_cnt'] == 1
+    assert dead_address in pool.down
+
+
+def test_framed_socket_max_frame_size(mocker):
+    from iris_api.utils import MsgpackFramedSocket, MsgpackFrameError
+    mock_socket = mocker.MagicMock()
+    mock_socket.recv_into.side_effect = fake_recv_into(frame({'body': 'x' * 100}))
+    connection = MsgpackFramedSocket(mock_socket, max_frame_size=64)
+    with pytest.raises(MsgpackFrameError):
+        connection.recv()
+    with pytest.raises(MsgpackFrameError):
+        connection.send({'body': 'x' * 100})
+
+
+def test_framed_socket_grows_buffer(mocker):
+    from iris_api.utils import MsgpackFramedSocket
+    big = {'body': 'x' * 1000}
+    mock_socket = mocker.MagicMock()
+    mock_socket.recv_into.side_effect = fake_recv_into(frame({'id': 1}) + frame(big), frame({'id': 2}))
+    connection = MsgpackFramedSocket(mock_socket, buffer_size=16)
+    assert connection.recv() == {'id': 1}
+    assert connection.recv() == big
+    assert connection.recv() == {'id': 2}
+    assert connection.recv() is None
+
+
+def test_role_targets_stale_while_revalidate(mocker):
+    from iris_api.sender.cache import RoleTargets
+    from iris_api.metrics import stats
+    from gevent import sleep
+    mocker.patch('iris_api.sender.cache.RoleTargets.initialize_active_targets')
+    mocker.patch.dict(stats, {'role_target_cache_hit_cnt': 0, 'role_target_cache_miss_cnt': 0,
+                              'role_target_cache_stale_cnt': 0, 'role_target_cache_negative_hit_cnt': 0,
+                              'oncall_error': 0})
+    mock_time = mocker.patch('iris_api.sender.cache.time')
+    mock_time.time.return_value = 1000
+    role_lookup = mocker.MagicMock()
+    role_lookup.team_members.return_value = ['foo', 'bar']
+
+    targets_for_role = RoleTargets(role_lookup, None, ttl=60, stale_ttl=600, negative_ttl=30)
+    targets_for_role.active_targets = {'foo', 'bar'}
+
+    assert targets_for_role('team', 'demo') == {'foo', 'bar'}
+    assert targets_for_role('team', 'demo') == {'foo', 'bar'}
+    assert role_lookup.team_members.call_count == 1
+    assert stats['role_target_cache_miss_cnt'] == 1
+    assert stats['role_target_cache_hit_cnt'] == 1
+
+    # expired entries are served while oncall is down
+    mock_time.time.return_value = 1100
+    role_lookup.team_members.return_value = None
+    assert targets_for_role('team', 'demo') == {'foo', 'bar'}
+    assert stats['role_target_cache_stale_cnt'] == 1
+    sleep(0)
+    assert role_lookup.team_members.call_count == 2
+    assert stats['oncall_error'] == 1
+    assert targets_for_role('team', 'demo') == {'foo', 'bar'}
+    assert role_lookup.team_members.call_count == 2
+
+    # past the stale window the lookup error is returned and cached
+    mock_time.time.return_value = 2000
+    assert targets_for_role('team', 'demo') is None
+    assert targets_for_role('team', 'demo') is None
+    assert role_lookup.team_members.call_count == 3
+    assert stats['role_target_cache_negative_hit_cnt'] == 1
+
+    role_lookup.team_members.return_value = ['foo']
+    mock_time.time.return_value = 2031
+    assert targets_for_role('team', 'demo') == {'foo'}
+
+
+def test_role_targets_single_background_refresh(mocker):
+    from iris_api.sender.cache import RoleTargets
+    from iris_api.metrics import stats
+    mocker.patch('iris_api.sender.cache.RoleTargets.initialize_active_targets')
+    mocker.patch.dict(stats, {'role_target_cache_hit_cnt': 0, 'role_target_cache_miss_cnt': 0,
+                              'role_target_cache_stale_cnt': 0, 'role_target_cache_negative_hit_cnt': 0})
+    mock_spawn = mocker.patch('iris_api.sender.cache.spawn')
+    mock_time = mocker.patch('iris_api.sender.cache.time')
+    mock_time.time.return_value = 1000
+    role_lookup = mocker.MagicMock()
+    role_lookup.team_members.return_value = ['foo']
+
+    targets_for_role = RoleTargets(role_lookup, None, ttl=60, stale_ttl=600, negative_ttl=30)
+    targets_for_role.active_targets = {'foo', 'bar'}
+    targets_for_role('team', 'demo')
+    mock_time.time.return_value = 1100
+    targets_for_role('team', 'demo')
+    mock_spawn.assert_called_once_with(targets_for_role.background_refresh, ('team', 'demo'))
+
+    # a synchronous refresh leaves the in-flight marker alone
+    targets_for_role.refresh(('team', 'demo'))
+    assert ('team', 'demo') in targets_for_role.refreshing
+    mock_time.time.return_value = 1200
+    targets_for_role('team', 'demo')
+    assert mock_spawn.call_count == 1
+
+    targets_for_role.background_refresh(('team', 'demo'))
+    assert not targets_for_role.refreshing
+
+
+def test_oncall_snapshot_expires_at_handoff(mocker):
+    from iris_api.role_lookup.oncall import oncall
+    mock_time = mocker.patch('iris_api.role_lookup.oncall.time')
+    mock_time.time.return_value = 1000
+
+    role_lookup = oncall({'oncall-api': 'http://localhost:8080', 'oncall_snapshot_max_ttl': 1800})
+    mock_get = mocker.patch.object(role_lookup.requests, 'get')
+    mock_get.return_value.status_code = 200
+    mock_get.return_value.json.return_value = [
+        {'username': 'foo', 'start': 0, 'end': 1600},
+        {'username': 'bar', 'start': 0, 'end': 5000},
+    ]
+
+    assert role_lookup.prefetch_oncall([('demo', 'primary'), ('demo', 'secondary'), ('demo', 'primary')]) == 2
+    assert mock_get.call_count == 2
+    assert role_lookup.prefetch_oncall([('demo', 'primary')]) == 0
+
+    assert role_lookup.team_oncall('demo') == ['foo', 'bar']
+    assert role_lookup.team_oncall('demo', 'secondary') == ['foo', 'bar']
+    assert mock_get.call_count == 2
+    assert role_lookup.snapshot_hit_cnt == 2
+
+    # the snapshot is refetched once the first shift ends
+    mock_time.time.return_value = 1600
+    assert role_lookup.team_oncall('demo') == ['foo', 'bar']
+    assert mock_get.call_count == 3
+    assert role_lookup.api_call_cnt == 3
+
+
+def test_cache_lru_eviction(mocker):
+    from iris_api.sender.cache import Cache, default_cache_metrics
+    from iris_api.metrics import stats
+    mocker.patch.dict(stats, default_cache_metrics)
+    mock_time = mocker.patch('iris_api.sender.cache.time')
+    mock_time.time.return_value = 1000
+
+    engine = mocker.MagicMock()
+    cursor = engine.raw_connection.return_value.cursor.return_value
+    cursor.fetchone.side_effect = lambda: {'id': cursor.execute.call_args[0][1]}
+
+    targets = Cache(engine, 'SELECT * FROM `target` WHERE `id`=%s', None, 'targets', max_size=2, ttl=60)
+    assert targets[1] == {'id': 1}
+    assert targets[2] == {'id': 2}
+    assert targets[1] == {'id': 1}
+    # 2 is the least recently used
+    assert targets[3] == {'id': 3}
+    assert list(targets.data) == [1, 3]
+    assert cursor.execute.call_count == 3
+    assert stats['targets_cache_hit_cnt'] == 1
+    assert stats['targets_cache_miss_cnt'] == 3
+    assert stats['targets_cache_eviction_cnt'] == 1
+    assert stats['targets_cache_size'] == 2
+    assert stats['targets_cache_bytes'] == targets.size > 0
+
+    mock_time.time.return_value = 1060
+    assert targets[1] == {'id': 1}
+    assert cursor.execute.call_count == 4
+    assert stats['targets_cache_expired_cnt'] == 1
+
+
+def test_cache_get_many(mocker):
+    from iris_api.sender.cache import Cache, default_cache_metrics
+    from iris_api.metrics import stats
+    mocker.patch.dict(stats, default_cache_metrics)
+
+    engine = mocker.MagicMock()
+    cursor = engine.raw_connection.return_value.cursor.return_value
+    cursor.__iter__.side_effect = lambda: iter([{'id': 1}, {'id': 2}])
+    cursor.fetchone.return_value = None
+
+    targets = Cache(engine, 'SELECT * FROM `target` WHERE `id`=%s', None, 'targets',
+                    many_sql='SELECT * FROM `target` WHERE `id` IN %s')
+    assert targets.get_many([1, 2, 3]) == {1: {'id': 1}, 2: {'id': 2}, 3: None}
+    # one query for the batch, one for the key it didn't return
+    assert cursor.execute.call_count == 2
+    assert cursor.execute.call_args_list[0][0][0] == 'SELECT * FROM `target` WHERE `id` IN %s'
+
+    assert targets.get_many([1, 2, 3]) == {1: {'id': 1}, 2: {'id': 2}, 3: None}
+    assert cursor.execute.call_count == 2
+    assert stats['targets_cache_miss_cnt'] == 3
+    assert stats['targets_cache_hit_cnt'] == 3
+
+
+def test_plans_bulk_load(mocker):
+    from iris_api.sender import cache
+    mock_cursor = mock_plan_rows(mocker, fake_plan)
+
+    plans = cache.plans.load([fake_plan['id']])
+    assert mock_cursor.execute.call_count == 2
+    assert plans[fake_plan['id']]['steps'] == {1: [178243, 178252], 2: [178261]}
+    assert cache.plans[fake_plan['id']] is plans[fake_plan['id']]
+    assert mock_cursor.execute.call_count == 2
+
+
+def test_change_log_poll(mocker):
+    from iris_api.change_log import ChangeLog
+    engine = mocker.MagicMock()
+    cursor = engine.raw_connection.return_value.cursor.return_value
+    cursor.fetchone.return_value = (10,)
+
+    change_log = ChangeLog(engine)
+    # the first poll reloads everything
+    assert change_log.poll() is None
+    assert change_log.version == 10
+
+    cursor.fetchall.return_value = ()
+    assert change_log.poll() == {}
+
+    cursor.fetchall.return_value = ((12, 'template', 'foo'), (13, 'plan', 'bar'))
+    assert change_log.poll() == {'template': {'foo'}, 'plan': {'bar'}}
+    assert change_log.version == 13
+
+    # a change committed late with a lower id is still picked up, once
+    cursor.fetchall.return_value = ((11, 'template', 'baz'), (12, 'template', 'foo'), (13, 'plan', 'bar'))
+    assert change_log.poll() == {'template': {'baz'}}
+    assert change_log.poll() == {}
+    assert change_log.version == 13
+
+
+def test_change_log_poll_backs_off(mocker):
+    from iris_api.change_log import ChangeLog
+    engine = mocker.MagicMock()
+    cursor = engine.raw_connection.return_value.cursor.return_value
+    cursor.fetchone.return_value = (10,)
+    change_log = ChangeLog(engine)
+    assert change_log.poll() is None
+
+    # failures don't reload anything, and aren't retried right away
+    cursor.execute.side_effect = Exception('gone away')
+    assert change_log.poll() == {}
+    assert change_log.poll() == {}
+    assert cursor.execute.call_count == 2
+    assert change_log.version == 10
+
+    # the first poll after recovering reloads everything, once
+    cursor.execute.side_effect = None
+    cursor.fetchall.return_value = ()
+    change_log.retry_at = 0
+    assert change_log.poll() is None
+    assert change_log.poll() == {}
+
+
+def test_rate_counter():
+    from iris_api.sender.cache import RateCounter
+    counter = RateCounter(60, 5)
+    now = counter.tick * 5
+    assert len(counter.buckets) == 12
+
+    assert counter.add(now) == 1
+    assert counter.add(now + 4) == 2
+    assert counter.add(now + 30) == 3
+    # the first two fall out of the window exactly a duration later
+    assert counter.count(now + 59) == 3
+    assert counter.count(now + 60) == 1
+    assert counter.count(now + 89) == 1
+    assert counter.count(now + 90) == 0
+    # idle for longer than the window
+    assert counter.add(now + 1000) == 1
+
+
+def test_rate_counter_resize(mocker):
+    from iris_api.sender.cache import RateCounter
+    mock_time = mocker.patch('iris_api.sender.cache.time')
+    mock_time.time.return_value = 1000
+    counter = RateCounter(60, 5)
+    counter.add(1000)
+    counter.add(1030)
+    counter.add(1055)
+
+    mock_time.time.return_value = 1055
+    smaller = counter.resize(30)
+    assert smaller.duration == 30
+    assert smaller.count(1055) == 2
+    larger = counter.resize(120)
+    assert larger.count(1055) == 3
+    assert larger.count(1119) == 3
+    assert larger.count(1120) == 2
+
+
+def test_target_reprioritization_load_rules(mocker):
+    from iris_api.sender.cache import TargetReprioritization
+    mock_db = mocker.patch('iris_api.sender.cache.db')
+    mock_db.read_engine.return_value = mock_db.engine
+    cursor = mock_db.engine.raw_connection.return_value.cursor.return_value
+
+    target_reprioritization = TargetReprioritization(None)
+    cursor.__iter__.side_effect = lambda: iter([('foo', 'email', 'sms', '123', 2, 60),
+                                                ('bar', 'email', 'call', '456', 3, 300)])
+    target_reprioritization.load_rules()
+    assert set(target_reprioritization.rates) == {('foo', 'email'), ('bar', 'email')}
+    counter = target_reprioritization.rates[('bar', 'email')][3]
+
+    # only the changed target's rules are queried and replaced
+    cursor.__iter__.side_effect = lambda: iter([('foo', 'sms', 'call', '789', 1, 60)])
+    target_reprioritization.load_rules({'foo'})
+    assert cursor.execute.call_args[0][1] == [('foo',)]
+    assert set(target_reprioritization.rates) == {('foo', 'sms'), ('bar', 'email')}
+    assert target_reprioritization.rates[('bar', 'email')][3] is counter
+
+
+def test_message_change_sets_flag(mocker):
+    from iris_api.sender import auditlog
+    mock_db = mocker.patch('iris_api.sender.auditlog.db')
+    session = mock_db.Session.return_value
+
+    auditlog.message_change(1, auditlog.MODE_CHANGE, 'email', 'sms', 'description')
+    assert session.execute.call_count == 2
+    assert session.execute.call_args[0] == ('UPDATE `message` SET `mode_changed` = TRUE WHERE `id` = :message_id',
+                                            {'message_id': 1})
+    session.commit.assert_called_once_with()
+
+    session.reset_mock()
+    auditlog.message_change(1, auditlog.SENT_CHANGE, '', '', 'description')
+    assert session.execute.call_count == 1
+
+
+def test_cache_refresh_relists_periodically(mocker):
+    from iris_api.sender import cache
+    mocker.patch.object(cache, 'change_log')
+    plans = mocker.patch.object(cache, 'plans')
+    templates = mocker.patch.object(cache, 'templates')
+    mocker.patch.object(cache, 'prefetch_oncall')
+    mocker.patch.object(cache, 'full_refresh_interval', 600)
+    mocker.patch.object(cache, 'last_full_refresh', 0)
+
+    cache.refresh()
+    cache.refresh()
+    assert cache.change_log.dispatch.call_count == 2
+    plans.refresh.assert_called_once_with()
+    templates.refresh.assert_called_once_with()
+
+
+def test_prune_change_log_failure_keeps_audit_prune(mocker):
+    from iris_api.bin import sender
+    mock_db = mocker.patch('iris_api.bin.sender.db')
+    connection = mock_db.engine.raw_connection.return_value
+    cursor = connection.cursor.return_value
+    cursor.execute.side_effect = [None, Exception('no change_log table')]
+    mocker.patch('iris_api.bin.sender.sleep', side_effect=StopIteration)
+
+    with pytest.raises(StopIteration):
+        sender.prune_old_audit_logs_worker()
+    cursor.execute.assert_any_call(sender.PRUNE_OLD_AUDIT_LOGS_SQL)
+    connection.commit.assert_called_once_with()
+    connection.rollback.assert_called_once_with()